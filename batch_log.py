@@ -0,0 +1,60 @@
+# batch_log.py - Cấp batch_id và ghi trạng thái batch (dùng chung cho load_to_raw và transform)
+from sqlalchemy import text
+
+BATCH_LOG_TABLE = "batch_log"
+# Bảng sequence được tạo bởi migrations.py (staging v2)
+BATCH_SEQ_TABLE = "batch_id_seq"
+
+
+def allocate_batch_id(conn):
+    """
+    Lấy batch_id mới một cách nguyên tử (AUTO_INCREMENT), an toàn khi nhiều loader chạy song song.
+    """
+    return conn.execute(text(f"INSERT INTO {BATCH_SEQ_TABLE} () VALUES ()")).lastrowid
+
+
+def trim_batch_sequence(engine):
+    """
+    Dọn bảng sequence, chỉ giữ id lớn nhất (AUTO_INCREMENT vẫn tăng tiếp từ đó).
+    Chạy ở bước bảo trì (batch_partitions.py --maintain), không nằm trong luồng cấp batch_id.
+    """
+    with engine.begin() as conn:
+        return conn.execute(text(
+            f"DELETE FROM {BATCH_SEQ_TABLE} WHERE id < (SELECT max_id FROM (SELECT MAX(id) AS max_id FROM {BATCH_SEQ_TABLE}) m)"
+        )).rowcount
+
+
+def start_batch(engine, source_endpoint, source_file, loc_name="", loc_key=""):
+    """
+    Cấp batch_id và ghi dòng RUNNING vào batch_log trong cùng 1 transaction. Trả về batch_id.
+    Dòng log lấy id bằng LAST_INSERT_ID() ngay trên server: 2 câu INSERT + COMMIT, không có câu
+    dọn sequence xen giữa.
+    """
+    with engine.begin() as conn:
+        batch_id = allocate_batch_id(conn)
+        conn.execute(text(f"""
+            INSERT INTO {BATCH_LOG_TABLE}
+            (batch_id, source_system, source_endpoint, source_file, location_name, location_key, start_time, status)
+            VALUES (LAST_INSERT_ID(), 'STAGING', :endpoint, :file, :loc_name, :loc_key, NOW(), 'RUNNING')
+        """), {"endpoint": source_endpoint, "file": source_file,
+               "loc_name": loc_name, "loc_key": loc_key})
+    return batch_id
+
+
+def mark_success(engine, batch_id, success_count, total_records=None):
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            UPDATE {BATCH_LOG_TABLE} SET status='SUCCESS', success_count=:c,
+                total_records=COALESCE(:total, :c), end_time=NOW()
+            WHERE batch_id=:bid
+        """), {"bid": batch_id, "c": success_count, "total": total_records})
+
+
+def mark_failed(engine, batch_id, error_msg, total_records=None):
+    msg = str(error_msg)[:2000] if error_msg else "Lỗi không xác định"
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            UPDATE {BATCH_LOG_TABLE} SET status='FAILED', total_records=COALESCE(:total, total_records),
+                end_time=NOW(), error_message=:msg
+            WHERE batch_id=:bid
+        """), {"bid": batch_id, "total": total_records, "msg": msg})
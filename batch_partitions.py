@@ -0,0 +1,157 @@
+# batch_partitions.py - Phân vùng bảng raw/transform theo batch_id (LIST partition)
+#
+# Bảng đã phân vùng: mỗi batch nằm trong 1 partition riêng "p<batch_id>".
+# ADD/DROP PARTITION cần khóa metadata độc quyền trên cả bảng: nó phải chờ mọi câu lệnh
+# đang đọc bảng (vd. SELECT streaming của transform) và chặn các batch khác trong lúc chờ.
+# Vì vậy luồng nạp không chạy DDL:
+#   - partition được dựng sẵn cho PARTITION_AHEAD batch_id kế tiếp (cửa sổ cuộn),
+#   - nạp/dọn 1 batch chỉ là DELETE theo batch_id (chỉ chạm 1 partition, khóa theo dòng),
+#   - partition rỗng của batch đã xong được DROP ở bước bảo trì.
+# Bảng chưa phân vùng: các hàm dưới đây dùng DELETE theo batch_id như cũ.
+#
+# Chuyển bảng sang dạng phân vùng (chạy 1 lần):
+#   python batch_partitions.py raw_weather_forecast transform_weather_forecast
+# Bảo trì cửa sổ partition + dọn bảng batch_id_seq (chạy theo lịch, ngoài giờ pipeline nạp dữ liệu):
+#   python batch_partitions.py --maintain [bảng ...]
+import os
+import sys
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from batch_log import trim_batch_sequence
+
+load_dotenv()
+
+# Số partition dựng sẵn phía trước batch_id lớn nhất đã cấp
+PARTITION_AHEAD = int(os.getenv("BATCH_PARTITION_AHEAD", "200"))
+
+_partitioned_cache = {}
+
+
+def partition_name(batch_id):
+    return f"p{int(batch_id)}"
+
+
+def is_partitioned(conn, table):
+    """Bảng có đang phân vùng LIST theo batch_id không (kết quả được nhớ trong process)."""
+    if table not in _partitioned_cache:
+        method = conn.execute(text("""
+            SELECT MAX(partition_method) FROM information_schema.partitions
+            WHERE table_schema = DATABASE() AND table_name = :t
+        """), {"t": table}).scalar()
+        _partitioned_cache[table] = method == "LIST"
+    return _partitioned_cache[table]
+
+
+def _partition_exists(conn, table, batch_id):
+    return conn.execute(text("""
+        SELECT COUNT(*) FROM information_schema.partitions
+        WHERE table_schema = DATABASE() AND table_name = :t AND partition_name = :p
+    """), {"t": table, "p": partition_name(batch_id)}).scalar() > 0
+
+
+def release_batch(engine, table, batch_id):
+    """
+    Xóa toàn bộ dữ liệu của 1 batch bằng DELETE theo batch_id (bảng phân vùng: chỉ quét partition
+    của batch). Partition rỗng còn lại được DROP ở bước bảo trì, không phải trong luồng nạp.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(f"DELETE FROM {table} WHERE batch_id = :bid"), {"bid": batch_id})
+
+
+def prepare_batch(engine, table, batch_id):
+    """
+    Chuẩn bị chỗ ghi cho 1 batch: xóa dữ liệu cũ của batch (nếu chạy lại).
+    Partition của batch đã được dựng sẵn bởi maintain_partitions; nếu cửa sổ đã cạn
+    mới phải ADD PARTITION ngay trong luồng nạp (kèm cảnh báo).
+    """
+    release_batch(engine, table, batch_id)
+    with engine.begin() as conn:
+        if is_partitioned(conn, table) and not _partition_exists(conn, table, batch_id):
+            print(f"⚠️ Bảng '{table}' chưa có partition dựng sẵn cho batch {batch_id}: "
+                  f"ADD PARTITION trong luồng nạp. Hãy chạy 'python batch_partitions.py --maintain'.")
+            conn.execute(text(
+                f"ALTER TABLE {table} ADD PARTITION "
+                f"(PARTITION {partition_name(batch_id)} VALUES IN ({int(batch_id)}))"
+            ))
+
+
+def maintain_partitions(engine, table, ahead=PARTITION_AHEAD):
+    """
+    Bảo trì cửa sổ partition của 1 bảng (chạy ngoài giờ nạp, vì cần khóa metadata độc quyền):
+    - dựng sẵn partition cho các batch_id từ batch lớn nhất đã có tới batch_id kế tiếp + ahead,
+    - DROP partition rỗng của các batch cũ hơn `ahead` batch gần nhất và không còn RUNNING
+      (batch mới nạp raw có thể chưa được transform ghi vào; p0 luôn được giữ).
+    Trả về (số partition thêm, số partition xóa).
+    """
+    with engine.begin() as conn:
+        if not is_partitioned(conn, table):
+            print(f"ℹ️ Bảng '{table}' chưa phân vùng theo batch_id, bỏ qua.")
+            return 0, 0
+        existing = sorted(int(name[1:]) for (name,) in conn.execute(text("""
+            SELECT partition_name FROM information_schema.partitions
+            WHERE table_schema = DATABASE() AND table_name = :t
+        """), {"t": table}))
+        next_id = conn.execute(text("SELECT COALESCE(MAX(id), 0) + 1 FROM batch_id_seq")).scalar()
+        running = {row[0] for row in conn.execute(text(
+            "SELECT batch_id FROM batch_log WHERE status = 'RUNNING'"))}
+
+        droppable = [
+            bid for bid in existing
+            if 0 < bid < next_id - ahead and bid not in running and not conn.execute(text(
+                f"SELECT EXISTS (SELECT 1 FROM {table} PARTITION ({partition_name(bid)}))")).scalar()
+        ]
+        if droppable:
+            conn.execute(text(
+                f"ALTER TABLE {table} DROP PARTITION {', '.join(partition_name(bid) for bid in droppable)}"))
+
+        missing = range(max(existing[-1] + 1, next_id), next_id + ahead)
+        if missing:
+            partitions = [f"PARTITION {partition_name(bid)} VALUES IN ({bid})" for bid in missing]
+            conn.execute(text(f"ALTER TABLE {table} ADD PARTITION ({', '.join(partitions)})"))
+    print(f"✅ '{table}': dựng sẵn {len(missing)} partition (tới p{next_id + ahead - 1}), "
+          f"xóa {len(droppable)} partition rỗng.")
+    return len(missing), len(droppable)
+
+
+def enable_partitioning(engine, table):
+    """
+    Chuyển bảng sang PARTITION BY LIST (batch_id), mỗi batch hiện có 1 partition.
+    Yêu cầu: batch_id thuộc mọi khóa chính/unique và bảng không có khóa ngoại.
+    """
+    with engine.begin() as conn:
+        if is_partitioned(conn, table):
+            print(f"ℹ️ Bảng '{table}' đã được phân vùng theo batch_id.")
+            return
+        batch_ids = [row[0] for row in conn.execute(text(f"SELECT DISTINCT batch_id FROM {table}"))]
+        # p0 luôn được giữ lại: MySQL không cho DROP partition cuối cùng của bảng
+        batch_ids = sorted({0} | {int(bid) for bid in batch_ids if bid is not None})
+        partitions = [f"PARTITION {partition_name(bid)} VALUES IN ({bid})" for bid in batch_ids]
+        conn.execute(text(f"ALTER TABLE {table} PARTITION BY LIST (batch_id) ({', '.join(partitions)})"))
+    _partitioned_cache[table] = True
+    print(f"✅ Đã phân vùng bảng '{table}' theo batch_id ({len(partitions)} partition).")
+    maintain_partitions(engine, table)
+
+
+if __name__ == "__main__":
+    maintain = "--maintain" in sys.argv
+    tables = [arg for arg in sys.argv[1:] if arg != "--maintain"] or ["raw_weather_forecast", "transform_weather_forecast"]
+    engine = create_engine(
+        f"mysql+pymysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@"
+        f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
+    )
+    try:
+        for table in tables:
+            if maintain:
+                maintain_partitions(engine, table)
+            else:
+                enable_partitioning(engine, table)
+        if maintain:
+            print(f"🧹 Đã dọn {trim_batch_sequence(engine)} id cũ khỏi batch_id_seq.")
+    except Exception as e:
+        if maintain:
+            print(f"❌ Lỗi khi bảo trì partition: {e}")
+        else:
+            print(f"❌ Không thể phân vùng bảng (batch_id phải nằm trong khóa chính, không có khóa ngoại): {e}")
+        sys.exit(1)
+    finally:
+        engine.dispose()
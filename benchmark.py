@@ -0,0 +1,258 @@
+# benchmark.py - Đo hiệu năng các bước ETL (chạy local, không cần API thật)
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_LATENCY = 0.05  # Giả lập độ trễ API (giây)
+
+STUB_PAYLOAD = json.dumps({
+    "DailyForecasts": [
+        {
+            "Date": f"2025-11-{12 + i}T07:00:00+07:00",
+            "Temperature": {"Minimum": {"Value": 24.0}, "Maximum": {"Value": 31.0}},
+            "Day": {"Icon": 12, "IconPhrase": "Showers", "HasPrecipitation": True,
+                    "PrecipitationType": "Rain", "PrecipitationIntensity": "Light"},
+            "Night": {"Icon": 38, "IconPhrase": "Mostly cloudy", "HasPrecipitation": False},
+            "Sources": ["AccuWeather"],
+            "MobileLink": "http://www.accuweather.com/",
+            "Link": "http://www.accuweather.com/"
+        } for i in range(5)
+    ]
+}).encode("utf-8")
+
+# ==============================================================================
+# STUB SERVER
+# ==============================================================================
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Cho phép keep-alive
+
+    def do_GET(self):
+        time.sleep(STUB_LATENCY)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(STUB_PAYLOAD)))
+        self.end_headers()
+        self.wfile.write(STUB_PAYLOAD)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# ==============================================================================
+# BENCHMARK: EXTRACT (gọi API tuần tự vs song song)
+# ==============================================================================
+def bench_extract():
+    from extract_to_file import fetch_all_endpoints
+
+    server = start_stub_server()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/forecasts/v1/daily/5day"
+    print(f"Stub server: {base_url} (latency {STUB_LATENCY * 1000:.0f} ms)")
+    print(f"{'endpoints':>10} {'concurrency':>12} {'seconds':>10} {'req/s':>10}")
+
+    try:
+        for n in [3, 10, 50, 100, 500]:
+            urls = [f"{base_url}/{100000 + i}" for i in range(n)]
+            for concurrency in [1, 8, 32]:
+                start = time.perf_counter()
+                results = fetch_all_endpoints(urls, "stub-key", concurrency=concurrency)
+                elapsed = time.perf_counter() - start
+                assert all(results), "Stub server trả về lỗi"
+                print(f"{n:>10} {concurrency:>12} {elapsed:>10.2f} {n / elapsed:>10.1f}")
+    finally:
+        server.shutdown()
+
+# ==============================================================================
+# BENCHMARK: ĐỊNH DẠNG FILE EXTRACT (CSV vs Parquet, 1 triệu dòng)
+# ==============================================================================
+def make_extract_rows(n, seed=42):
+    """
+    Sinh n dòng extract giả lập (cùng cấu trúc với flatten_forecasts), giá trị ngẫu nhiên
+    có seed: dữ liệu lặp lại vài dòng mẫu nén gần như tuyệt đối, không đo được gì.
+    """
+    import random
+    from datetime import datetime, timedelta
+
+    rng = random.Random(seed)
+    phrases = ["Sunny", "Mostly sunny", "Partly sunny", "Intermittent clouds", "Hazy sunshine",
+               "Mostly cloudy", "Cloudy", "Showers", "Thunderstorms", "Partly sunny w/ t-storms"]
+    precip_types = ["Rain", "Snow", "Ice", "Mixed"]
+    intensities = ["Light", "Moderate", "Heavy"]
+    start = datetime(2020, 1, 1, 7)
+    for i in range(n):
+        location_key = str(rng.randint(100000, 999999))
+        min_temp = round(rng.uniform(-10, 30), 1)
+        day_precip, night_precip = rng.random() < 0.4, rng.random() < 0.3
+        yield {
+            'date': (start + timedelta(days=rng.randint(0, 2000))).strftime('%Y-%m-%dT%H:%M:%S+07:00'),
+            'location_name': f"location {location_key}",
+            'location_key': location_key,
+            'min_temp': min_temp,
+            'max_temp': round(min_temp + rng.uniform(0, 15), 1),
+            'day_icon': rng.randint(1, 44),
+            'day_phrase': rng.choice(phrases),
+            'day_precip': int(day_precip),
+            'day_precip_type': rng.choice(precip_types) if day_precip else '',
+            'day_precip_intensity': rng.choice(intensities) if day_precip else '',
+            'night_icon': rng.randint(1, 44),
+            'night_phrase': rng.choice(phrases),
+            'night_precip': int(night_precip),
+            'night_precip_type': rng.choice(precip_types) if night_precip else '',
+            'night_precip_intensity': rng.choice(intensities) if night_precip else '',
+            'source': "AccuWeather",
+            'mobile_link': f"http://www.accuweather.com/en/vn/{location_key}/daily-weather-forecast?day={i % 5 + 1}",
+            'link': f"http://www.accuweather.com/en/vn/{location_key}/daily-weather-forecast?day={i % 5 + 1}&lang=en",
+        }
+
+def bench_extract_format(n_rows=1_000_000):
+    import tempfile
+    # Cùng cách đọc với load_to_raw.read_extract_file (không import load_to_raw vì module đó kết nối DB)
+    from extract_to_file import StreamingCsvWriter, StreamingParquetWriter, CSV_HEADER, read_extract_text
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"{'format':>8} {'write (s)':>10} {'read (s)':>10} {'size (MB)':>10}")
+        for writer_cls in [StreamingCsvWriter, StreamingParquetWriter]:
+            path = os.path.join(tmp_dir, "bench" + writer_cls.extension)
+
+            start = time.perf_counter()
+            writer = writer_cls(tmp_dir, CSV_HEADER)
+            writer.write_rows(make_extract_rows(n_rows))
+            writer.commit(path)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            df = read_extract_text(path)
+            read_time = time.perf_counter() - start
+            assert len(df) == n_rows
+
+            size_mb = os.path.getsize(path) / 1024 / 1024
+            print(f"{writer_cls.extension[1:]:>8} {write_time:>10.2f} {read_time:>10.2f} {size_mb:>10.1f}")
+
+# ==============================================================================
+# BENCHMARK: CHUYỂN KIỂU TRONG TRANSFORM (apply từng dòng vs convert_frame vector hóa)
+# ==============================================================================
+def make_raw_frame(n):
+    """Sinh DataFrame giống bảng raw (mọi cột là chuỗi), có lẫn giá trị lỗi/NULL."""
+    import numpy as np
+    import pandas as pd
+
+    idx = np.arange(n)
+    dates = pd.Series(pd.date_range("2020-01-01", periods=1000, freq="D").strftime("%Y-%m-%dT07:00:00+07:00"))
+    df = pd.DataFrame({
+        "date_time": dates.iloc[idx % 1000].to_numpy(),
+        "location_name": "ho chi minh",
+        "location_key": "353981",
+        "min_temp_c": (20 + idx % 70 / 10).astype(str),
+        "max_temp_c": (28 + idx % 50 / 10).astype(str),
+        "day_icon": (idx % 44).astype(str),
+        "day_phrase": "Partly sunny w/ t-storms",
+        "day_precip": np.where(idx % 3 == 0, "True", "0"),
+        "day_precip_type": "Rain",
+        "day_precip_intensity": "Moderate",
+        "night_icon": (idx % 44).astype(str),
+        "night_phrase": None,
+        "night_precip": None,
+        "night_precip_type": None,
+        "night_precip_intensity": None,
+        "source": "AccuWeather",
+        "mobile_link": "http://www.accuweather.com/",
+        "link": "http://www.accuweather.com/",
+    })
+    df.loc[idx % 97 == 0, "date_time"] = "not a date"
+    df.loc[idx % 89 == 0, "max_temp_c"] = None
+    # Giá trị cách cũ parse được nhưng quy tắc mới loại (xem transform_rules.COLUMN_SPECS)
+    df.loc[idx % 101 == 0, "date_time"] = "12/11/2025"
+    df.loc[idx % 103 == 0, "min_temp_c"] = "inf"
+    df.loc[idx % 107 == 0, "max_temp_c"] = "-Infinity"
+    return df
+
+def strict_rows(df):
+    """Dòng có date_time/nhiệt độ đúng định dạng của transform_rules (ISO 8601, số hữu hạn)."""
+    from transform_rules import DATETIME_PATTERN, NUMBER_PATTERN
+
+    mask = df["date_time"].astype(str).str.fullmatch(DATETIME_PATTERN)
+    for col in ["min_temp_c", "max_temp_c"]:
+        mask &= df[col].astype(str).str.strip(" ").str.fullmatch(NUMBER_PATTERN)
+    return mask
+
+def legacy_convert(df):
+    """Cách chuyển kiểu cũ của transform.main (apply từng dòng cho date_time)."""
+    import pandas as pd
+
+    def safe_datetime(x):
+        try:
+            s = str(x).split('+')[0].split('Z')[0].split('.')[0]
+            return pd.to_datetime(s)
+        except:
+            return pd.NaT
+
+    df['date_time'] = df['date_time'].apply(safe_datetime)
+    df['min_temp_c'] = pd.to_numeric(df['min_temp_c'], errors='coerce')
+    df['max_temp_c'] = pd.to_numeric(df['max_temp_c'], errors='coerce')
+    df['day_icon'] = pd.to_numeric(df['day_icon'], errors='coerce').fillna(0).astype(int)
+    df['night_icon'] = pd.to_numeric(df['night_icon'], errors='coerce').fillna(0).astype(int)
+    df['day_phrase'] = df['day_phrase'].fillna('Unknown').str.slice(0, 100)
+    df['night_phrase'] = df['night_phrase'].fillna('Unknown').str.slice(0, 100)
+    df['day_precip'] = df['day_precip'].notnull() & (df['day_precip'].astype(str).str.strip() != '0')
+    df['night_precip'] = df['night_precip'].notnull() & (df['night_precip'].astype(str).str.strip() != '0')
+    df['day_precip_type'] = df['day_precip_type'].fillna('None').str.slice(0, 20)
+    df['day_precip_intensity'] = df['day_precip_intensity'].fillna('None').str.slice(0, 20)
+    df['night_precip_type'] = df['night_precip_type'].fillna('None').str.slice(0, 20)
+    df['night_precip_intensity'] = df['night_precip_intensity'].fillna('None').str.slice(0, 20)
+    df['location_name'] = df['location_name'].fillna('Ho Chi Minh City')
+    df['location_key'] = df['location_key'].fillna('353981')
+    df['source'] = df['source'].fillna('AccuWeather')
+    return df.dropna(subset=['date_time', 'min_temp_c', 'max_temp_c'])
+
+def bench_transform(sizes=(10**5, 10**6, 10**7), legacy_max_rows=10**6):
+    import pandas as pd
+    from transform_rules import convert_frame
+
+    # Kiểm tra 2 cách cho cùng kết quả trước khi đo; khác biệt có chủ đích duy nhất là
+    # các dòng ngày không ISO / inf mà cách cũ giữ lại, quy tắc mới loại bỏ
+    sample = make_raw_frame(10_000)
+    expected = legacy_convert(sample.copy())
+    strict = strict_rows(sample).loc[expected.index]
+    assert not strict.all(), "mẫu phải có dòng ngày không ISO / inf"
+    expected = expected[strict]
+    actual, _ = convert_frame(sample)
+    pd.testing.assert_frame_equal(expected, actual, check_dtype=False)
+
+    print(f"{'rows':>10} {'apply (s)':>10} {'vector (s)':>11} {'speedup':>8}")
+    for n in sizes:
+        df = make_raw_frame(n)
+
+        start = time.perf_counter()
+        convert_frame(df)
+        vector_time = time.perf_counter() - start
+
+        if n <= legacy_max_rows:
+            start = time.perf_counter()
+            legacy_convert(df.copy())
+            legacy_time = time.perf_counter() - start
+            print(f"{n:>10} {legacy_time:>10.2f} {vector_time:>11.2f} {legacy_time / vector_time:>7.1f}x")
+        else:
+            # apply từng dòng ở kích thước này mất quá lâu, chỉ đo bản vector hóa
+            print(f"{n:>10} {'-':>10} {vector_time:>11.2f} {'-':>8}")
+
+BENCHMARKS = {
+    "extract": bench_extract,
+    "extract_format": bench_extract_format,
+    "transform": bench_transform,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Không có benchmark '{name}'. Chọn trong: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+        print(f"\n=== BENCHMARK: {name} ===")
+        BENCHMARKS[name]()
@@ -0,0 +1,72 @@
+# dump_manifest.py - Manifest + nén/giải nén file dump (dùng chung cho export_file_dump và load_to_warehouse)
+#
+# Manifest (dump_manifest.json trong thư mục dump) liệt kê các file dump theo thứ tự tạo:
+#   {"file", "mode" (full|incremental), "watermark_from", "watermark_to",
+#    "row_count", "staging_version" (phiên bản migrations của staging lúc export),
+#    "checksum" (sha256 của file đã nén), "created_at"}
+# Chuỗi cần nạp = các file theo đúng thứ tự trong manifest.
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_NAME = "dump_manifest.json"
+
+# Đuôi file theo kiểu nén (zstd cần cài thư viện zstandard)
+COMPRESSION_EXT = {"none": ".sql", "gzip": ".sql.gz", "zstd": ".sql.zst"}
+
+
+def manifest_path(dump_dir):
+    return os.path.join(dump_dir, MANIFEST_NAME)
+
+def load_manifest(dump_dir):
+    """Danh sách entry trong manifest (rỗng nếu chưa có)."""
+    try:
+        with open(manifest_path(dump_dir), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+def save_manifest(dump_dir, entries):
+    # Ghi ra file tạm rồi đổi tên để không bao giờ để lại manifest hỏng
+    path = manifest_path(dump_dir)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def last_watermark(entries):
+    return entries[-1]["watermark_to"] if entries else None
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def compression_of(path):
+    for compression, ext in COMPRESSION_EXT.items():
+        if compression != "none" and path.endswith(ext):
+            return compression
+    return "none"
+
+def open_compressed_writer(path, compression):
+    """File nhị phân để ghi, tự nén theo compression (none | gzip | zstd)."""
+    if compression == "gzip":
+        return gzip.open(path, 'wb', compresslevel=6)
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).stream_writer(open(path, 'wb'), closefd=True)
+    return open(path, 'wb')
+
+def open_decompressed_reader(path):
+    """File nhị phân để đọc, tự giải nén theo đuôi file."""
+    compression = compression_of(path)
+    if compression == "gzip":
+        return gzip.open(path, 'rb')
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
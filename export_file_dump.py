@@ -1,13 +1,56 @@
 import os
 import sys
 import subprocess
+import pymysql
 from datetime import datetime
 from dotenv import load_dotenv
+from dump_manifest import (COMPRESSION_EXT, load_manifest, save_manifest, last_watermark,
+                           file_checksum, open_compressed_writer)
+
+# Cột mốc thay đổi của 1 dòng staging (dòng mới: created_at, dòng được cập nhật: date_update)
+WATERMARK_EXPR = "COALESCE(date_update, created_at)"
+
+def read_watermark_range(db_host, db_port, db_user, db_pass, db_name, table_name, watermark_from):
+    """
+    Trả về (watermark mới, điều kiện --where, số dòng sẽ export, số dòng mới thực sự,
+    phiên bản cấu trúc staging lúc export).
+    - Watermark mới chỉ tính trên các giây đã trôi qua (< NOW()): dòng ghi trong giây hiện tại
+      sau khi đọc MAX không bị "kẹt" sau mốc.
+    - Cận dưới lấy cả dòng đúng bằng mốc cũ (>=) để không sót dòng commit muộn trong cùng giây;
+      restore/upsert Fact là idempotent nên các dòng đọc lại không sinh trùng.
+    """
+    conn = pymysql.connect(host=db_host, port=int(db_port), user=db_user, password=db_pass, database=db_name)
+    try:
+        with conn.cursor() as cursor:
+            # Ghi vào manifest: load_to_warehouse biết dump có cột nào mà không dò information_schema
+            cursor.execute("SELECT MAX(version) FROM schema_version WHERE component = 'staging'")
+            staging_version = cursor.fetchone()[0] or 0
+            cursor.execute(f"SELECT MAX({WATERMARK_EXPR}) FROM {table_name} WHERE {WATERMARK_EXPR} < NOW()")
+            watermark_to = cursor.fetchone()[0]
+            watermark_to = str(watermark_to) if watermark_to is not None else watermark_from
+            if watermark_from is None:
+                cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
+                row_count = cursor.fetchone()[0]
+                return watermark_to, None, row_count, row_count, staging_version
+            where = f"{WATERMARK_EXPR} >= '{watermark_from}' AND {WATERMARK_EXPR} <= '{watermark_to}'"
+            cursor.execute(f"""
+                SELECT COUNT(*), COALESCE(SUM({WATERMARK_EXPR} > '{watermark_from}'), 0)
+                FROM {table_name} WHERE {where}
+            """)
+            row_count, new_rows = cursor.fetchone()
+            return watermark_to, where, row_count, int(new_rows), staging_version
+    finally:
+        conn.close()
 
 def export_table_to_sql():
     # 1. Tải biến môi trường
     load_dotenv()
 
+    # full: dump toàn bộ bảng | incremental: chỉ các dòng mới/đổi sau watermark của lần export trước
+    dump_mode = os.getenv("DUMP_MODE", "full").lower()
+    # none | gzip | zstd (zstd cần cài thư viện zstandard)
+    compression = os.getenv("DUMP_COMPRESSION", "gzip").lower()
+
     mysql_dump_path = os.getenv("MYSQL_DUMP_PATH")
     
     db_host = os.getenv("DB_HOST")
@@ -31,14 +74,31 @@ def export_table_to_sql():
         print(f"❌ Lỗi tạo thư mục: {e}")
         return
 
-    # 3. Tạo tên file output (kèm thời gian)
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    # 3. Xác định phạm vi export theo watermark (lần đầu luôn là full)
     table_name = "staging_weather_forecast"
-    filename = f"{table_name}_{timestamp}.sql"
+    entries = load_manifest(output_dir)
+    watermark_from = last_watermark(entries) if dump_mode == "incremental" else None
+    try:
+        watermark_to, where, row_count, new_rows, staging_version = read_watermark_range(
+            db_host, db_port, db_user, db_pass, db_name, table_name, watermark_from)
+    except pymysql.MySQLError as e:
+        print(f"❌ Lỗi khi đọc watermark: {e}")
+        return
+    mode = "incremental" if where else "full"
+    # Chỉ còn các dòng đúng bằng mốc cũ (đã export lần trước) -> không cần file mới
+    if mode == "incremental" and new_rows == 0:
+        print(f"ℹ️ Không có dòng mới/cập nhật sau watermark {watermark_from}. Bỏ qua export.")
+        return
+
+    # Tạo tên file output (kèm thời gian)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"{table_name}_{timestamp}_{mode}{COMPRESSION_EXT[compression]}"
     output_path = os.path.join(output_dir, filename)
+    tmp_path = output_path + ".tmp"
 
-    print(f"🚀 Bắt đầu export bảng '{table_name}'...")
+    print(f"🚀 Bắt đầu export bảng '{table_name}' ({mode}, {row_count} dòng, nén: {compression})...")
     print(f"   Database: {db_name}")
+    print(f"   Watermark: {watermark_from} -> {watermark_to}")
     print(f"   Output: {output_path}")
 
     # 4. Cấu hình lệnh mysqldump
@@ -55,6 +115,8 @@ def export_table_to_sql():
         db_name,
         table_name                # Chỉ export bảng này
     ]
+    if where:
+        dump_cmd.insert(-2, f'--where={where}')  # Chỉ các dòng sau watermark
 
     # 5. Thực thi
     # Sử dụng biến môi trường cho password để an toàn hơn (tránh cảnh báo password in command line)
@@ -62,14 +124,31 @@ def export_table_to_sql():
     env_vars['MYSQL_PWD'] = db_pass
 
     try:
-        with open(output_path, 'w', encoding='utf-8') as outfile:
-            subprocess.run(
-                dump_cmd, 
-                env=env_vars, 
-                stdout=outfile, 
-                check=True,  # Sẽ ném lỗi nếu mysqldump thất bại
-                text=True
-            )
+        # Stream stdout của mysqldump qua bộ nén, ghi file tạm rồi đổi tên khi thành công
+        proc = subprocess.Popen(dump_cmd, env=env_vars, stdout=subprocess.PIPE)
+        try:
+            with open_compressed_writer(tmp_path, compression) as outfile:
+                for chunk in iter(lambda: proc.stdout.read(1024 * 1024), b''):
+                    outfile.write(chunk)
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, dump_cmd)
+        os.replace(tmp_path, output_path)
+
+        # Ghi manifest: file chỉ được restore khi checksum khớp
+        entries.append({
+            "file": filename,
+            "mode": mode,
+            "watermark_from": watermark_from,
+            "watermark_to": watermark_to,
+            "row_count": row_count,
+            "staging_version": staging_version,
+            "checksum": file_checksum(output_path),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+        })
+        save_manifest(output_dir, entries)
         print(f"✅ Export thành công! File lưu tại:\n   👉 {output_path}")
         
     except subprocess.CalledProcessError as e:
@@ -80,6 +159,9 @@ def export_table_to_sql():
         print("💡 Hãy cài đặt MySQL Server/Client hoặc thêm đường dẫn thư mục bin của MySQL vào System PATH.")
     except Exception as e:
         print(f"❌ Lỗi không xác định: {e}")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 if __name__ == "__main__":
     export_table_to_sql()
\ No newline at end of file
@@ -1,45 +1,103 @@
 import csv
+import io
 import os
+import sys
+import tempfile
 import requests
+import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 from urllib.parse import urlparse
 from dotenv import load_dotenv
-from location_mapping import get_location_name
+from location_mapping import get_location_name, build_endpoints
+from response_cache import ResponseCache
 
 # 1. Load biến môi trường
 load_dotenv()
 
-# Tạo danh sách các Endpoint cần chạy (Lọc bỏ các giá trị None nếu file env thiếu)
-ENDPOINTS = [
-    url for url in [
-        os.getenv('API_ENDPOINT_HCM'),
-        os.getenv('API_ENDPOINT_HN'),
-        os.getenv('API_ENDPOINT_DN')
-    ] if url # Chỉ lấy giá trị không rỗng
-]
+# Tạo danh sách các Endpoint cần chạy từ danh mục địa điểm (locations.csv)
+ENDPOINTS = build_endpoints()
 
 OUTPUT_DIR = os.getenv('OUTPUT_DIR')
 API_KEY = os.getenv('API_KEY')
 
+# Số request gọi API song song tối đa (1 = chạy tuần tự như cũ)
+FETCH_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', '8'))
+
+# Cache response API trên đĩa (RESPONSE_CACHE_TTL=0 để tắt)
+RESPONSE_CACHE_DIR = os.getenv('RESPONSE_CACHE_DIR')
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1000'))
+
+# Số dòng gom trong bộ nhớ trước khi ghi xuống file CSV
+EXTRACT_FLUSH_ROWS = int(os.getenv('EXTRACT_FLUSH_ROWS', '500'))
+# Số dòng mỗi row group của file Parquet (row group nhỏ làm file to và đọc chậm)
+EXTRACT_PARQUET_ROW_GROUP_ROWS = int(os.getenv('EXTRACT_PARQUET_ROW_GROUP_ROWS', '100000'))
+
+# Định dạng file extract: csv | parquet | both (parquet cần cài pyarrow)
+EXTRACT_FORMAT = os.getenv('EXTRACT_FORMAT', 'csv').lower()
+EXTRACT_PARQUET_COMPRESSION = os.getenv('EXTRACT_PARQUET_COMPRESSION', 'zstd')
+
+CSV_HEADER = [
+    'date', 'location_name', 'location_key', 'min_temp', 'max_temp',
+    'day_icon', 'day_phrase', 'day_precip', 'day_precip_type', 'day_precip_intensity',
+    'night_icon', 'night_phrase', 'night_precip', 'night_precip_type', 'night_precip_intensity',
+    'source', 'mobile_link', 'link'
+]
+
+# Giá trị trả về khi payload giống hệt lần gọi trước (không cần ghi lại)
+NOT_MODIFIED = object()
+
 def extract_location_key(url):
     """Lấy location_key từ cuối URL endpoint."""
     if not url: return None
     path = urlparse(url).path.rstrip('/')
     return path.split('/')[-1]
 
-def fetch_weather_data(url, api_key):
-    """Gọi API lấy dữ liệu JSON."""
+def create_http_session(pool_size):
+    """
+    Tạo 1 Session dùng chung cho mọi request (giữ kết nối keep-alive).
+    pool_size: số kết nối tối đa giữ trong pool cho mỗi host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_weather_data(url, api_key, session=None, cache=None):
+    """
+    Gọi API lấy dữ liệu JSON.
+    Nếu có cache: trả về NOT_MODIFIED khi payload không đổi so với lần trước.
+    """
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
     location_key = extract_location_key(url)
+
+    entry = cache.get(location_key) if cache else None
+    if cache and cache.is_fresh(entry):
+        cache.record_hit()
+        return NOT_MODIFIED
+    if cache:
+        headers.update(cache.conditional_headers(entry))
+
     print(f"--> Đang gọi API cho Key {location_key}...")
     
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        http = session or requests
+        response = http.get(url, headers=headers, timeout=10)
+        if response.status_code == 304 and entry:
+            cache.touch(location_key, entry)
+            return NOT_MODIFIED
         if response.status_code == 200:
-            return response.json()
+            data = response.json()
+            if cache and not cache.store(location_key, data, response.headers):
+                return NOT_MODIFIED
+            return data
         else:
             print(f"    Lỗi API ({location_key}): {response.status_code} - {response.text}")
             return None
@@ -47,102 +105,420 @@ def fetch_weather_data(url, api_key):
         print(f"    Lỗi kết nối ({location_key}): {e}")
         return None
 
-def generate_file_path(base_dir, date_str):
+def generate_file_path(base_dir, date_str, run_suffix=None, extension=".csv"):
     """
     Tạo tên file dựa trên ngày dự báo đầu tiên.
-    Format: weather_yyyy_mmm_dd.csv
+    Format: weather_yyyy_mmm_dd.csv (hoặc weather_yyyy_mmm_dd_<run_suffix>.csv
+    khi chỉ gọi 1 phần danh mục, để các lượt chạy trong ngày không ghi đè nhau)
     """
     dt = datetime.fromisoformat(date_str)
-    file_name = f"weather_{dt.strftime('%Y')}_{dt.strftime('%b')}_{dt.strftime('%d')}.csv"
-    return os.path.join(base_dir, file_name)
+    file_name = f"weather_{dt.strftime('%Y')}_{dt.strftime('%b')}_{dt.strftime('%d')}"
+    if run_suffix:
+        file_name += f"_{run_suffix}"
+    return os.path.join(base_dir, file_name + extension)
+
+def iter_fetch_results(urls, api_key, concurrency=FETCH_CONCURRENCY, cache=None):
+    """
+    Gọi API cho toàn bộ endpoint bằng thread pool giới hạn (concurrency),
+    dùng chung 1 Session. Yield (url, data) theo đúng thứ tự của urls ngay khi có kết quả;
+    chỉ giữ tối đa 2 x concurrency request đang chờ để bộ nhớ không tăng theo số endpoint.
+    """
+    workers = max(1, min(concurrency, len(urls)))
+    with create_http_session(workers) as session:
+        if workers == 1:
+            for url in urls:
+                yield url, fetch_weather_data(url, api_key, session, cache)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for url in urls:
+                pending.append((url, executor.submit(fetch_weather_data, url, api_key, session, cache)))
+                if len(pending) >= workers * 2:
+                    done_url, future = pending.popleft()
+                    yield done_url, future.result()
+            while pending:
+                done_url, future = pending.popleft()
+                yield done_url, future.result()
+
+def fetch_all_endpoints(urls, api_key, concurrency=FETCH_CONCURRENCY, cache=None):
+    """Giống iter_fetch_results nhưng trả về list data (theo thứ tự của urls)."""
+    return [data for _, data in iter_fetch_results(urls, api_key, concurrency, cache)]
+
+def get_response_cache():
+    """Tạo ResponseCache theo cấu hình .env (None nếu bị tắt)."""
+    if RESPONSE_CACHE_TTL <= 0:
+        return None
+    cache_dir = RESPONSE_CACHE_DIR or os.path.join(OUTPUT_DIR, '.http_cache')
+    return ResponseCache(cache_dir, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES)
+
+# Chuẩn hóa kiểu giá trị trước khi ghi để CSV và Parquet cho ra cùng 1 chuỗi trong bảng raw
+# (cờ mưa ghi 1/0: transform coi mọi giá trị khác '0' là có mưa, kể cả 'False')
+def _as_float(value):
+    return None if value is None else float(value)
+
+def _as_int(value):
+    return None if value is None else int(value)
+
+def _as_flag(value):
+    return None if value is None else int(bool(value))
+
+def flatten_forecasts(data, location_key, location_name):
+    """Xử lý dữ liệu json thành các dictionary phẳng (flat), mỗi ngày dự báo 1 dòng."""
+    for item in data.get('DailyForecasts', []):
+        temp = item.get('Temperature', {})
+        day = item.get('Day', {})
+        night = item.get('Night', {})
+
+        yield {
+            'date': item.get('Date'),
+            'location_name': location_name,
+            'location_key': location_key,
+            'min_temp': _as_float(temp.get('Minimum', {}).get('Value')),
+            'max_temp': _as_float(temp.get('Maximum', {}).get('Value')),
+            
+            'day_icon': _as_int(day.get('Icon')),
+            'day_phrase': day.get('IconPhrase'),
+            'day_precip': _as_flag(day.get('HasPrecipitation')),
+            'day_precip_type': day.get('PrecipitationType', ''),
+            'day_precip_intensity': day.get('PrecipitationIntensity', ''),
+
+            'night_icon': _as_int(night.get('Icon')),
+            'night_phrase': night.get('IconPhrase'),
+            'night_precip': _as_flag(night.get('HasPrecipitation')),
+            'night_precip_type': night.get('PrecipitationType', ''),
+            'night_precip_intensity': night.get('PrecipitationIntensity', ''),
+
+            'source': ", ".join(item.get('Sources', [])),
+            'mobile_link': item.get('MobileLink'),
+            'link': item.get('Link')
+        }
+
+class StreamingCsvWriter:
+    """
+    Ghi CSV tăng dần: các dòng được gom vào buffer và ghi xuống file tạm
+    mỗi khi đủ flush_rows dòng. commit() đổi tên file tạm thành file đích (atomic),
+    nên file .csv chỉ xuất hiện khi đã ghi xong.
+    """
+    extension = '.csv'
+
+    def __init__(self, output_dir, fieldnames, flush_rows=EXTRACT_FLUSH_ROWS):
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.weather_', suffix=self.extension + '.tmp', dir=output_dir)
+        self.file = os.fdopen(fd, 'wb')
+        self.fieldnames = fieldnames
+        self.flush_rows = flush_rows
+        self.buffer = []
+        self.row_count = 0
+        self._open()
+
+    def _open(self):
+        self.text = io.TextIOWrapper(self.file, newline='', encoding='utf-8', write_through=True)
+        self.writer = csv.DictWriter(self.text, fieldnames=self.fieldnames)
+        self.writer.writeheader()
+
+    def _write_buffer(self):
+        self.writer.writerows(self.buffer)
+
+    def _close(self):
+        self.text.close()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.buffer.append(row)
+            self.row_count += 1
+            if len(self.buffer) >= self.flush_rows:
+                self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self._write_buffer()
+            self.buffer.clear()
+        self.file.flush()
+
+    def commit(self, output_path):
+        self.flush()
+        self._close()
+        os.chmod(self.tmp_path, 0o644)  # mkstemp tạo file 0600
+        os.replace(self.tmp_path, output_path)
+
+    def abort(self):
+        self._close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+class StreamingParquetWriter(StreamingCsvWriter):
+    """
+    Giống StreamingCsvWriter nhưng ghi Parquet có kiểu dữ liệu (parquet_schema) và nén.
+    Mỗi lần flush chuyển buffer thành 1 RecordBatch (dạng cột, gọn hơn list dict);
+    đủ row_group_rows dòng mới ghi ra 1 row group.
+    """
+    extension = '.parquet'
+
+    def __init__(self, output_dir, fieldnames, flush_rows=EXTRACT_FLUSH_ROWS,
+                 row_group_rows=EXTRACT_PARQUET_ROW_GROUP_ROWS):
+        self.row_group_rows = row_group_rows
+        self.batches = []
+        self.batch_rows = 0
+        super().__init__(output_dir, fieldnames, flush_rows)
 
-def process_all_endpoints():
-    if not ENDPOINTS or not API_KEY:
+    def _open(self):
+        import pyarrow.parquet as pq
+        self.schema = parquet_schema()
+        self.writer = pq.ParquetWriter(self.file, self.schema, compression=EXTRACT_PARQUET_COMPRESSION)
+
+    def _write_buffer(self):
+        import pyarrow as pa
+        self.batches.append(pa.RecordBatch.from_pylist(self.buffer, schema=self.schema))
+        self.batch_rows += len(self.buffer)
+        if self.batch_rows >= self.row_group_rows:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        import pyarrow as pa
+        if self.batches:
+            self.writer.write_table(pa.Table.from_batches(self.batches, schema=self.schema),
+                                    row_group_size=max(self.batch_rows, 1))
+            self.batches.clear()
+            self.batch_rows = 0
+
+    def _close(self):
+        if self.writer.is_open:
+            self._write_row_group()
+            self.writer.close()
+        self.file.close()
+
+    def abort(self):
+        self.batches.clear()  # Không ghi phần còn lại vào file sắp bị xóa
+        super().abort()
+
+def parquet_schema():
+    """Schema Arrow của file extract (cùng thứ tự cột với CSV_HEADER)."""
+    import pyarrow as pa
+    types = {
+        'min_temp': pa.float64(), 'max_temp': pa.float64(),
+        'day_icon': pa.int32(), 'night_icon': pa.int32(),
+        'day_precip': pa.int8(), 'night_precip': pa.int8(),
+    }
+    return pa.schema([(col, types.get(col, pa.string())) for col in CSV_HEADER])
+
+def _float_text(column):
+    """
+    Cột số thực -> chuỗi giống str() của Python (cách module csv ghi ra).
+    Cast của Arrow cho cùng chuỗi với 1e-4 <= |x| < 1e9 (trừ số nguyên thiếu '.0'), 0, inf, nan;
+    chỉ các giá trị ngoài khoảng đó (hiếm với nhiệt độ) mới phải đổi từng giá trị.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    column = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    text = column.cast(pa.string())
+    finite = pc.is_finite(column)
+    integral = pc.and_(finite, pc.equal(column, pc.floor(column))).fill_null(False)
+    text = pc.if_else(integral, pc.binary_join_element_wise(text, pa.scalar(".0"), ""), text)
+
+    magnitude = pc.abs(column)
+    outside = pc.and_(pc.and_(finite, pc.not_equal(column, 0)),
+                      pc.or_(pc.less(magnitude, 1e-4), pc.greater_equal(magnitude, 1e9))).fill_null(False)
+    if pc.any(outside).as_py():
+        values = text.to_pylist()
+        for i in pc.indices_nonzero(outside).to_pylist():
+            values[i] = str(column[i].as_py())
+        text = pa.array(values, pa.string())
+    return text
+
+def read_extract_text(path):
+    """
+    Đọc file extract thành DataFrame toàn chuỗi, giống nhau cho .csv và .parquet
+    (chuỗi rỗng -> NaN, như LOAD DATA với NULLIF(.., '')):
+    - .csv: đọc mọi cột là chuỗi (cách đọc cũ).
+    - .parquet: đọc bằng pyarrow rồi đổi từng cột có kiểu về đúng chuỗi mà CSV ghi ra
+      (số thực theo str() của Python, số nguyên không có '.0', cờ bool của file cũ -> 1/0).
+    Bảng raw lưu mọi cột dạng chuỗi, nên Parquet chỉ thay đổi định dạng trên đĩa
+    (file nhỏ hơn, đọc theo cột), không giữ kiểu tới bước transform.
+    """
+    if not path.endswith(".parquet"):
+        df = pd.read_csv(path, dtype=str, engine='python', sep=None)
+        df.columns = df.columns.str.strip()
+        return df
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    table = pq.read_table(path)
+    columns = []
+    for column in table.columns:
+        if pa.types.is_boolean(column.type):
+            column = pc.if_else(column, "1", "0")
+        elif pa.types.is_floating(column.type):
+            column = _float_text(column)
+        elif not pa.types.is_string(column.type):
+            column = column.cast(pa.string())
+        columns.append(column)
+    df = pa.table(columns, names=table.column_names).to_pandas()
+    return df.where(df != '')
+
+def check_extract_formats():
+    """
+    Ghi cùng 1 payload mẫu bằng cả 2 writer rồi đọc lại bằng read_extract_text:
+    bảng raw phải nhận đúng cùng chuỗi bất kể EXTRACT_FORMAT. Trả về danh sách khác biệt.
+    """
+    payload = {"DailyForecasts": [
+        {"Date": "2025-11-12T07:00:00-05:00", "Temperature": {"Minimum": {"Value": 21}, "Maximum": {"Value": 30.5}},
+         "Day": {"Icon": 12, "IconPhrase": "Showers", "HasPrecipitation": True,
+                 "PrecipitationType": "Rain", "PrecipitationIntensity": "Light"},
+         "Night": {"Icon": 7, "IconPhrase": "Cloudy", "HasPrecipitation": False},
+         "Sources": ["AccuWeather"], "MobileLink": "m", "Link": "l"},
+        {"Date": "2025-11-13T07:00:00+07:00", "Temperature": {"Minimum": {"Value": -0.1}, "Maximum": {}},
+         "Day": {"IconPhrase": "Sunny", "HasPrecipitation": False}, "Night": {"Icon": None},
+         "Sources": []},
+        # Số rất nhỏ/rất lớn: Arrow và Python viết khác nhau (0.00001 / 1e-05)
+        {"Date": "2025-11-14T07:00:00+07:00", "Temperature": {"Minimum": {"Value": 0.00001}, "Maximum": {"Value": 1e12}},
+         "Day": {}, "Night": {}, "Sources": ["AccuWeather"]},
+    ]}
+    rows = list(flatten_forecasts(payload, "353981", "Ho Chi Minh City"))
+    frames = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for writer_cls in [StreamingCsvWriter, StreamingParquetWriter]:
+            path = os.path.join(tmp_dir, "check" + writer_cls.extension)
+            writer = writer_cls(tmp_dir, CSV_HEADER)
+            writer.write_rows(rows)
+            writer.commit(path)
+            frames[writer_cls.extension] = read_extract_text(path)
+
+    csv_df, parquet_df = (frames[ext].astype(object).where(frames[ext].notnull(), None) for ext in ('.csv', '.parquet'))
+    errors = []
+    for col in CSV_HEADER:
+        for i, (a, b) in enumerate(zip(csv_df[col], parquet_df[col])):
+            if a != b:
+                errors.append(f"dòng {i}, cột {col}: csv={a!r}, parquet={b!r}")
+    return errors
+
+def open_extract_writers(output_dir):
+    """Tạo writer theo EXTRACT_FORMAT: csv | parquet | both."""
+    formats = {
+        'csv': [StreamingCsvWriter],
+        'parquet': [StreamingParquetWriter],
+        'both': [StreamingCsvWriter, StreamingParquetWriter],
+    }
+    if EXTRACT_FORMAT not in formats:
+        raise ValueError(f"EXTRACT_FORMAT không hợp lệ: {EXTRACT_FORMAT} (csv | parquet | both)")
+    return [writer_cls(output_dir, CSV_HEADER) for writer_cls in formats[EXTRACT_FORMAT]]
+
+def process_all_endpoints(urls=None):
+    """
+    Gọi API và ghi file extract (CSV và/hoặc Parquet, theo EXTRACT_FORMAT).
+    urls: danh sách endpoint cần gọi (mặc định: toàn bộ ENDPOINTS).
+    """
+    partial_run = urls is not None
+    urls = ENDPOINTS if urls is None else urls
+
+    if not urls or not API_KEY:
         print("Lỗi: Thiếu danh sách ENDPOINT hoặc API_KEY trong .env")
         return
 
-    all_rows = [] # List chứa tất cả dữ liệu của 3 địa điểm
+    # Tạo thư mục nếu chưa có
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
     representative_date = None # Dùng để đặt tên file
+    unchanged = 0
+    row_count = 0
+
+    # 2. Gọi API song song, ghi dữ liệu của từng Endpoint ngay khi nhận được
+    cache = get_response_cache()
+    writers = open_extract_writers(OUTPUT_DIR)
+
+    def abort_all():
+        for writer in writers:
+            writer.abort()
+        if cache:
+            cache.discard()
+
+    try:
+        for url, data in iter_fetch_results(urls, API_KEY, cache=cache):
+            if data is NOT_MODIFIED:
+                unchanged += 1
+                continue
+            if not data:
+                continue # Bỏ qua nếu lỗi, chạy tiếp địa điểm sau
+
+            location_key = extract_location_key(url)
+            location_name = get_location_name(location_key)
+            daily_forecasts = data.get('DailyForecasts', [])
 
-    # 2. Vòng lặp qua từng Endpoint
-    for url in ENDPOINTS:
-        location_key = extract_location_key(url)
-        location_name = get_location_name(location_key)
-        
-        data = fetch_weather_data(url, API_KEY)
-        
-        if not data:
-            continue # Bỏ qua nếu lỗi, chạy tiếp địa điểm sau
-
-        daily_forecasts = data.get('DailyForecasts', [])
-        
-        # Lấy ngày của địa điểm đầu tiên thành công để làm tên file
-        if representative_date is None and daily_forecasts:
-            representative_date = daily_forecasts[0].get('Date')
-
-        # Xử lý dữ liệu json thành dictionary phẳng (flat)
-        for item in daily_forecasts:
-            temp = item.get('Temperature', {})
-            day = item.get('Day', {})
-            night = item.get('Night', {})
-
-            row = {
-                'date': item.get('Date'),
-                'location_name': location_name,
-                'location_key': location_key,
-                'min_temp': temp.get('Minimum', {}).get('Value'),
-                'max_temp': temp.get('Maximum', {}).get('Value'),
-                
-                'day_icon': day.get('Icon'),
-                'day_phrase': day.get('IconPhrase'),
-                'day_precip': day.get('HasPrecipitation'),
-                'day_precip_type': day.get('PrecipitationType', ''),
-                'day_precip_intensity': day.get('PrecipitationIntensity', ''),
-
-                'night_icon': night.get('Icon'),
-                'night_phrase': night.get('IconPhrase'),
-                'night_precip': night.get('HasPrecipitation'),
-                'night_precip_type': night.get('PrecipitationType', ''),
-                'night_precip_intensity': night.get('PrecipitationIntensity', ''),
-
-                'source': ", ".join(item.get('Sources', [])),
-                'mobile_link': item.get('MobileLink'),
-                'link': item.get('Link')
-            }
-            all_rows.append(row)
-
-    # 3. Ghi dữ liệu ra CSV (chỉ ghi nếu có dữ liệu)
-    if not all_rows:
+            # Lấy ngày của địa điểm đầu tiên thành công để làm tên file
+            if representative_date is None and daily_forecasts:
+                representative_date = daily_forecasts[0].get('Date')
+
+            # Lỗi payload của 1 địa điểm không làm mất dữ liệu các địa điểm khác
+            try:
+                rows = list(flatten_forecasts(data, location_key, location_name))
+            except (AttributeError, TypeError) as e:
+                print(f"    Lỗi dữ liệu ({location_key}): {e}")
+                if cache:
+                    cache.drop(location_key)
+                continue
+
+            for writer in writers:
+                writer.write_rows(rows)
+            row_count += len(rows)
+    except BaseException:
+        abort_all()
+        raise
+
+    if cache:
+        print(f"--> Cache: {cache.summary()}")
+
+    # 3. Chốt file extract (chỉ giữ lại nếu có dữ liệu)
+    if unchanged == len(urls):
+        abort_all()
+        print("Dữ liệu không thay đổi so với lần gọi trước → bỏ qua ghi file.")
+        return None
+    if row_count == 0:
+        abort_all()
         print("Không thu thập được dữ liệu nào.")
         return False
-
-    # Tạo thư mục nếu chưa có
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
+    if unchanged:
+        partial_run = True  # Chỉ ghi các địa điểm có dữ liệu mới
 
     # Tạo đường dẫn file output
-    output_csv_path = generate_file_path(OUTPUT_DIR, representative_date)
+    run_suffix = datetime.now().strftime('%H%M%S') if partial_run else None
+    output_path = None
+    committed = []
 
-    csv_header = [
-        'date', 'location_name', 'location_key', 'min_temp', 'max_temp',
-        'day_icon', 'day_phrase', 'day_precip', 'day_precip_type', 'day_precip_intensity',
-        'night_icon', 'night_phrase', 'night_precip', 'night_precip_type', 'night_precip_intensity',
-        'source', 'mobile_link', 'link'
-    ]
+    def abort_commit():
+        # Lỗi bất kỳ khi chốt file: bỏ mọi writer và cả các file đã chốt (CSV/Parquet đi cùng nhau),
+        # cache không được lưu nên lần chạy sau gọi lại API cho các địa điểm này
+        abort_all()
+        for path in committed:
+            if os.path.exists(path):
+                os.remove(path)
 
     try:
-        with open(output_csv_path, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=csv_header)
-            writer.writeheader()
-            writer.writerows(all_rows) # Ghi tất cả các dòng cùng lúc
-        
-        print(f"\n--> HOÀN TẤT! Tổng cộng {len(all_rows)} dòng dữ liệu.")
-        print(f"--> File lưu tại: {output_csv_path}")
-        return True
-        
+        for writer in writers:
+            output_path = generate_file_path(OUTPUT_DIR, representative_date, run_suffix, writer.extension)
+            writer.commit(output_path)
+            committed.append(output_path)
+            print(f"--> File lưu tại: {output_path}")
     except PermissionError:
-        print(f"Lỗi: Không thể ghi file {output_csv_path}. Hãy đóng file nếu đang mở.")
+        abort_commit()
+        print(f"Lỗi: Không thể ghi file {output_path}. Hãy đóng file nếu đang mở.")
         return False
+    except BaseException:
+        abort_commit()
+        raise
+
+    # Chỉ lưu cache khi payload đã nằm trong file extract
+    if cache:
+        cache.commit()
+        cache.evict()
+    print(f"\n--> HOÀN TẤT! Tổng cộng {row_count} dòng dữ liệu.")
+    return True
 
 if __name__ == "__main__":
-    process_all_endpoints()
\ No newline at end of file
+    if "--check-formats" in sys.argv:
+        # Kiểm tra CSV và Parquet cho cùng dữ liệu raw (không gọi API, cần pyarrow)
+        differences = check_extract_formats()
+        for difference in differences:
+            print(f"❌ {difference}")
+        print("✅ CSV và Parquet cho cùng dữ liệu raw." if not differences else "❌ CSV và Parquet khác nhau.")
+        sys.exit(1 if differences else 0)
+    process_all_endpoints()
@@ -0,0 +1,191 @@
+# fact_maintenance.py - Bảo trì bảng Fact trong Warehouse
+#
+#   python fact_maintenance.py compact [--dry-run]   # Xóa dòng trùng (date_sk, location_key), giữ bản nạp mới nhất
+#   python fact_maintenance.py partition             # Chuyển Fact sang PARTITION BY RANGE (date_sk), mỗi tháng 1 partition
+#   python fact_maintenance.py archive [--keep-months N] [--drop]
+#                                                    # Chuyển partition cũ hơn N tháng sang bảng archive nén (hoặc xóa)
+import os
+import sys
+from datetime import date
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+load_dotenv()
+
+FACT_TABLE = os.getenv("FACT_TABLE_NAME", "fact_weather_forecast")
+
+# Khóa tự nhiên của 1 dòng Fact: 1 dự báo / ngày / địa điểm
+FACT_NATURAL_KEY = ["date_sk", "location_key"]
+
+# Số tháng gần nhất được giữ trong bảng Fact khi archive
+FACT_RETENTION_MONTHS = int(os.getenv("FACT_RETENTION_MONTHS", "24"))
+
+
+def get_warehouse_engine():
+    return create_engine(
+        f"mysql+pymysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@"
+        f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_WAREHOUSE_NAME')}"
+    )
+
+# ==============================================================================
+# COMPACT: GỘP CÁC DÒNG TRÙNG KHÓA TỰ NHIÊN
+# ==============================================================================
+def count_duplicates(conn, fact_table=FACT_TABLE):
+    """Trả về (tổng số dòng, số khóa tự nhiên khác nhau)."""
+    keys = ", ".join(FACT_NATURAL_KEY)
+    return tuple(conn.execute(text(
+        f"SELECT COUNT(*), COUNT(DISTINCT {keys}) FROM {fact_table}"
+    )).one())
+
+def compact_fact_table(conn, fact_table=FACT_TABLE):
+    """
+    Xóa các dòng trùng (date_sk, location_key), chỉ giữ dòng có id_fact lớn nhất
+    (lần nạp mới nhất). Trả về số dòng đã xóa.
+    """
+    join_on = " AND ".join(f"f.{col} = k.{col}" for col in FACT_NATURAL_KEY)
+    keys = ", ".join(FACT_NATURAL_KEY)
+    return conn.execute(text(f"""
+        DELETE f FROM {fact_table} f
+        JOIN (
+            SELECT {keys}, MAX(id_fact) AS keep_id
+            FROM {fact_table}
+            GROUP BY {keys}
+            HAVING COUNT(*) > 1
+        ) k ON {join_on} AND f.id_fact < k.keep_id
+    """)).rowcount
+
+def run_compact(engine, dry_run=False):
+    with engine.begin() as conn:
+        total, distinct = count_duplicates(conn)
+        print(f"📊 {FACT_TABLE}: {total} dòng, {distinct} dự báo khác nhau, {total - distinct} dòng trùng.")
+        if dry_run or total == distinct:
+            return
+        deleted = compact_fact_table(conn)
+    print(f"🧹 Đã xóa {deleted} dòng trùng khỏi '{FACT_TABLE}'.")
+
+
+# ==============================================================================
+# PARTITION: PHÂN VÙNG FACT THEO THÁNG (RANGE trên date_sk)
+# ==============================================================================
+def partition_name(year_month):
+    return f"p{year_month}"
+
+def archive_table_name(year_month):
+    return f"{FACT_TABLE}_archive_{year_month}"
+
+def list_partitions(conn, fact_table=FACT_TABLE):
+    """[(tên partition, số dòng ước tính)] theo thứ tự, rỗng nếu bảng chưa phân vùng."""
+    return [tuple(row) for row in conn.execute(text("""
+        SELECT partition_name, table_rows FROM information_schema.partitions
+        WHERE table_schema = DATABASE() AND table_name = :t AND partition_name IS NOT NULL
+        ORDER BY partition_ordinal_position
+    """), {"t": fact_table})]
+
+def month_boundaries(conn):
+    """[(YYYYMM, date_sk đầu tiên của tháng)] theo thứ tự, lấy từ dim_date."""
+    return [tuple(row) for row in conn.execute(text("""
+        SELECT DATE_FORMAT(full_date, '%Y%m') AS ym, MIN(date_sk)
+        FROM dim_date GROUP BY ym ORDER BY ym
+    """))]
+
+def enable_fact_partitioning(engine):
+    """
+    Chuyển bảng Fact sang PARTITION BY RANGE (date_sk), mỗi tháng trong dim_date 1 partition.
+    MySQL yêu cầu: khóa chính/unique phải chứa date_sk và bảng phân vùng không có khóa ngoại,
+    nên khóa chính đổi thành (id_fact, date_sk) và 2 khóa ngoại tới dim bị bỏ (index vẫn giữ).
+    """
+    with engine.begin() as conn:
+        if list_partitions(conn):
+            print(f"ℹ️ Bảng '{FACT_TABLE}' đã được phân vùng.")
+            return
+        months = month_boundaries(conn)
+        if not months:
+            raise RuntimeError("dim_date rỗng, chưa thể tính ranh giới partition.")
+
+        conn.execute(text(f"""
+            ALTER TABLE {FACT_TABLE}
+                DROP FOREIGN KEY fk_fact_date,
+                DROP FOREIGN KEY fk_fact_location,
+                DROP PRIMARY KEY,
+                ADD PRIMARY KEY (id_fact, date_sk)
+        """))
+
+        # Partition của tháng i chứa date_sk < date_sk đầu tiên của tháng i+1; tháng cuối: MAXVALUE
+        partitions = [
+            f"PARTITION {partition_name(ym)} VALUES LESS THAN ({next_first_sk})"
+            for (ym, _), (_, next_first_sk) in zip(months, months[1:])
+        ] + [f"PARTITION {partition_name(months[-1][0])} VALUES LESS THAN MAXVALUE"]
+        conn.execute(text(f"ALTER TABLE {FACT_TABLE} PARTITION BY RANGE (date_sk) ({', '.join(partitions)})"))
+    print(f"✅ Đã phân vùng '{FACT_TABLE}' theo tháng ({len(partitions)} partition).")
+
+# ==============================================================================
+# ARCHIVE: CHUYỂN PARTITION CŨ RA KHỎI FACT
+# ==============================================================================
+def cutoff_year_month(keep_months, today=None):
+    """YYYYMM của tháng cũ nhất còn được giữ lại."""
+    today = today or date.today()
+    months = today.year * 12 + today.month - 1 - (keep_months - 1)
+    return f"{months // 12}{months % 12 + 1:02d}"
+
+def archive_partition(engine, partition, year_month, drop_only=False):
+    """
+    Tách 1 partition khỏi Fact, chi phí tỉ lệ với kích thước partition (không quét cả bảng):
+    EXCHANGE PARTITION sang bảng rỗng cùng cấu trúc -> nén bảng đó (ROW_FORMAT=COMPRESSED)
+    -> đổi tên thành bảng archive của tháng. drop_only: xóa luôn, không lưu archive.
+    """
+    swap = f"{FACT_TABLE}_swap_{year_month}"
+    with engine.begin() as conn:
+        if not drop_only:
+            conn.execute(text(f"DROP TABLE IF EXISTS {swap}"))
+            conn.execute(text(f"CREATE TABLE {swap} LIKE {FACT_TABLE}"))
+            conn.execute(text(f"ALTER TABLE {swap} REMOVE PARTITIONING"))
+            conn.execute(text(f"ALTER TABLE {FACT_TABLE} EXCHANGE PARTITION {partition} WITH TABLE {swap}"))
+            conn.execute(text(f"ALTER TABLE {swap} ROW_FORMAT=COMPRESSED"))
+            conn.execute(text(f"RENAME TABLE {swap} TO {archive_table_name(year_month)}"))
+        conn.execute(text(f"ALTER TABLE {FACT_TABLE} DROP PARTITION {partition}"))
+
+def run_archive(engine, keep_months=FACT_RETENTION_MONTHS, drop_only=False):
+    with engine.connect() as conn:
+        partitions = list_partitions(conn)
+    if not partitions:
+        print(f"❌ Bảng '{FACT_TABLE}' chưa phân vùng. Hãy chạy: python fact_maintenance.py partition")
+        sys.exit(1)
+
+    cutoff = cutoff_year_month(keep_months)
+    # Luôn giữ partition cuối (MAXVALUE): MySQL không cho xóa partition cuối cùng của bảng
+    old = [(name, rows) for name, rows in partitions[:-1] if name[1:] < cutoff]
+    if not old:
+        print(f"ℹ️ Không có partition nào cũ hơn {cutoff}.")
+        return
+
+    action = "Xóa" if drop_only else "Archive"
+    for name, rows in old:
+        archive_partition(engine, name, name[1:], drop_only=drop_only)
+        target = "" if drop_only else f" -> {archive_table_name(name[1:])}"
+        print(f"📦 {action} {name} (~{rows} dòng){target}")
+    print(f"✅ Đã xử lý {len(old)} partition cũ hơn {cutoff} (giữ {keep_months} tháng gần nhất).")
+
+def _keep_months_arg(args):
+    if "--keep-months" in args:
+        return int(args[args.index("--keep-months") + 1])
+    return FACT_RETENTION_MONTHS
+
+
+COMMANDS = {
+    "compact": lambda engine, args: run_compact(engine, dry_run="--dry-run" in args),
+    "partition": lambda engine, args: enable_fact_partitioning(engine),
+    "archive": lambda engine, args: run_archive(engine, _keep_months_arg(args), drop_only="--drop" in args),
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print(f"Cách dùng: python fact_maintenance.py <{'|'.join(COMMANDS)}> [tùy chọn]")
+        sys.exit(1)
+    engine = get_warehouse_engine()
+    try:
+        COMMANDS[sys.argv[1]](engine, sys.argv[2:])
+    except Exception as e:
+        print(f"❌ Lỗi bảo trì bảng Fact: {e}")
+        sys.exit(1)
+    finally:
+        engine.dispose()
@@ -3,19 +3,14 @@ import sys
 from dotenv import load_dotenv
 from sqlalchemy import create_engine, text
 from sqlalchemy.exc import SQLAlchemyError
+from location_mapping import load_locations, mart_table_name
+from migrations import require_schema, current_version, latest_version, detail_mart_ddl
 
 # --- DỮ LIỆU ĐẦU VÀO ---
-LOCATIONS_DATA = [
-    {"key": "353981", "name": "Ho Chi Minh"},
-    {"key": "353412", "Ha Noi": "Ha Noi"}, # Lưu ý: Data gốc bạn đưa key hơi lạ, mình chuẩn hóa lại bên dưới
-    {"key": "427264", "name": "Da Nang"}
-]
-
-# Chuẩn hóa lại format data cho dễ xử lý (List of Dictionary chuẩn)
+# Lấy từ danh mục địa điểm dùng chung (locations.csv)
 CLEAN_DATA = [
-    {"location_key": "353981", "location_name": "Ho Chi Minh"},
-    {"location_key": "353412", "location_name": "Ha Noi"},
-    {"location_key": "427264", "location_name": "Da Nang"}
+    {"location_key": loc["location_key"], "location_name": loc["location_name"]}
+    for loc in load_locations()
 ]
 
 # --- HÀM KẾT NỐI (Tương tự các bài trước) ---
@@ -45,20 +40,6 @@ def get_warehouse_engine():
         print(f"❌ Lỗi tạo engine: {e}")
         return None
 
-# --- HÀM TẠO BẢNG (DDL) ---
-def create_table_if_not_exists(conn):
-    sql = text("""
-    CREATE TABLE IF NOT EXISTS dim_location (
-        location_key VARCHAR(50) NOT NULL,
-        location_name VARCHAR(100) NOT NULL,
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-        PRIMARY KEY (location_key)
-    ) ENGINE=InnoDB CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
-    """)
-    conn.execute(sql)
-    print("✅ Đã kiểm tra/tạo bảng 'dim_location'.")
-
 # --- HÀM NẠP DỮ LIỆU (UPSERT) ---
 def upsert_locations(engine, data):
     upsert_sql = text("""
@@ -70,23 +51,48 @@ def upsert_locations(engine, data):
 
     try:
         with engine.connect() as conn:
-            # 1. Tạo bảng trước
-            create_table_if_not_exists(conn)
-            
-            # 2. Thực thi Upsert cho từng dòng
+            # Thực thi Upsert (executemany cho toàn bộ danh mục)
             print(f"🔄 Đang đồng bộ {len(data)} địa điểm...")
-            for row in data:
-                conn.execute(upsert_sql, row)
+            conn.execute(upsert_sql, data)
             
             conn.commit()
             print("🎉 Đồng bộ dim_location thành công!")
+            return True
             
     except SQLAlchemyError as e:
         print(f"❌ Lỗi SQL: {e}")
+        return False
+
+# --- TẠO BẢNG DETAIL MART CHO ĐỊA ĐIỂM (lúc đăng ký, không phải lúc nạp mart) ---
+def create_location_marts(data):
+    """
+    Tạo bảng Detail Mart (CREATE TABLE IF NOT EXISTS) cho các địa điểm vừa đồng bộ,
+    để load_to_data_mart chỉ cần kiểm tra phiên bản cấu trúc.
+    Data Mart chưa được migrate: migrations.py mart sẽ tạo các bảng này.
+    """
+    dm_name = os.getenv("DM_DB_NAME")
+    engine = create_engine(
+        f"mysql+pymysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@"
+        f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{dm_name}"
+    )
+    try:
+        with engine.begin() as conn:
+            if current_version(conn, "mart") < latest_version("mart"):
+                print("💡 Data Mart chưa được migrate: chạy python migrations.py mart (tạo luôn bảng Detail Mart)")
+                return
+            for loc in data:
+                conn.execute(text(detail_mart_ddl(mart_table_name(loc["location_key"]))))
+        print(f"🎉 Đã có bảng Detail Mart cho {len(data)} địa điểm trong '{dm_name}'.")
+    except (SQLAlchemyError, ValueError) as e:
+        print(f"❌ Lỗi tạo bảng Detail Mart: {e}")
+    finally:
+        engine.dispose()
 
 # --- MAIN ---
 if __name__ == "__main__":
     engine = get_warehouse_engine()
     if engine:
-        upsert_locations(engine, CLEAN_DATA)
+        require_schema(engine, "warehouse")  # Bảng dim_location được tạo bởi migrations.py
+        if upsert_locations(engine, CLEAN_DATA):
+            create_location_marts(CLEAN_DATA)
         engine.dispose()
\ No newline at end of file
@@ -5,7 +5,7 @@ from dotenv import load_dotenv
 from sqlalchemy import create_engine, text
 from sqlalchemy.types import Integer, Date, String, VARCHAR
 from sqlalchemy.exc import SQLAlchemyError
-import pymysql
+from migrations import require_schema
 
 # --- HÀM HELPER: Lấy Engine (Đã sửa đổi để linh hoạt) ---
 def get_db_engine(db_name_env_key):
@@ -26,28 +26,7 @@ def get_db_engine(db_name_env_key):
         print(f"Lỗi: Thiếu thông tin cấu hình cho '{db_name_env_key}' trong .env", file=sys.stderr)
         return None # Trả về None để xử lý ở hàm main thay vì exit ngay
 
-    # 1. Tạo CSDL nếu chưa có (dùng PyMySql)
-    conn = None
-    try:
-        conn = pymysql.connect(
-            user=db_user,
-            password=db_pass,
-            host=db_host,
-            port=int(db_port),
-            charset='utf8mb4'
-        )
-        cursor = conn.cursor()
-        # Tạo DB nếu chưa tồn tại
-        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {db_name} CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
-        print(f"✅ CSDL '{db_name}' đã sẵn sàng.")
-    except pymysql.MySQLError as err:
-        print(f"❌ Lỗi PyMySql khi tạo CSDL {db_name}: {err}", file=sys.stderr)
-        sys.exit(1)
-    finally:
-        if conn:
-            conn.close()
-
-    # 2. Tạo Engine (dùng SQLAlchemy)
+    # Tạo Engine (dùng SQLAlchemy). CSDL và bảng được tạo bởi migrations.py
     try:
         connection_string = f"mysql+pymysql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
         engine = create_engine(connection_string)
@@ -83,20 +62,17 @@ def load_dimension(engine, file_name, table_name, schema, pk_column):
             names=column_names
         )
         
-        print(f"   - Đang tải {len(df)} dòng vào bảng '{table_name}'...")
-        df.to_sql(
-            name=table_name,
-            con=engine,
-            if_exists='replace',
-            index=False,
-            dtype=schema,
-            chunksize=1000
-        )
-        
-        print(f"   - Đang tạo Khóa chính ({pk_column})...")
-        with engine.connect() as conn:
-            conn.execute(text(f"ALTER TABLE {table_name} ADD PRIMARY KEY ({pk_column});"))
-            conn.commit()
+        # Upsert vào bảng có sẵn (không DROP/CREATE lại bảng: bảng Fact có khóa ngoại tới dim)
+        print(f"   - Đang upsert {len(df)} dòng vào bảng '{table_name}'...")
+        cols = ', '.join(f"`{col}`" for col in column_names)
+        params = ', '.join(f":{col}" for col in column_names)
+        updates = ', '.join(f"`{col}` = VALUES(`{col}`)" for col in column_names if col != pk_column)
+        upsert_sql = text(f"INSERT INTO {table_name} ({cols}) VALUES ({params}) "
+                          f"ON DUPLICATE KEY UPDATE {updates}")
+        records = df.astype(object).where(df.notnull(), None).to_dict(orient='records')
+        with engine.begin() as conn:
+            for start in range(0, len(records), 1000):
+                conn.execute(upsert_sql, records[start:start + 1000])
             
         print(f"✅ Thành công: Bảng '{table_name}' tại DB '{db_name}'.\n")
 
@@ -145,6 +121,7 @@ if __name__ == "__main__":
 
     # 3. Thực thi tải dữ liệu cho Staging
     if staging_engine:
+        require_schema(staging_engine, "staging")
         load_dimension(
             engine=staging_engine,
             file_name=file_csv,
@@ -155,6 +132,7 @@ if __name__ == "__main__":
 
     # 4. Thực thi tải dữ liệu cho Warehouse
     if wh_engine:
+        require_schema(wh_engine, "warehouse")
         load_dimension(
             engine=wh_engine,
             file_name=file_csv,
@@ -1,11 +1,14 @@
 import os
 import sys
 import pandas as pd
-import pymysql
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sqlalchemy
+from location_mapping import load_mart_catalog
+from mart_publish import InPlacePublisher, ShadowPublisher, WATERMARK_TABLE
+from migrations import require_schema
 
 # --- CẤU HÌNH & KHỞI TẠO ---
 load_dotenv()
@@ -16,13 +19,44 @@ FACT_TABLE = os.getenv("FACT_TABLE_NAME")
 DIM_DATE = "dim_date" 
 LOG_BASE_PATH = os.getenv("LOG_BASE_PATH") 
 
-LOCATION_MARTS = {
-    "353981": {"name": "ho_chi_minh", "table": "dm_hcm"},
-    "353412": {"name": "ha_noi", "table": "dm_hanoi"},
-    "427264": {"name": "da_nang", "table": "dm_danang"},
-}
+# Danh sách Detail Mart sinh từ dim_location lúc chạy (location_mapping.load_mart_catalog),
+# bảng mart được tạo khi đăng ký địa điểm (load_dim_location.py) hoặc bởi: python migrations.py mart
+# Số địa điểm nạp Detail Mart song song (mỗi luồng 1 connection trong pool)
+DM_LOAD_WORKERS = int(os.getenv("DM_LOAD_WORKERS", "8"))
 
 AGGREGATE_MART_TABLE = "dm_monthly_summary" 
+ROLLUP_MART_TABLE = "dm_rollup"
+
+# Các grain của rollup cube: mỗi grain là 1 biểu thức khóa trên Fact (f) / dim_date (d).
+# Thêm grain mới = thêm 1 dòng ở đây (không cần sửa SQL).
+# cell=True: 1 ô chỉ gồm các ngày của 1 khoảng thời gian -> incremental chỉ tính lại các ô có
+# dòng Fact đổi; cell=False (day_type, holiday): ô trải trên toàn bộ lịch sử của địa điểm.
+ROLLUP_GRAINS = [
+    {"grain": "week", "key": "d.year_week_monday", "cell": True},
+    # Tháng/năm theo date_time như dm_monthly_summary (dòng hợp lệ luôn có date_time);
+    # full_date chỉ dùng khi date_time NULL, để dòng vừa hỏng vẫn xác định được ô cũ
+    {"grain": "month", "key": "DATE_FORMAT(COALESCE(f.date_time, d.full_date), '%Y%m')", "cell": True},
+    {"grain": "year", "key": "CAST(YEAR(COALESCE(f.date_time, d.full_date)) AS CHAR)", "cell": True},
+    {"grain": "day_type", "key": "d.day_type", "cell": False},
+    {"grain": "holiday", "key": "d.holiday_flag", "cell": False},
+]
+
+# full: dựng lại mart từ toàn bộ Fact | incremental: chỉ các dòng Fact mới/đổi sau watermark của mart
+DM_REFRESH_MODE = os.getenv("DM_REFRESH_MODE", "full").lower()
+# inplace: ghi thẳng vào bảng mart | shadow: dựng bảng shadow rồi RENAME TABLE (xem mart_publish.py)
+DM_PUBLISH_MODE = os.getenv("DM_PUBLISH_MODE", "inplace").lower()
+# sql: tính dm_monthly_summary ngay trên MySQL (INSERT ... SELECT ... GROUP BY)
+# pandas: đọc Fact về Python rồi groupby (dùng khi mart không cùng server MySQL với Warehouse)
+DM_AGGREGATE_ENGINE = os.getenv("DM_AGGREGATE_ENGINE", "sql").lower()
+# Số ô (month_sk, location_key) tối đa trong 1 câu truy vấn khi tính lại aggregate
+CELL_QUERY_BATCH = 200
+
+DETAIL_COLUMNS = [
+    'date_sk', 'location_key', 'date_time', 'min_temp_c', 'max_temp_c', 
+    'day_icon', 'day_phrase', 'day_precip', 
+    'night_icon', 'night_phrase', 'night_precip', 
+    'source', 'created_at'
+]
 
 # ==============================================================================
 # HÀM LOG
@@ -41,219 +75,531 @@ def log(step, msg, level="INFO"):
         pass
 
 # ==============================================================================
-# PHẦN 1: TẠO CẤU TRÚC DATA MART (DDL)
+# LOGIC ETL
 # ==============================================================================
-def init_datamart_structure():
-    log("P0", "Kiểm tra và khởi tạo cấu trúc Data Mart...", "SETUP")
-    
-    host = os.getenv("DB_HOST")
-    user = os.getenv("DB_USER")
-    password = os.getenv("DB_PASS")
-    port = int(os.getenv("DB_PORT"))
-    dm_name = os.getenv("DM_DB_NAME")
-
-    try:
-        conn = pymysql.connect(host=host, user=user, password=password, port=port)
-        cursor = conn.cursor()
-        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {dm_name} CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;")
-        cursor.execute(f"USE {dm_name};")
-
-        # --- A. TẠO 3 BẢNG DETAIL MARTS ---
-        for key, info in LOCATION_MARTS.items():
-            table_name = info['table']
-            cursor.execute(f"""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                date_sk INT NOT NULL,
-                location_key VARCHAR(50) NOT NULL,
-                date_time DATETIME,
-                min_temp_c FLOAT,
-                max_temp_c FLOAT,
-                day_icon INT,
-                day_phrase VARCHAR(100),
-                day_precip TINYINT(1),
-                night_icon INT,
-                night_phrase VARCHAR(100),
-                night_precip TINYINT(1),
-                source VARCHAR(100),
-                created_at DATETIME,
-                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-                PRIMARY KEY (date_sk, location_key)
-            );
-            """)
-
-        # --- B. TẠO BẢNG AGGREGATE MART ---
-        cursor.execute(f"""
-        CREATE TABLE IF NOT EXISTS {AGGREGATE_MART_TABLE} (
-            month_sk INT NOT NULL,
-            location_key VARCHAR(50) NOT NULL,
-            avg_max_temp_c FLOAT,
-            avg_min_temp_c FLOAT,
-            avg_temp_c FLOAT,
-            total_rainy_days INT,
-            total_forecast_days INT,
-            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-            PRIMARY KEY (month_sk, location_key)
-        );
-        """)
-
-        conn.commit()
-        cursor.close()
-        conn.close()
-        log("P0", "Đã hoàn tất tạo 4 bảng Data Mart.", "SUCCESS")
-
-    except Exception as e:
-        log("L0", f"Lỗi khởi tạo DB: {e}", "ERROR")
-        sys.exit(1)
-
-# ==============================================================================
-# PHẦN 2: LOGIC ETL
-# ==============================================================================
-def get_engine(db_name):
+def get_engine(db_name, pool_size=5):
     try:
         db_user = os.getenv('DB_USER')
         db_pass = os.getenv('DB_PASS')
         db_host = os.getenv('DB_HOST')
         db_port = os.getenv('DB_PORT')
         uri = f"mysql+pymysql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
-        return create_engine(uri)
+        return create_engine(uri, pool_size=pool_size, max_overflow=0, pool_pre_ping=True)
     except Exception as e:
         log("CONFIG", f"Lỗi tạo engine cho {db_name}: {e}", "ERROR")
         sys.exit(1)
 
-def main_load_data_mart():
-    init_datamart_structure()
-    log("START", "Bắt đầu quy trình ETL Data Mart...", "INFO")
+# ==============================================================================
+# WATERMARK (mốc updated_at của Fact đã nạp vào từng mart)
+# ==============================================================================
+def read_watermarks(dm_engine):
+    with dm_engine.connect() as conn:
+        rows = conn.execute(text(f"SELECT mart_name, high_water FROM {WATERMARK_TABLE}"))
+        return {row.mart_name: row.high_water for row in rows}
 
-    wh_engine = get_engine(WH_DB_NAME) 
-    dm_engine = get_engine(os.getenv("DM_DB_NAME")) 
+def save_watermarks(dm_engine, mart_names, high_water):
+    with dm_engine.begin() as conn:
+        conn.execute(text(f"""
+            INSERT INTO {WATERMARK_TABLE} (mart_name, high_water) VALUES (:m, :hw)
+            ON DUPLICATE KEY UPDATE high_water = VALUES(high_water)
+        """), [{"m": name, "hw": high_water} for name in mart_names])
 
-    try:
-        # --- [P1] EXTRACT ---
-        all_keys = list(LOCATION_MARTS.keys())
-        keys_str = ', '.join([f"'{k}'" for k in all_keys])
-
-        main_query = f"""
-        SELECT 
-            f.date_sk, f.location_key, f.date_time, f.min_temp_c, f.max_temp_c, 
-            f.day_icon, f.day_phrase, f.day_precip, 
-            f.night_icon, f.night_phrase, f.night_precip, 
-            f.source, f.created_at,
-            d.month_sk -- Lấy cột này, nhưng sẽ bị ghi đè ở bước Transform bên dưới
+def fact_high_water(wh_engine):
+    with wh_engine.connect() as conn:
+        return conn.execute(text(f"SELECT MAX(updated_at) FROM {FACT_TABLE}")).scalar()
+
+# ==============================================================================
+# EXTRACT / TRANSFORM
+# ==============================================================================
+def extract_fact(wh_engine, where="", params=None):
+    """Đọc Fact (join dim_date, dim_location) kèm điều kiện lọc thêm."""
+    main_query = f"""
+    SELECT 
+        f.date_sk, f.location_key, f.date_time, f.min_temp_c, f.max_temp_c, 
+        f.day_icon, f.day_phrase, f.day_precip, 
+        f.night_icon, f.night_phrase, f.night_precip, 
+        f.source, f.created_at, f.updated_at,
+        d.full_date, -- Ngày của date_sk: xác định ô tháng của dòng có date_time NULL
+        d.month_sk -- Lấy cột này, nhưng sẽ bị ghi đè ở bước Transform bên dưới
+    FROM {WH_DB_NAME}.{FACT_TABLE} f
+    JOIN {WH_DB_NAME}.{DIM_DATE} d ON f.date_sk = d.date_sk
+    JOIN {WH_DB_NAME}.dim_location l ON f.location_key = l.location_key
+    WHERE 1 = 1 {where}
+    """
+    return pd.read_sql(text(main_query), wh_engine, params=params or {})
+
+def prepare_fact_frame(df_all):
+    df_all = df_all.dropna(subset=['date_time', 'min_temp_c', 'max_temp_c', 'date_sk', 'location_key']).copy()
+    
+    # Tính Metrics
+    df_all['avg_temp_c'] = (df_all['min_temp_c'] + df_all['max_temp_c']) / 2
+    df_all['is_rainy_day'] = ((df_all['day_precip'] == 1) | (df_all['night_precip'] == 1)).astype(int)
+    
+    # --- FIX QUAN TRỌNG: Tính toán lại month_sk bằng Python để đảm bảo định dạng YYYYMM ---
+    # Điều này sẽ ghi đè bất kỳ giá trị sai nào (như 1, 2) lấy từ database
+    df_all['month_sk'] = pd.to_datetime(df_all['date_time']).dt.strftime('%Y%m').astype(int)
+    
+    # Xử lý NULL cho text
+    text_cols = ['source', 'day_phrase', 'night_phrase', 'created_at']
+    for col in text_cols:
+        if col in df_all.columns:
+            df_all[col] = df_all[col].fillna('')
+    return df_all
+
+def changed_since(df, watermark):
+    """Các dòng Fact đổi từ watermark (None = mart chưa nạp lần nào -> lấy hết)."""
+    return df if watermark is None else df[df['updated_at'] >= watermark]
+
+def changed_cells(df_fact, watermark):
+    """
+    Các ô (month_sk, location_key) có dòng Fact đổi từ watermark, tính trên dữ liệu CHƯA lọc
+    (trước prepare_fact_frame): dòng vừa đổi sang NULL nhiệt độ/date_time vẫn làm ô cũ của nó
+    được tính lại. Tháng lấy theo date_time, NULL thì theo ngày của date_sk trong dim_date.
+    """
+    df = changed_since(df_fact, watermark).dropna(subset=['location_key'])
+    day = pd.to_datetime(df['date_time']).fillna(pd.to_datetime(df['full_date']))
+    df = df.assign(cell_month=day.dt.strftime('%Y%m')).dropna(subset=['cell_month'])
+    return set(zip(df['cell_month'].astype(int), df['location_key']))
+
+def cell_keys(cells):
+    """Điều kiện SQL (kèm tham số) chọn các dòng mart theo khóa (month_sk, location_key)."""
+    conditions, params = [], {}
+    for i, (month_sk, location_key) in enumerate(cells):
+        conditions.append(f"(month_sk = :km{i} AND location_key = :kl{i})")
+        params.update({f"km{i}": int(month_sk), f"kl{i}": location_key})
+    return f"({' OR '.join(conditions)})", params
+
+def cell_conditions(cells):
+    """Điều kiện SQL (kèm tham số) chọn các dòng Fact thuộc các ô (month_sk, location_key)."""
+    conditions, params = [], {}
+    for i, (month_sk, location_key) in enumerate(cells):
+        month_start = pd.Timestamp(year=month_sk // 100, month=month_sk % 100, day=1)
+        conditions.append(f"(f.location_key = :lk{i} AND f.date_time >= :ms{i} AND f.date_time < :me{i})")
+        params.update({f"lk{i}": location_key, f"ms{i}": month_start.to_pydatetime(),
+                       f"me{i}": (month_start + pd.offsets.MonthBegin(1)).to_pydatetime()})
+    return f"({' OR '.join(conditions)})", params
+
+def cell_batches(cells):
+    cells = sorted(cells)
+    for start in range(0, len(cells), CELL_QUERY_BATCH):
+        yield cells[start:start + CELL_QUERY_BATCH]
+
+def extract_cells(wh_engine, cells):
+    """Đọc toàn bộ dòng Fact thuộc các ô (month_sk, location_key) cần tính lại."""
+    frames = []
+    for batch in cell_batches(cells):
+        condition, params = cell_conditions(batch)
+        frames.append(extract_fact(wh_engine, f"AND {condition}", params))
+    return pd.concat(frames, ignore_index=True)
+
+# ==============================================================================
+# LOAD
+# ==============================================================================
+def upsert_detail_mart(dm_engine, table_name, df_city, publisher, stale_keys=()):
+    """
+    Upsert theo khóa (date_sk, location_key): dòng Fact được cập nhật sẽ ghi đè bản cũ trong mart.
+    stale_keys: (date_sk, location_key) của dòng Fact vừa đổi sang không hợp lệ (bị prepare_fact_frame
+    loại) -> xóa khỏi mart trong cùng transaction, không để lại bản cũ.
+    """
+    # Gọi target trong luồng worker: tạo/chép shadow của các mart chạy song song
+    table_name = publisher.target(table_name)
+    cols = ', '.join(DETAIL_COLUMNS)
+    params = ', '.join([f":{col}" for col in DETAIL_COLUMNS])
+    updates = ', '.join(f"{col} = VALUES({col})" for col in DETAIL_COLUMNS[2:])
+    sql = text(f"""
+        INSERT INTO {table_name} ({cols}) VALUES ({params})
+        ON DUPLICATE KEY UPDATE {updates}
+    """)
+    with dm_engine.begin() as conn:
+        if stale_keys:
+            conn.execute(text(f"DELETE FROM {table_name} WHERE date_sk = :date_sk AND location_key = :location_key"),
+                         [{"date_sk": int(date_sk), "location_key": key} for date_sk, key in stale_keys])
+        if not df_city.empty:
+            conn.execute(sql, df_city[DETAIL_COLUMNS].to_dict(orient='records'))
+    return len(df_city)
+
+def stale_detail_keys(df_fact_city, df_city):
+    """Khóa (date_sk, location_key) có trong Fact đã đổi nhưng không còn dòng hợp lệ."""
+    changed = set(zip(df_fact_city['date_sk'].dropna().astype(int), df_fact_city['location_key']))
+    return sorted(changed - set(zip(df_city['date_sk'].astype(int), df_city['location_key'])))
+
+def load_detail_marts(dm_engine, df_fact, df_all, watermarks, marts, publisher):
+    """
+    Nạp song song Detail Mart của mọi địa điểm (tối đa DM_LOAD_WORKERS luồng).
+    df_fact: Fact chưa lọc (tìm dòng vừa hỏng để xóa), df_all: Fact sau prepare_fact_frame.
+    """
+    log("P2", f"Load {len(marts)} Detail Marts ({DM_LOAD_WORKERS} luồng song song)...", "INFO")
+
+    valid_by_location = dict(tuple(df_all.groupby('location_key')))
+    jobs = {}
+    for location_key, df_fact_city in df_fact.groupby('location_key'):
+        info = marts.get(location_key)
+        if info is None:
+            continue
+        watermark = watermarks.get(info['table'])
+        df_city = changed_since(valid_by_location.get(location_key, df_all.iloc[0:0]), watermark)
+        stale_keys = stale_detail_keys(changed_since(df_fact_city, watermark), df_city)
+        if not df_city.empty or stale_keys:
+            jobs[info['table']] = (df_city, stale_keys)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, DM_LOAD_WORKERS)) as executor:
+        futures = {executor.submit(upsert_detail_mart, dm_engine, table, df_city, publisher, stale_keys): table
+                   for table, (df_city, stale_keys) in jobs.items()}
+        for future in as_completed(futures):
+            table_name = futures[future]
+            try:
+                count = future.result()
+                log("P3", f"Hoàn tất load Detail Mart {table_name} ({count} dòng).", "SUCCESS")
+            except Exception as e:
+                failed.append(table_name)
+                log("P3", f"Lỗi load Detail Mart {table_name}: {e}", "ERROR")
+
+    if failed:
+        # Không ghi watermark: lần chạy sau sẽ nạp lại các mart lỗi
+        raise RuntimeError(f"{len(failed)} Detail Mart nạp thất bại: {', '.join(sorted(failed))}")
+
+def aggregate_monthly(df_all):
+    return df_all.groupby(['month_sk', 'location_key']).agg(
+        avg_max_temp_c=('max_temp_c', 'mean'),
+        avg_min_temp_c=('min_temp_c', 'mean'),
+        avg_temp_c=('avg_temp_c', 'mean'), 
+        total_rainy_days=('is_rainy_day', 'sum'),
+        total_forecast_days=('date_sk', 'nunique')
+    ).reset_index()
+
+MONTHLY_SUMMARY_UPSERT = f"""
+    ON DUPLICATE KEY UPDATE
+        avg_max_temp_c=VALUES(avg_max_temp_c), 
+        avg_min_temp_c=VALUES(avg_min_temp_c), 
+        avg_temp_c=VALUES(avg_temp_c),
+        total_rainy_days=VALUES(total_rainy_days),
+        total_forecast_days=VALUES(total_forecast_days),
+        last_updated=NOW()
+"""
+
+def delete_cells(conn, table, cells):
+    """Xóa các ô sắp tính lại: ô không còn dòng Fact hợp lệ nào sẽ không còn số liệu cũ."""
+    for batch in cell_batches(cells):
+        condition, params = cell_keys(batch)
+        conn.execute(text(f"DELETE FROM {table} WHERE {condition}"), params)
+
+def load_monthly_summary(dm_engine, df_monthly_city, table=AGGREGATE_MART_TABLE, cells=None):
+    """Engine pandas: (xóa các ô cells nếu có) rồi upsert kết quả groupby bằng 1 lệnh executemany."""
+    log("P3", f"Load {len(df_monthly_city)} dòng vào {table}", "INFO")
+
+    sql = text(f"""
+        INSERT INTO {table} 
+        (month_sk, location_key, avg_max_temp_c, avg_min_temp_c, avg_temp_c, total_rainy_days, total_forecast_days)
+        VALUES (:month_sk, :location_key, :avg_max_temp_c, :avg_min_temp_c, :avg_temp_c, :total_rainy_days, :total_forecast_days)
+        {MONTHLY_SUMMARY_UPSERT}
+    """)
+    with dm_engine.begin() as conn:
+        if cells is not None:
+            delete_cells(conn, table, cells)
+        if not df_monthly_city.empty:
+            conn.execute(sql, df_monthly_city.to_dict(orient='records'))
+    log("P3", f"Hoàn tất load {table}.", "SUCCESS")
+
+def aggregate_monthly_pushdown(dm_engine, cells=None, table=AGGREGATE_MART_TABLE):
+    """
+    Engine sql: tính và upsert dm_monthly_summary bằng 1 lệnh INSERT ... SELECT ... GROUP BY
+    đọc thẳng bảng Fact ở schema Warehouse (cùng server). Cùng quy tắc với prepare_fact_frame +
+    aggregate_monthly. cells: chỉ tính các ô này (None = toàn bộ). Trả về rowcount của upsert.
+    """
+    sql = f"""
+        INSERT INTO {table} 
+        (month_sk, location_key, avg_max_temp_c, avg_min_temp_c, avg_temp_c, total_rainy_days, total_forecast_days)
+        SELECT
+            CAST(DATE_FORMAT(f.date_time, '%Y%m') AS UNSIGNED) AS month_sk,
+            f.location_key,
+            AVG(f.max_temp_c),
+            AVG(f.min_temp_c),
+            AVG((f.min_temp_c + f.max_temp_c) / 2),
+            COALESCE(SUM(f.day_precip = 1 OR f.night_precip = 1), 0),
+            COUNT(DISTINCT f.date_sk)
         FROM {WH_DB_NAME}.{FACT_TABLE} f
         JOIN {WH_DB_NAME}.{DIM_DATE} d ON f.date_sk = d.date_sk
-        WHERE f.location_key IN ({keys_str})
-        """
-        
-        df_all = pd.read_sql(main_query, wh_engine)
-        log("P1", f"Extract: Đã lấy {len(df_all)} dòng từ Fact Table.", "INFO")
+        JOIN {WH_DB_NAME}.dim_location l ON f.location_key = l.location_key
+        WHERE f.date_time IS NOT NULL AND f.min_temp_c IS NOT NULL AND f.max_temp_c IS NOT NULL
+          {{cells}}
+        -- Group theo biểu thức, không theo alias: MySQL ưu tiên cột d.month_sk (1, 2, ...) của dim_date
+        GROUP BY CAST(DATE_FORMAT(f.date_time, '%Y%m') AS UNSIGNED), f.location_key
+        {MONTHLY_SUMMARY_UPSERT}
+    """
+    affected = 0
+    with dm_engine.begin() as conn:
+        if cells is None:
+            affected += conn.execute(text(sql.format(cells=""))).rowcount
+        else:
+            delete_cells(conn, table, cells)
+            for batch in cell_batches(cells):
+                condition, params = cell_conditions(batch)
+                affected += conn.execute(text(sql.format(cells=f"AND {condition}")), params).rowcount
+    return affected
 
-        if df_all.empty:
-            log("P1", "Fact Table rỗng. Kết thúc.", "WARNING")
+def refresh_monthly_summary(wh_engine, dm_engine, df_fact, df_all, watermark, publisher):
+    """
+    Lần đầu (chưa có watermark): tính từ toàn bộ Fact.
+    Incremental: chỉ tính lại các ô (month_sk, location_key) có dòng Fact đổi (lấy từ df_fact
+    chưa lọc, xem changed_cells), mỗi ô tính từ đầy đủ các dòng Fact của tháng đó.
+    """
+    log("P2", f"Bắt đầu Aggregation theo Tháng & Tỉnh (engine={DM_AGGREGATE_ENGINE})...", "INFO")
+    cells = None
+    if watermark is not None:
+        cells = changed_cells(df_fact, watermark)
+        if not cells:
+            log("P2", f"{AGGREGATE_MART_TABLE}: không có ô nào cần tính lại.", "INFO")
             return
+        log("P2", f"Tính lại {len(cells)} ô (month_sk, location_key).", "INFO")
+
+    table = publisher.target(AGGREGATE_MART_TABLE)
+    if DM_AGGREGATE_ENGINE == "sql":
+        affected = aggregate_monthly_pushdown(dm_engine, cells, table)
+        log("P3", f"Hoàn tất upsert {AGGREGATE_MART_TABLE} trên MySQL ({affected} dòng bị ảnh hưởng).", "SUCCESS")
+        return
 
-        # --- [P2] TRANSFORM ---
-        df_all.dropna(subset=['date_time', 'min_temp_c', 'max_temp_c', 'date_sk', 'location_key'], inplace=True)
-        
-        # Tính Metrics
-        df_all['avg_temp_c'] = (df_all['min_temp_c'] + df_all['max_temp_c']) / 2
-        df_all['is_rainy_day'] = df_all.apply(lambda x: 1 if (x['day_precip'] == 1 or x['night_precip'] == 1) else 0, axis=1)
-        
-        # --- FIX QUAN TRỌNG: Tính toán lại month_sk bằng Python để đảm bảo định dạng YYYYMM ---
-        # Điều này sẽ ghi đè bất kỳ giá trị sai nào (như 1, 2) lấy từ database
-        df_all['month_sk'] = pd.to_datetime(df_all['date_time']).dt.strftime('%Y%m').astype(int)
-        
-        # Xử lý NULL cho text
-        text_cols = ['source', 'day_phrase', 'night_phrase', 'created_at']
-        for col in text_cols:
-            if col in df_all.columns:
-                df_all[col] = df_all[col].fillna('')
-
-        # -------------------------------------------------------------
-        # --- LOAD (3 BẢNG DETAIL MARTS) ---
-        # -------------------------------------------------------------
-        log("P2", "Load 3 Detail Marts (Filter & Load)...", "INFO")
-        
-        DETAIL_COLUMNS = [
-            'date_sk', 'location_key', 'date_time', 'min_temp_c', 'max_temp_c', 
-            'day_icon', 'day_phrase', 'day_precip', 
-            'night_icon', 'night_phrase', 'night_precip', 
-            'source', 'created_at'
-        ]
-
-        for location_key, info in LOCATION_MARTS.items():
-            table_name = info['table']
-            df_city = df_all[df_all['location_key'] == location_key].copy()
-            
-            if df_city.empty:
-                continue
-            
-            df_city_filtered = df_city[DETAIL_COLUMNS] 
-
-            with dm_engine.connect() as conn:
-                # Tạo danh sách values cho insert
-                data_to_insert = df_city_to_load = df_city_filtered.to_dict(orient='records')
-                
-                if not data_to_insert: continue
-
-                # Xây dựng câu lệnh INSERT IGNORE (Bỏ qua nếu trùng PK)
-                cols = ', '.join(DETAIL_COLUMNS)
-                params = ', '.join([f":{col}" for col in DETAIL_COLUMNS])
-                
-                sql = text(f"""
-                    INSERT IGNORE INTO {table_name} ({cols}) VALUES ({params})
-                """)
-                
-                conn.execute(sql, data_to_insert)
-                conn.commit()
-            
-            log("P3", f"Hoàn tất load Detail Mart {table_name}.", "SUCCESS")
-        
-        # -------------------------------------------------------------
-        # --- LOAD (BẢNG AGGREGATE MART) ---
-        # -------------------------------------------------------------
-        log("P2", "Bắt đầu Aggregation theo Tháng & Tỉnh...", "INFO")
-
-        df_monthly_city = df_all.groupby(['month_sk', 'location_key']).agg(
+    df_source = df_all if cells is None else prepare_fact_frame(extract_cells(wh_engine, cells))
+    load_monthly_summary(dm_engine, aggregate_monthly(df_source), table, cells)
+
+# ==============================================================================
+# ROLLUP CUBE: NHIỀU GRAIN (tuần/tháng/năm/loại ngày/ngày lễ) TỪ 1 LẦN QUÉT FACT
+# ==============================================================================
+ROLLUP_MEASURES = ['avg_max_temp_c', 'avg_min_temp_c', 'avg_temp_c', 'total_rainy_days', 'total_forecast_days']
+
+def rollup_base_sql(where="", valid_only=True):
+    """
+    Các dòng Fact kèm khóa k_<grain> của mọi grain.
+    valid_only: lọc như prepare_fact_frame (False khi tìm ô bị ảnh hưởng, để dòng vừa đổi
+    sang NULL vẫn làm ô cũ của nó được tính lại).
+    """
+    grain_keys = ",\n            ".join(f"{g['key']} AS k_{g['grain']}" for g in ROLLUP_GRAINS)
+    valid = ("AND f.date_time IS NOT NULL AND f.min_temp_c IS NOT NULL AND f.max_temp_c IS NOT NULL"
+             if valid_only else "")
+    return f"""
+        SELECT
+            f.location_key, f.date_sk, f.min_temp_c, f.max_temp_c,
+            (f.min_temp_c + f.max_temp_c) / 2 AS avg_temp_c,
+            COALESCE(f.day_precip = 1 OR f.night_precip = 1, 0) AS is_rainy_day,
+            {grain_keys}
+        FROM {WH_DB_NAME}.{FACT_TABLE} f
+        JOIN {WH_DB_NAME}.{DIM_DATE} d ON f.date_sk = d.date_sk
+        JOIN {WH_DB_NAME}.dim_location l ON f.location_key = l.location_key
+        WHERE 1 = 1 {valid}
+          {where}
+    """
+
+def rollup_upsert_sql(table):
+    columns = ['grain', 'grain_key', 'location_key'] + ROLLUP_MEASURES
+    updates = ", ".join(f"{col}=VALUES({col})" for col in ROLLUP_MEASURES)
+    return f"INSERT INTO {table} ({', '.join(columns)})", f"ON DUPLICATE KEY UPDATE {updates}, last_updated=NOW()"
+
+def rollup_scope(wh_engine, watermark):
+    """
+    Phạm vi tính lại incremental: (các địa điểm có dòng Fact đổi,
+    {grain cell=True: [(location_key, grain_key)] của các ô có dòng Fact đổi}).
+    """
+    keys = ", ".join(f"k_{g['grain']}" for g in ROLLUP_GRAINS if g['cell'])
+    changed = pd.read_sql(
+        text(f"SELECT DISTINCT location_key, {keys} FROM ({rollup_base_sql('AND f.updated_at >= :wm', False)}) b"),
+        wh_engine, params={"wm": watermark})
+    locations = sorted(changed['location_key'].unique())
+    cells = {}
+    for g in ROLLUP_GRAINS:
+        if g['cell']:
+            key = f"k_{g['grain']}"
+            rows = changed.dropna(subset=[key])
+            cells[g['grain']] = sorted(set(zip(rows['location_key'], rows[key].astype(str))))
+    return locations, cells
+
+def rollup_filters(scope):
+    """
+    Điều kiện SQL (kèm tham số) theo phạm vi: base chỉ đọc các địa điểm bị ảnh hưởng,
+    mỗi grain cell=True chỉ group các ô (location_key, grain_key) bị ảnh hưởng.
+    scope None (tính toàn bộ) -> không lọc.
+    """
+    if scope is None:
+        return "", {g['grain']: "" for g in ROLLUP_GRAINS}, {}
+    locations, cells = scope
+    params = {f"loc{i}": key for i, key in enumerate(locations)}
+    where = "AND f.location_key IN (" + ", ".join(f":loc{i}" for i in range(len(locations))) + ")"
+    branch = {g['grain']: "" for g in ROLLUP_GRAINS}
+    for g in ROLLUP_GRAINS:
+        if not g['cell']:
+            continue
+        name = g['grain']
+        pairs = cells[name]
+        params.update({f"{name}_l{i}": loc for i, (loc, _) in enumerate(pairs)})
+        params.update({f"{name}_k{i}": key for i, (_, key) in enumerate(pairs)})
+        values = ", ".join(f"(:{name}_l{i}, :{name}_k{i})" for i in range(len(pairs)))
+        branch[name] = f"AND (location_key, k_{name}) IN ({values})" if pairs else "AND 1 = 0"
+    return where, branch, params
+
+def delete_rollup_cells(conn, table, scope):
+    """Xóa các ô sắp tính lại (ô không còn dòng Fact hợp lệ nào sẽ không còn số liệu cũ)."""
+    locations, cells = scope
+    for g in ROLLUP_GRAINS:
+        name = g['grain']
+        if g['cell']:
+            for start in range(0, len(cells[name]), CELL_QUERY_BATCH):
+                pairs = cells[name][start:start + CELL_QUERY_BATCH]
+                values = ", ".join(f"(:l{i}, :k{i})" for i in range(len(pairs)))
+                params = {f"l{i}": loc for i, (loc, _) in enumerate(pairs)}
+                params.update({f"k{i}": key for i, (_, key) in enumerate(pairs)})
+                conn.execute(text(f"DELETE FROM {table} WHERE grain = :g AND (location_key, grain_key) IN ({values})"),
+                             {"g": name, **params})
+        else:
+            params = {f"loc{i}": key for i, key in enumerate(locations)}
+            in_list = ", ".join(f":loc{i}" for i in range(len(locations)))
+            conn.execute(text(f"DELETE FROM {table} WHERE grain = :g AND location_key IN ({in_list})"),
+                         {"g": name, **params})
+
+def rollup_cube_pushdown(dm_engine, table, scope=None):
+    """
+    Engine sql: CTE 'base' được MySQL materialize 1 lần (1 lần quét Fact), mỗi grain là
+    1 nhánh GROUP BY trên base, gộp bằng UNION ALL (tương đương GROUPING SETS).
+    """
+    where, branch, params = rollup_filters(scope)
+    branches = "\n            UNION ALL\n".join(f"""
+            SELECT '{g['grain']}', k_{g['grain']}, location_key,
+                AVG(max_temp_c), AVG(min_temp_c), AVG(avg_temp_c),
+                SUM(is_rainy_day), COUNT(DISTINCT date_sk)
+            FROM base WHERE k_{g['grain']} IS NOT NULL {branch[g['grain']]}
+            GROUP BY k_{g['grain']}, location_key""" for g in ROLLUP_GRAINS)
+    insert, upsert = rollup_upsert_sql(table)
+    sql = f"""
+        {insert}
+        SELECT * FROM (
+            WITH base AS ({rollup_base_sql(where)})
+            {branches}
+        ) AS rollup_rows
+        {upsert}
+    """
+    with dm_engine.begin() as conn:
+        if scope is not None:
+            delete_rollup_cells(conn, table, scope)
+        return conn.execute(text(sql), params).rowcount
+
+def rollup_cube_pandas(wh_engine, dm_engine, table, scope=None):
+    """Engine pandas: đọc base 1 lần, groupby từng grain, upsert bằng 1 lệnh executemany."""
+    where, _, params = rollup_filters(scope)
+    base = pd.read_sql(text(rollup_base_sql(where)), wh_engine, params=params)
+    frames = []
+    for g in ROLLUP_GRAINS:
+        key = f"k_{g['grain']}"
+        rows = base.dropna(subset=[key]).astype({key: str})
+        if scope is not None and g['cell']:
+            cells = pd.DataFrame(scope[1][g['grain']], columns=['location_key', key], dtype=object)
+            rows = rows.merge(cells, on=['location_key', key])
+        cube = rows.groupby([key, 'location_key']).agg(
             avg_max_temp_c=('max_temp_c', 'mean'),
             avg_min_temp_c=('min_temp_c', 'mean'),
-            avg_temp_c=('avg_temp_c', 'mean'), 
+            avg_temp_c=('avg_temp_c', 'mean'),
             total_rainy_days=('is_rainy_day', 'sum'),
             total_forecast_days=('date_sk', 'nunique')
-        ).reset_index()
-
-        log("P3", f"Load {len(df_monthly_city)} dòng vào {AGGREGATE_MART_TABLE}", "INFO")
-
-        with dm_engine.connect() as conn:
-            for _, row in df_monthly_city.iterrows():
-                sql = text(f"""
-                    INSERT INTO {AGGREGATE_MART_TABLE} 
-                    (month_sk, location_key, avg_max_temp_c, avg_min_temp_c, avg_temp_c, total_rainy_days, total_forecast_days)
-                    VALUES (:ms, :lk, :avg_max, :avg_min, :avg_t, :rain, :total)
-                    ON DUPLICATE KEY UPDATE
-                        avg_max_temp_c=VALUES(avg_max_temp_c), 
-                        avg_min_temp_c=VALUES(avg_min_temp_c), 
-                        avg_temp_c=VALUES(avg_temp_c),
-                        total_rainy_days=VALUES(total_rainy_days),
-                        total_forecast_days=VALUES(total_forecast_days),
-                        last_updated=NOW()
-                """)
-                conn.execute(sql, {
-                    'ms': row['month_sk'], 'lk': row['location_key'],
-                    'avg_max': row['avg_max_temp_c'], 'avg_min': row['avg_min_temp_c'],
-                    'avg_t': row['avg_temp_c'], 'rain': row['total_rainy_days'],
-                    'total': row['total_forecast_days']
-                })
-            conn.commit()
-        log("P3", f"Hoàn tất load {AGGREGATE_MART_TABLE}.", "SUCCESS")
+        ).reset_index().rename(columns={key: 'grain_key'})
+        frames.append(cube.assign(grain=g['grain']))
+    cube = pd.concat(frames, ignore_index=True)
+
+    insert, upsert = rollup_upsert_sql(table)
+    columns = ['grain', 'grain_key', 'location_key'] + ROLLUP_MEASURES
+    sql = text(f"{insert} VALUES ({', '.join(f':{col}' for col in columns)}) {upsert}")
+    with dm_engine.begin() as conn:
+        if scope is not None:
+            delete_rollup_cells(conn, table, scope)
+        if not cube.empty:
+            conn.execute(sql, cube[columns].to_dict(orient='records'))
+    return len(cube)
+
+def refresh_rollup_cube(wh_engine, dm_engine, watermark, publisher):
+    """
+    Lần đầu (chưa có watermark): tính toàn bộ cube.
+    Incremental: grain week/month/year chỉ tính lại các ô có dòng Fact đổi từ watermark;
+    day_type/holiday trải trên toàn bộ lịch sử nên được tính lại đầy đủ cho các địa điểm đó.
+    """
+    scope = None
+    if watermark is not None:
+        scope = rollup_scope(wh_engine, watermark)
+        if not scope[0]:
+            log("P2", f"{ROLLUP_MART_TABLE}: không có địa điểm nào cần tính lại.", "INFO")
+            return
+        cells = sum(len(pairs) for pairs in scope[1].values())
+        log("P2", f"Tính lại {cells} ô theo thời gian của {len(scope[0])} địa điểm.", "INFO")
+
+    grains = ", ".join(g['grain'] for g in ROLLUP_GRAINS)
+    log("P2", f"Tính rollup cube ({grains}, engine={DM_AGGREGATE_ENGINE})...", "INFO")
+    table = publisher.target(ROLLUP_MART_TABLE)
+    if DM_AGGREGATE_ENGINE == "sql":
+        affected = rollup_cube_pushdown(dm_engine, table, scope)
+    else:
+        affected = rollup_cube_pandas(wh_engine, dm_engine, table, scope)
+    log("P3", f"Hoàn tất {ROLLUP_MART_TABLE} ({affected} dòng bị ảnh hưởng).", "SUCCESS")
+
+# ==============================================================================
+# MAIN
+# ==============================================================================
+def main_load_data_mart():
+    log("START", f"Bắt đầu quy trình ETL Data Mart (mode={DM_REFRESH_MODE}, publish={DM_PUBLISH_MODE})...", "INFO")
+
+    wh_engine = get_engine(WH_DB_NAME) 
+    dm_engine = get_engine(os.getenv("DM_DB_NAME"), pool_size=max(1, DM_LOAD_WORKERS)) 
+    # Các bảng Data Mart được tạo bởi: python migrations.py mart
+    require_schema(dm_engine, "mart")
+
+    if DM_PUBLISH_MODE == "shadow":
+        # incremental chỉ ghi phần thay đổi nên shadow phải chép sẵn dữ liệu hiện tại
+        publisher = ShadowPublisher(dm_engine, seed=DM_REFRESH_MODE == "incremental")
+        if publisher.seed:
+            log("START", "incremental + shadow: mỗi mart có thay đổi được chép đầy đủ sang shadow.", "WARNING")
+    else:
+        publisher = InPlacePublisher()
+
+    try:
+        # --- [P1] EXTRACT ---
+        with wh_engine.connect() as conn:
+            marts = load_mart_catalog(conn, WH_DB_NAME)
+        mart_names = [info['table'] for info in marts.values()] + [AGGREGATE_MART_TABLE, ROLLUP_MART_TABLE]
+        watermarks = read_watermarks(dm_engine) if DM_REFRESH_MODE == "incremental" else {}
+        high_water = fact_high_water(wh_engine)
+
+        # Chỉ đọc các dòng từ watermark cũ nhất trong các mart (mart chưa có watermark -> đọc hết)
+        since = [watermarks.get(name) for name in mart_names]
+        if None in since:
+            df_all = extract_fact(wh_engine)
+        else:
+            # >= : đọc lại các dòng đúng bằng mốc cũ (cùng giây) để không sót, upsert nên không trùng
+            df_all = extract_fact(wh_engine, "AND f.updated_at >= :since AND f.updated_at <= :hw",
+                                  {"since": min(since), "hw": high_water})
+        log("P1", f"Extract: Đã lấy {len(df_all)} dòng từ Fact Table.", "INFO")
+
+        if df_all.empty:
+            log("P1", "Không có dòng Fact mới. Kết thúc.", "WARNING")
+            return
+
+        # --- [P2] TRANSFORM --- (giữ df_fact chưa lọc để tìm các ô aggregate bị ảnh hưởng)
+        df_fact = df_all
+        df_all = prepare_fact_frame(df_fact)
+
+        # --- LOAD ---
+        load_detail_marts(dm_engine, df_fact, df_all, watermarks, marts, publisher)
+        refresh_monthly_summary(wh_engine, dm_engine, df_fact, df_all, watermarks.get(AGGREGATE_MART_TABLE), publisher)
+        refresh_rollup_cube(wh_engine, dm_engine, watermarks.get(ROLLUP_MART_TABLE), publisher)
+
+        # --- PUBLISH --- (mode shadow: 1 lệnh RENAME TABLE cho mọi mart đã dựng lại)
+        publisher.publish()
+
+        # Ghi watermark cho mọi mart (cả ở mode full, để lần incremental sau bắt đầu từ đây)
+        save_watermarks(dm_engine, mart_names, high_water)
 
         log("END", "QUY TRÌNH DATA MART HOÀN TẤT!", "SUCCESS")
 
     except Exception as e:
         log("ERROR", f"Lỗi ETL Tổng quát: {e}", "ERROR")
+        publisher.discard()
         sys.exit(1)
     finally:
         if 'wh_engine' in locals(): wh_engine.dispose()
         if 'dm_engine' in locals(): dm_engine.dispose()
 
 if __name__ == "__main__":
-    main_load_data_mart()
\ No newline at end of file
+    main_load_data_mart()
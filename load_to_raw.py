@@ -2,137 +2,351 @@
 import pandas as pd
 import os
 import sqlalchemy
-from sqlalchemy import text
+from sqlalchemy import text, bindparam
 from dotenv import load_dotenv
+from batch_log import start_batch, mark_success, mark_failed
+from batch_partitions import prepare_batch, release_batch
+from migrations import require_schema
+from extract_to_file import read_extract_text
 import sys
-import glob
+import csv
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 load_dotenv()
 
 # Config
 RAW_TABLE = os.getenv("RAW_TABLE_NAME", "raw_weather_forecast")
 OUTPUT_DIR = os.getenv("OUTPUT_DIR")
+# insert: pandas to_sql (mặc định) | bulk: LOAD DATA LOCAL INFILE (chỉ áp dụng cho CSV)
+RAW_LOAD_MODE = os.getenv("RAW_LOAD_MODE", "insert").lower()
+# Bảng ghi nhận các file đã nạp (tên file + checksum → batch_id)
+MANIFEST_TABLE = os.getenv("RAW_MANIFEST_TABLE", "raw_file_manifest")
+RAW_LOAD_WORKERS = int(os.getenv("RAW_LOAD_WORKERS", "4"))
+# Số tên file tối đa trong 1 câu truy vấn manifest
+MANIFEST_QUERY_BATCH = 500
 
 if not OUTPUT_DIR:
     print("Thiếu OUTPUT_DIR trong .env!")
     sys.exit(1)
 
+# File đã ghi vào manifest được chuyển sang thư mục này, lần chạy sau không phải liệt kê/stat lại
+LOADED_DIR = os.getenv("RAW_LOADED_DIR") or os.path.join(OUTPUT_DIR, "loaded")
+
 engine = sqlalchemy.create_engine(
     f"mysql+pymysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@"
     f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}",
-    pool_pre_ping=True
+    pool_pre_ping=True,
+    connect_args={"local_infile": True}  # Cho phép LOAD DATA LOCAL INFILE
 )
 
-def get_next_batch_id():
-    with engine.connect() as conn:
-        result = conn.execute(text("SELECT COALESCE(MAX(batch_id), 0) + 1 FROM batch_log"))
-        return result.scalar()
+# Đổi tên các cột của file extract cho khớp với bảng raw
+RENAME_MAP = {
+    'date': 'date_time',
+    'min_temp': 'min_temp_c', 
+    'max_temp': 'max_temp_c'       
+}
 
-def log_start(batch_id, file_name, loc_name="", loc_key=""):
-    with engine.begin() as conn:
-        conn.execute(text("""
-            INSERT INTO batch_log 
-            (batch_id, source_system, source_endpoint, source_file, location_name, location_key, start_time, status)
-            VALUES (:bid, 'STAGING', 'load_to_raw', :file, :loc_name, :loc_key, NOW(), 'RUNNING')
-        """), {"bid": batch_id, "file": os.path.basename(file_name), "loc_name": loc_name, "loc_key": loc_key})
+# Những cột có trong bảng raw (các cột khác trong file sẽ bị bỏ qua)
+VALID_COLUMNS = [
+    'date_time', 'location_name', 'location_key', 'min_temp_c', 'max_temp_c',
+    'day_icon', 'day_phrase', 'day_precip', 'day_precip_type', 'day_precip_intensity',
+    'night_icon', 'night_phrase', 'night_precip', 'night_precip_type', 'night_precip_intensity',
+    'source', 'mobile_link', 'link'
+]
 
-def log_success(batch_id, count):
-    with engine.begin() as conn:
-        conn.execute(text("""
-            UPDATE batch_log SET status='SUCCESS', total_records=:c, success_count=:c, end_time=NOW()
-            WHERE batch_id=:bid
-        """), {"bid": batch_id, "c": count})
+RAW_DTYPE = {
+    'date_time': sqlalchemy.VARCHAR(50),
+    'location_name': sqlalchemy.VARCHAR(100),
+    'location_key': sqlalchemy.VARCHAR(50),
+    'min_temp_c': sqlalchemy.VARCHAR(20),
+    'max_temp_c': sqlalchemy.VARCHAR(20),
+    'day_icon': sqlalchemy.VARCHAR(10),
+    'day_phrase': sqlalchemy.VARCHAR(255),
+    'day_precip': sqlalchemy.VARCHAR(10),
+    'day_precip_type': sqlalchemy.VARCHAR(50),
+    'day_precip_intensity': sqlalchemy.VARCHAR(50),
+    'night_icon': sqlalchemy.VARCHAR(10),
+    'night_phrase': sqlalchemy.VARCHAR(255),
+    'night_precip': sqlalchemy.VARCHAR(10),
+    'night_precip_type': sqlalchemy.VARCHAR(50),
+    'night_precip_intensity': sqlalchemy.VARCHAR(50),
+    'source': sqlalchemy.VARCHAR(100),
+    'mobile_link': sqlalchemy.VARCHAR(500),
+    'link': sqlalchemy.VARCHAR(500),
+    'batch_id': sqlalchemy.BIGINT()
+}
 
-def log_error(batch_id, count, msg):
-    with engine.begin() as conn:
-        conn.execute(text("""
-            UPDATE batch_log SET status='FAILED', total_records=:c, end_time=NOW(), 
-            error_message=:msg WHERE batch_id=:bid
-        """), {"bid": batch_id, "c": count, "msg": str(msg)[:2000]})
+def read_extract_file(path):
+    """
+    Đọc file extract (.csv hoặc .parquet) thành DataFrame toàn chuỗi.
+    2 định dạng cho ra cùng 1 chuỗi trong bảng raw (xem extract_to_file.read_extract_text).
+    """
+    return read_extract_text(path)
 
-def main():
-    csv_files = glob.glob(os.path.join(OUTPUT_DIR, "*.csv"))
-    if not csv_files:
-        print(f"Không tìm thấy file CSV trong: {OUTPUT_DIR}")
-        sys.exit(1)
-
-    latest_file = max(csv_files, key=os.path.getmtime)
-    print(f"Đang xử lý file: {latest_file}")
-
-    # Đọc CSV
-    df = pd.read_csv(latest_file, dtype=str, engine='python', sep=None)
-    df.columns = df.columns.str.strip()
+def load_with_insert(path, batch_id):
+    """Đọc file bằng pandas rồi INSERT nhiều dòng (to_sql). Trả về số dòng đã nạp."""
+    df = read_extract_file(path)
 
     if df.empty:
-        print("File CSV rỗng!")
-        sys.exit(1)
+        print("File extract rỗng!")
+        return 0
 
     print(f"Đã đọc {len(df)} dòng")
 
     # 1. ĐỔI TÊN CÁC CỘT CHO KHỚP VỚI BẢNG RAW
-    rename_map = {
-        'date': 'date_time',
-        'min_temp': 'min_temp_c', 
-        'max_temp': 'max_temp_c'       
-    }
-    df = df.rename(columns=rename_map)
+    df = df.rename(columns=RENAME_MAP)
 
     # 2. Chỉ giữ lại những cột có trong bảng raw (tránh lỗi cột thừa)
-    valid_columns = [
-        'date_time', 'location_name', 'location_key', 'min_temp_c', 'max_temp_c',
-        'day_icon', 'day_phrase', 'day_precip', 'day_precip_type', 'day_precip_intensity',
-        'night_icon', 'night_phrase', 'night_precip', 'night_precip_type', 'night_precip_intensity',
-        'source', 'mobile_link', 'link'
-    ]
-    df = df[[col for col in valid_columns if col in df.columns]]
+    df = df[[col for col in VALID_COLUMNS if col in df.columns]]
 
     # 3. Thêm batch_id
-    batch_id = get_next_batch_id()
     df['batch_id'] = batch_id
 
-    # 4. Log bắt đầu
-    loc_name = df['location_name'].iloc[0] if 'location_name' in df.columns else "Unknown"
-    loc_key = df['location_key'].iloc[0] if 'location_key' in df.columns else "Unknown"
-    log_start(batch_id, latest_file, loc_name, loc_key)
+    df.to_sql(
+        name=RAW_TABLE,
+        con=engine,
+        if_exists='append',
+        index=False,
+        method='multi',
+        chunksize=1000,
+        dtype=RAW_DTYPE
+    )
+    return len(df)
 
-    # 5. Load vào bảng raw
+def load_with_bulk(path, batch_id):
+    """
+    Nạp file CSV thẳng vào MySQL bằng LOAD DATA LOCAL INFILE (server tự parse).
+    Cột được ánh xạ theo header của file qua RENAME_MAP / VALID_COLUMNS,
+    chuỗi rỗng được đổi thành NULL giống như khi đọc bằng pandas.
+    Trả về số dòng đã nạp.
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        header_line = f.readline()
+    header = [RENAME_MAP.get(col.strip(), col.strip()) for col in next(csv.reader([header_line]))]
+    line_end = '\\r\\n' if header_line.endswith('\r\n') else '\\n'
+
+    variables = [f"@c{i}" for i in range(len(header))]
+    assignments = [
+        f"{col} = NULLIF({var}, '')"
+        for col, var in zip(header, variables) if col in VALID_COLUMNS
+    ]
+
+    sql = text(f"""
+        LOAD DATA LOCAL INFILE :path
+        INTO TABLE {RAW_TABLE}
+        CHARACTER SET utf8mb4
+        FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY ''
+        LINES TERMINATED BY '{line_end}'
+        IGNORE 1 LINES
+        ({', '.join(variables)})
+        SET {', '.join(assignments)}, batch_id = :bid
+    """)
+    with engine.begin() as conn:
+        result = conn.execute(sql, {"path": os.path.abspath(path), "bid": batch_id})
+    return result.rowcount
+
+def load_file(path):
+    """
+    Nạp 1 file extract vào bảng raw với 1 batch_id mới, ghi log vào batch_log.
+    RAW_LOAD_MODE=bulk dùng LOAD DATA LOCAL INFILE cho file CSV, mặc định dùng INSERT.
+    Trả về (batch_id, số dòng).
+    """
+    # Lấy tên/mã địa điểm của dòng đầu tiên để ghi log
+    loc_name, loc_key = "Unknown", "Unknown"
+    if path.endswith(".csv"):
+        with open(path, newline='', encoding='utf-8') as f:
+            first_row = next(csv.DictReader(f), None) or {}
+        loc_name = first_row.get('location_name', loc_name)
+        loc_key = first_row.get('location_key', loc_key)
+
+    # Cấp batch_id (nguyên tử) + ghi log bắt đầu trong 1 transaction
+    batch_id = start_batch(engine, 'load_to_raw', os.path.basename(path), loc_name, loc_key)
+
+    use_bulk = RAW_LOAD_MODE == "bulk" and path.endswith(".csv")
+    mode = "LOAD DATA" if use_bulk else "INSERT"
+    count = 0
     try:
-        df.to_sql(
-            name=RAW_TABLE,
-            con=engine,
-            if_exists='append',
-            index=False,
-            method='multi',
-            chunksize=1000,
-            dtype={
-                'date_time': sqlalchemy.VARCHAR(50),
-                'location_name': sqlalchemy.VARCHAR(100),
-                'location_key': sqlalchemy.VARCHAR(50),
-                'min_temp_c': sqlalchemy.VARCHAR(20),
-                'max_temp_c': sqlalchemy.VARCHAR(20),
-                'day_icon': sqlalchemy.VARCHAR(10),
-                'day_phrase': sqlalchemy.VARCHAR(255),
-                'day_precip': sqlalchemy.VARCHAR(10),
-                'day_precip_type': sqlalchemy.VARCHAR(50),
-                'day_precip_intensity': sqlalchemy.VARCHAR(50),
-                'night_icon': sqlalchemy.VARCHAR(10),
-                'night_phrase': sqlalchemy.VARCHAR(255),
-                'night_precip': sqlalchemy.VARCHAR(10),
-                'night_precip_type': sqlalchemy.VARCHAR(50),
-                'night_precip_intensity': sqlalchemy.VARCHAR(50),
-                'source': sqlalchemy.VARCHAR(100),
-                'mobile_link': sqlalchemy.VARCHAR(500),
-                'link': sqlalchemy.VARCHAR(500),
-                'batch_id': sqlalchemy.BIGINT()
-            }
-        )
-        log_success(batch_id, len(df))
-        print(f"HOÀN TẤT! Batch #{batch_id} → {len(df)} bản ghi đã vào {RAW_TABLE}")
+        # Bảng raw phân vùng theo batch_id: partition của batch đã được dựng sẵn
+        prepare_batch(engine, RAW_TABLE, batch_id)
+
+        start = time.perf_counter()
+        count = load_with_bulk(path, batch_id) if use_bulk else load_with_insert(path, batch_id)
+        elapsed = time.perf_counter() - start
+
+        mark_success(engine, batch_id, count)
+        print(f"HOÀN TẤT! Batch #{batch_id} → {count} bản ghi đã vào {RAW_TABLE}")
+        print(f"[{mode}] {elapsed:.2f}s → {count / elapsed if elapsed else 0:,.0f} dòng/giây")
+        return batch_id, count
 
     except Exception as e:
-        log_error(batch_id, len(df), str(e))
+        mark_failed(engine, batch_id, str(e), total_records=count)
+        release_batch(engine, RAW_TABLE, batch_id)  # Không để lại dữ liệu nạp dở
         print(f"LOAD THẤT BẠI: {e}")
         raise
 
+# ============ MANIFEST ============
+def file_checksum(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def scan_extract_files():
+    """
+    Liệt kê file extract trong OUTPUT_DIR: {tên file: (đường dẫn, size, mtime)}.
+    Chỉ xét file ở cấp trên cùng: file đã nạp nằm trong LOADED_DIR nên không bị quét lại.
+    """
+    files = {}
+    with os.scandir(OUTPUT_DIR) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith((".csv", ".parquet")):
+                st = entry.stat()
+                files[entry.name] = (entry.path, st.st_size, st.st_mtime)
+    return files
+
+def file_stem(path):
+    """Tên file bỏ đuôi (.csv/.parquet của cùng 1 lượt extract có chung stem)."""
+    return os.path.splitext(os.path.basename(path))[0]
+
+def query_manifest(conn, column, values):
+    """Các dòng manifest có column thuộc values (truy vấn theo lô, không đọc cả bảng)."""
+    sql = text(f"""
+        SELECT file_name, file_stem, file_size, file_mtime, checksum, batch_id, row_count
+        FROM {MANIFEST_TABLE} WHERE {column} IN :values
+    """).bindparams(bindparam("values", expanding=True))
+    values = sorted(values)
+    rows = []
+    for start in range(0, len(values), MANIFEST_QUERY_BATCH):
+        rows += conn.execute(sql, {"values": values[start:start + MANIFEST_QUERY_BATCH]}).fetchall()
+    return rows
+
+def find_pending_files():
+    """
+    So sánh thư mục với manifest, trả về các nhóm file chưa nạp.
+    Mỗi nhóm là list (đường dẫn, checksum) của cùng 1 lượt extract, file nên nạp đứng đầu.
+    File có (tên, size, mtime) đã có trong manifest được bỏ qua mà không cần đọc nội dung;
+    chỉ file mới/thay đổi mới phải tính checksum. File có file "anh em" (cùng stem, khác đuôi)
+    đã nạp ở lần chạy trước chỉ được ghi vào manifest, không nạp lại.
+    File đã có trong manifest được chuyển sang LOADED_DIR.
+    """
+    files = scan_extract_files()
+    if not files:
+        return []
+    with engine.connect() as conn:
+        rows = query_manifest(conn, "file_name", files)
+    seen_stat = {(r.file_name, r.file_size, r.file_mtime) for r in rows}
+    seen_checksum = {(r.file_name, r.checksum) for r in rows}
+
+    pending, already_loaded = [], []
+    for name, (path, size, mtime) in sorted(files.items(), key=lambda item: item[1][2]):
+        if (name, size, mtime) in seen_stat:
+            already_loaded.append((path, None))
+            continue
+        checksum = file_checksum(path)
+        if (name, checksum) in seen_checksum:
+            already_loaded.append((path, checksum))
+            continue
+        pending.append((path, checksum))
+    # File đã nạp từ trước khi có LOADED_DIR: dọn khỏi thư mục để lần sau không quét lại
+    if already_loaded:
+        archive_loaded(already_loaded)
+    if not pending:
+        return []
+
+    # EXTRACT_FORMAT=both tạo 2 file cùng tên (.csv và .parquet): chỉ nạp 1 file
+    preferred = ".csv" if RAW_LOAD_MODE == "bulk" else ".parquet"
+    by_stem = {}
+    for path, checksum in pending:
+        by_stem.setdefault(file_stem(path), []).append((path, checksum))
+
+    # 2 file có thể được chốt ở 2 phía của 1 lượt nạp: file còn lại đã nằm trong manifest
+    with engine.connect() as conn:
+        loaded_siblings = {}
+        for r in query_manifest(conn, "file_stem", by_stem):
+            loaded_siblings.setdefault(r.file_stem, []).append(r)
+
+    groups = []
+    for stem, siblings in by_stem.items():
+        names = {os.path.basename(path) for path, _ in siblings}
+        loaded = [r for r in loaded_siblings.get(stem, []) if r.file_name not in names]
+        if loaded:
+            record_loaded(siblings, loaded[0].batch_id, loaded[0].row_count)
+            archive_loaded(siblings)
+            print(f"Bỏ qua {', '.join(sorted(names))}: đã nạp qua {loaded[0].file_name} (batch #{loaded[0].batch_id})")
+            continue
+        siblings.sort(key=lambda item: not item[0].endswith(preferred))
+        groups.append(siblings)
+    return groups
+
+def record_loaded(files, batch_id, count):
+    """Ghi các file vừa nạp vào manifest."""
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            INSERT INTO {MANIFEST_TABLE} (file_name, file_stem, checksum, file_size, file_mtime, batch_id, row_count)
+            VALUES (:name, :stem, :checksum, :size, :mtime, :bid, :cnt)
+            ON DUPLICATE KEY UPDATE file_size = VALUES(file_size), file_mtime = VALUES(file_mtime),
+                batch_id = VALUES(batch_id), row_count = VALUES(row_count), loaded_at = NOW()
+        """), [
+            {"name": os.path.basename(path), "stem": file_stem(path), "checksum": checksum, "size": os.path.getsize(path),
+             "mtime": os.path.getmtime(path), "bid": batch_id, "cnt": count}
+            for path, checksum in files
+        ])
+
+def archive_loaded(files):
+    """
+    Chuyển các file đã ghi vào manifest sang LOADED_DIR.
+    Lỗi khi chuyển chỉ cảnh báo: file còn lại sẽ được manifest bỏ qua ở lần chạy sau.
+    """
+    os.makedirs(LOADED_DIR, exist_ok=True)
+    for path, _ in files:
+        try:
+            os.replace(path, os.path.join(LOADED_DIR, os.path.basename(path)))
+        except OSError as e:
+            print(f"Không chuyển được {path} vào {LOADED_DIR}: {e}")
+
+def load_file_group(siblings):
+    """Nạp file đầu tiên trong nhóm, ghi cả nhóm vào manifest với cùng batch_id."""
+    path = siblings[0][0]
+    print(f"Đang xử lý file: {path}")
+    batch_id, count = load_file(path)
+    record_loaded(siblings, batch_id, count)
+    archive_loaded(siblings)
+    return batch_id, count
+
+def main():
+    require_schema(engine, "staging")
+
+    if "--mark-loaded" in sys.argv:
+        # Đánh dấu toàn bộ file hiện có là đã nạp (dùng 1 lần khi bắt đầu dùng manifest)
+        groups = find_pending_files()
+        for siblings in groups:
+            record_loaded(siblings, None, None)
+            archive_loaded(siblings)
+        print(f"Đã đánh dấu {sum(len(g) for g in groups)} file là đã nạp.")
+        return
+
+    groups = find_pending_files()
+    if not groups:
+        print(f"Không có file CSV/Parquet mới trong: {OUTPUT_DIR}")
+        return
+
+    print(f"Tìm thấy {len(groups)} file mới, nạp với {RAW_LOAD_WORKERS} luồng song song")
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, RAW_LOAD_WORKERS)) as executor:
+        futures = {executor.submit(load_file_group, siblings): siblings[0][0] for siblings in groups}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                failed += 1  # Lỗi đã được ghi vào batch_log, file sẽ được nạp lại ở lần chạy sau
+
+    if failed:
+        print(f"Có {failed}/{len(groups)} file nạp thất bại.")
+        sys.exit(1)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
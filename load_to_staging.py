@@ -1,8 +1,10 @@
 import os
 import sys
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, text, bindparam
 from sqlalchemy.exc import SQLAlchemyError
+from batch_partitions import release_batch
+from migrations import require_schema
 
 # --- Cấu hình kết nối (Tương tự code trước) ---
 def get_staging_engine():
@@ -25,8 +27,62 @@ def get_staging_engine():
         print(f"❌ Lỗi tạo engine: {e}")
         return None
 
-# --- Câu lệnh SQL Upsert ---
-UPSERT_SQL = text("""
+# --- Các cột so sánh thay đổi (row hash) ---
+# Không tính batch_id / created_at: cùng nội dung ở batch khác vẫn là "không đổi"
+HASH_COLUMNS = [
+    'location_name', 'min_temp_c', 'max_temp_c',
+    'day_icon', 'day_phrase', 'day_precip', 'day_precip_type', 'day_precip_intensity',
+    'night_icon', 'night_phrase', 'night_precip', 'night_precip_type', 'night_precip_intensity',
+    'source', 'mobile_link', 'link'
+]
+
+ROW_HASH_EXPR = "MD5(CONCAT_WS('|', " + ", ".join(
+    f"COALESCE(CAST(t.{col} AS CHAR), '<NULL>')" for col in HASH_COLUMNS
+) + "))"
+
+# Mỗi khóa (location_key, date_time) chỉ lấy dòng của batch mới nhất, kèm row_hash
+LATEST_TRANSFORM_SQL = f"""
+    SELECT * FROM (
+        SELECT t.*, {ROW_HASH_EXPR} AS row_hash,
+            ROW_NUMBER() OVER (PARTITION BY t.location_key, t.date_time ORDER BY t.batch_id DESC) AS rn
+        FROM transform_weather_forecast t
+        WHERE t.batch_id IN :batch_ids
+    ) x WHERE x.rn = 1
+"""
+
+# --- Câu lệnh SQL: đếm / cập nhật dòng đổi nội dung / thêm dòng mới ---
+COUNT_SQL = text(f"SELECT COUNT(*) FROM ({LATEST_TRANSFORM_SQL}) t").bindparams(
+    bindparam("batch_ids", expanding=True))
+
+UPDATE_CHANGED_SQL = text(f"""
+UPDATE staging_weather_forecast s
+JOIN ({LATEST_TRANSFORM_SQL}) t
+    ON s.location_key = t.location_key AND s.date_time = t.date_time
+SET
+    s.batch_id = t.batch_id,
+    s.location_name = t.location_name,
+    s.min_temp_c = t.min_temp_c,
+    s.max_temp_c = t.max_temp_c,
+    s.day_icon = t.day_icon,
+    s.day_phrase = t.day_phrase,
+    s.day_precip = t.day_precip,
+    s.day_precip_type = t.day_precip_type,
+    s.day_precip_intensity = t.day_precip_intensity,
+    s.night_icon = t.night_icon,
+    s.night_phrase = t.night_phrase,
+    s.night_precip = t.night_precip,
+    s.night_precip_type = t.night_precip_type,
+    s.night_precip_intensity = t.night_precip_intensity,
+    s.source = t.source,
+    s.mobile_link = t.mobile_link,
+    s.link = t.link,
+    s.row_hash = t.row_hash,
+    s.is_update = 1,          -- is_update=TRUE
+    s.date_update = NOW()     -- date_update=Current Time
+WHERE NOT (s.row_hash <=> t.row_hash)  -- Bỏ qua dòng không đổi nội dung
+""").bindparams(bindparam("batch_ids", expanding=True))
+
+INSERT_NEW_SQL = text(f"""
 INSERT INTO staging_weather_forecast (
     batch_id, location_key, location_name, date_time,
     min_temp_c, max_temp_c, 
@@ -34,69 +90,28 @@ INSERT INTO staging_weather_forecast (
     night_icon, night_phrase, night_precip, night_precip_type, night_precip_intensity,
     source, mobile_link, link,
     created_at,
-    is_update, date_update
+    is_update, date_update, row_hash
 )
 SELECT 
-    batch_id, location_key, location_name, date_time,
-    min_temp_c, max_temp_c, 
-    day_icon, day_phrase, day_precip, day_precip_type, day_precip_intensity,
-    night_icon, night_phrase, night_precip, night_precip_type, night_precip_intensity,
-    source, mobile_link, link,
-    created_at,
-    0, NULL  -- is_update=FALSE (0), date_update=NULL
-FROM transform_weather_forecast
-ON DUPLICATE KEY UPDATE
-    batch_id = VALUES(batch_id),
-    location_name = VALUES(location_name),
-    min_temp_c = VALUES(min_temp_c),
-    max_temp_c = VALUES(max_temp_c),
-    day_icon = VALUES(day_icon),
-    day_phrase = VALUES(day_phrase),
-    day_precip = VALUES(day_precip),
-    day_precip_type = VALUES(day_precip_type),
-    day_precip_intensity = VALUES(day_precip_intensity),
-    night_icon = VALUES(night_icon),
-    night_phrase = VALUES(night_phrase),
-    night_precip = VALUES(night_precip),
-    night_precip_type = VALUES(night_precip_type),
-    night_precip_intensity = VALUES(night_precip_intensity),
-    source = VALUES(source),
-    mobile_link = VALUES(mobile_link),
-    link = VALUES(link),
-    is_update = 1,          -- is_update=TRUE
-    date_update = NOW();    -- date_update=Current Time
-""")
+    t.batch_id, t.location_key, t.location_name, t.date_time,
+    t.min_temp_c, t.max_temp_c, 
+    t.day_icon, t.day_phrase, t.day_precip, t.day_precip_type, t.day_precip_intensity,
+    t.night_icon, t.night_phrase, t.night_precip, t.night_precip_type, t.night_precip_intensity,
+    t.source, t.mobile_link, t.link,
+    t.created_at,
+    0, NULL, t.row_hash  -- is_update=FALSE (0), date_update=NULL
+FROM ({LATEST_TRANSFORM_SQL}) t
+LEFT JOIN staging_weather_forecast s
+    ON s.location_key = t.location_key AND s.date_time = t.date_time
+WHERE s.location_key IS NULL
+""").bindparams(bindparam("batch_ids", expanding=True))
 
-# --- Hàm đảm bảo Unique Key ---
-def ensure_unique_key(connection):
-    """
-    Kiểm tra và tạo Unique Key nếu chưa có. 
-    Cần thiết để ON DUPLICATE KEY UPDATE hoạt động đúng.
-    """
-    check_sql = text("""
-        SELECT COUNT(1) 
-        FROM information_schema.statistics 
-        WHERE table_schema = DATABASE() 
-          AND table_name = 'staging_weather_forecast' 
-          AND index_name = 'uq_forecast';
-    """)
-    
-    result = connection.execute(check_sql).scalar()
-    
-    if result == 0:
-        print("⚠️ Chưa có Unique Key. Đang tạo index 'uq_forecast'...")
-        try:
-            # Lưu ý: Dữ liệu hiện tại phải sạch (không trùng) thì lệnh này mới chạy được
-            connection.execute(text("""
-                ALTER TABLE staging_weather_forecast 
-                ADD UNIQUE KEY uq_forecast (location_key, date_time);
-            """))
-            print("✅ Đã tạo Unique Key thành công.")
-        except Exception as e:
-            print(f"❌ Không thể tạo Unique Key (có thể do dữ liệu đang bị trùng lặp): {e}")
-            raise e
-    else:
-        print("ℹ️ Unique Key 'uq_forecast' đã tồn tại.")
+# Batch đã transform xong = có trong transform nhưng raw đã được dọn
+READY_BATCHES_SQL = text("""
+SELECT DISTINCT t.batch_id FROM transform_weather_forecast t
+WHERE NOT EXISTS (SELECT 1 FROM raw_weather_forecast r WHERE r.batch_id = t.batch_id)
+ORDER BY t.batch_id
+""")
 
 # --- Main Script ---
 def run_etl_load_staging():
@@ -105,19 +120,34 @@ def run_etl_load_staging():
 
     print("🚀 Bắt đầu quá trình Load từ Transform -> Staging...")
     
+    # 1. Đảm bảo điều kiện tiên quyết (uq_forecast, row_hash) đã được migrate
+    require_schema(engine, "staging")
+
     try:
         with engine.connect() as conn:
-            # 1. Đảm bảo điều kiện tiên quyết
-            ensure_unique_key(conn)
-            
-            # 2. Thực thi Upsert
-            print("⏳ Đang thực thi lệnh UPSERT...")
-            result = conn.execute(UPSERT_SQL)
+            # 2. Lấy các batch đã transform xong
+            batch_ids = [row[0] for row in conn.execute(READY_BATCHES_SQL)]
+            if not batch_ids:
+                print("ℹ️ Không có batch mới trong transform_weather_forecast.")
+                return
+            print(f"📦 Các batch sẽ nạp: {batch_ids}")
+
+            # 3. Cập nhật dòng đổi nội dung, thêm dòng mới (cùng 1 transaction)
+            print("⏳ Đang so sánh row_hash và cập nhật staging...")
+            params = {"batch_ids": batch_ids}
+            total = conn.execute(COUNT_SQL, params).scalar()
+            updated = conn.execute(UPDATE_CHANGED_SQL, params).rowcount
+            inserted = conn.execute(INSERT_NEW_SQL, params).rowcount
             conn.commit()
             
-            # 3. Thông báo kết quả
-            print(f"✅ Hoàn tất! Số dòng bị ảnh hưởng (Inserted/Updated): {result.rowcount}")
-            # Lưu ý: MySQL trả về rowcount = 1 cho Insert, = 2 cho Update
+            # 4. Thông báo kết quả
+            unchanged = total - inserted - updated
+            print(f"✅ Hoàn tất! Thêm mới: {inserted} | Cập nhật: {updated} | Không đổi: {unchanged}")
+
+        # 5. Dọn các batch đã nạp khỏi transform (theo từng partition thay cho TRUNCATE)
+        for batch_id in batch_ids:
+            release_batch(engine, "transform_weather_forecast", batch_id)
+        print(f"🧹 Đã dọn {len(batch_ids)} batch khỏi transform_weather_forecast.")
             
     except SQLAlchemyError as e:
         print(f"❌ Lỗi SQL: {e}")
@@ -4,6 +4,8 @@ import glob
 import subprocess
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
+from migrations import require_schema
+from dump_manifest import load_manifest, file_checksum, open_decompressed_reader
 
 # 1. Cấu hình và Biến môi trường
 load_dotenv()
@@ -16,6 +18,39 @@ DB_WAREHOUSE = os.getenv("DB_WAREHOUSE_NAME")
 OUTPUT_DIR = os.getenv("OUTPUT_DUMP")
 FACT_TABLE = os.getenv("FACT_TABLE_NAME", "fact_weather_forecast")
 
+# dump: mysqldump + mysql restore (mặc định) | direct: chuyển thẳng staging -> warehouse
+TRANSFER_MODE = os.getenv("WAREHOUSE_TRANSFER_MODE", "dump").lower()
+# Staging DB (mặc định cùng server với Warehouse)
+STAGING_DB = os.getenv("DB_NAME")
+STAGING_HOST = os.getenv("STAGING_DB_HOST", DB_HOST)
+STAGING_PORT = os.getenv("STAGING_DB_PORT", DB_PORT)
+STAGING_USER = os.getenv("STAGING_DB_USER", DB_USER)
+STAGING_PASS = os.getenv("STAGING_DB_PASS", DB_PASS)
+TRANSFER_CHUNK_SIZE = int(os.getenv("WAREHOUSE_TRANSFER_CHUNK", "10000"))
+# Bảng đệm trong Warehouse khi Staging ở server khác (tạo bởi migrations.py)
+TRANSFER_TABLE = "transfer_weather_forecast"
+TRANSFER_COLUMNS = [
+    'location_key', 'date_time', 'min_temp_c', 'max_temp_c',
+    'day_icon', 'day_phrase', 'day_precip', 'day_precip_type', 'day_precip_intensity',
+    'night_icon', 'night_phrase', 'night_precip', 'night_precip_type', 'night_precip_intensity',
+    'source', 'mobile_link', 'link'
+]
+
+# Các file dump (theo manifest) đã được nạp vào Warehouse (tạo bởi migrations.py)
+RESTORE_LOG_TABLE = "dump_restore_log"
+# Phiên bản migration staging thêm cột forecast_date: dump xuất từ staging cũ hơn không có cột này
+FORECAST_DATE_STAGING_VERSION = 6
+# Biểu thức ngày dự báo khi bảng nguồn chưa có cột forecast_date (không dùng được index)
+FORECAST_DATE_FALLBACK = "DATE(s.date_time)"
+
+# Các cột được ghi đè khi dự báo (date_sk, location_key) đã có trong Fact
+FACT_UPDATE_COLUMNS = [
+    'date_time', 'min_temp_c', 'max_temp_c',
+    'day_icon', 'day_phrase', 'day_precip', 'day_precip_type', 'day_precip_intensity',
+    'night_icon', 'night_phrase', 'night_precip', 'night_precip_type', 'night_precip_intensity',
+    'source', 'mobile_link', 'link'
+]
+
 # Cấu hình đường dẫn tới mysql.exe (nếu chưa có trong PATH)
 # Tương tự như bài trước, nếu bạn dùng XAMPP/MySQL Server hãy chỉnh đường dẫn này
 MYSQL_EXE_PATH = os.getenv("MYSQL_PATH")
@@ -53,6 +88,7 @@ def restore_dump_to_warehouse(dump_file):
     """
     Dùng command line 'mysql' để nạp file dump vào Warehouse.
     Điều này sẽ tạo bảng 'staging_weather_forecast' TẠI Warehouse DB.
+    File nén (.sql.gz / .sql.zst) được giải nén và stream thẳng vào stdin của mysql.
     """
     print("⏳ Đang nạp dữ liệu từ Dump vào Warehouse (Staging tạm)...")
     
@@ -69,8 +105,16 @@ def restore_dump_to_warehouse(dump_file):
     env_vars['MYSQL_PWD'] = DB_PASS
 
     try:
-        with open(dump_file, 'r') as input_file:
-            subprocess.run(cmd, env=env_vars, stdin=input_file, check=True)
+        with open_decompressed_reader(dump_file) as input_file:
+            proc = subprocess.Popen(cmd, env=env_vars, stdin=subprocess.PIPE)
+            try:
+                for chunk in iter(lambda: input_file.read(1024 * 1024), b''):
+                    proc.stdin.write(chunk)
+            finally:
+                proc.stdin.close()
+                returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
         print("✅ Đã nạp xong file Dump vào Warehouse.")
         return True
     except FileNotFoundError:
@@ -79,61 +123,81 @@ def restore_dump_to_warehouse(dump_file):
     except subprocess.CalledProcessError as e:
         print(f"❌ Lỗi khi chạy lệnh mysql restore: {e}")
         return False
+    except BrokenPipeError:
+        print("❌ Lệnh mysql restore đã dừng giữa chừng.")
+        proc.wait()
+        return False
 
-def create_fact_table_if_not_exists(engine):
-    """Tạo bảng Fact với khóa ngoại liên kết Dim"""
-    # SỬA: Đổi date_key thành date_sk để khớp với bảng dim_date
-    sql = f"""
-    CREATE TABLE IF NOT EXISTS {FACT_TABLE} (
-        id_fact BIGINT AUTO_INCREMENT PRIMARY KEY,
-        
-        -- Khóa ngoại (Foreign Keys)
-        date_sk INT NOT NULL,               -- <-- SỬA TÊN CỘT NÀY (date_key -> date_sk)
-        location_key VARCHAR(50) NOT NULL,  
-        
-        -- Các trường dữ liệu từ Staging
-        date_time DATETIME,
-        min_temp_c FLOAT DEFAULT 0,
-        max_temp_c FLOAT DEFAULT 0,
-        day_icon INT DEFAULT 0,
-        day_phrase VARCHAR(100),
-        day_precip BOOLEAN DEFAULT FALSE,
-        day_precip_type VARCHAR(20), 
-        day_precip_intensity VARCHAR(20),
-        night_icon INT DEFAULT 0,
-        night_phrase VARCHAR(100),
-        night_precip BOOLEAN DEFAULT FALSE,
-        night_precip_type VARCHAR(20) ,
-        night_precip_intensity VARCHAR(20),
-        source VARCHAR(100),
-        mobile_link VARCHAR(500), 
-        link VARCHAR(500),
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        
-        -- Định nghĩa rằng buộc (Constraints)
-        CONSTRAINT fk_fact_date FOREIGN KEY (date_sk) REFERENCES dim_date(date_sk), -- <-- SỬA THAM CHIẾU NÀY
-        CONSTRAINT fk_fact_location FOREIGN KEY (location_key) REFERENCES dim_location(location_key)
-    ) ENGINE=InnoDB;
+def find_pending_dumps(engine):
     """
-    try:
-        with engine.connect() as conn:
-            conn.execute(text(sql))
-            print(f"✅ Đã kiểm tra/tạo bảng '{FACT_TABLE}'.")
-    except Exception as e:
-        print(f"❌ Lỗi tạo bảng Fact: {e}")
-        sys.exit(1)
+    Các entry trong manifest chưa được nạp, theo đúng thứ tự export.
+    Nếu trong đó có bản full thì bắt đầu từ bản full cuối cùng (các bản trước đã nằm trong nó).
+    """
+    entries = load_manifest(OUTPUT_DIR)
+    with engine.connect() as conn:
+        applied = {row[0] for row in conn.execute(text(f"SELECT file_name FROM {RESTORE_LOG_TABLE}"))}
+    pending = [entry for entry in entries if entry["file"] not in applied]
+    full_positions = [i for i, entry in enumerate(pending) if entry["mode"] == "full"]
+    if full_positions:
+        return pending[:full_positions[-1]], pending[full_positions[-1]:]
+    return [], pending
+
+def record_restored(engine, entries, skipped=False):
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            INSERT INTO {RESTORE_LOG_TABLE} (file_name, checksum, mode, row_count, skipped)
+            VALUES (:file, :checksum, :mode, :row_count, :skipped)
+        """), [{**entry, "skipped": skipped} for entry in entries])
 
-def transform_and_load_fact(engine):
+def restore_dump_chain(engine):
     """
-    Chuyển dữ liệu từ bảng tạm staging -> bảng Fact.
-    SỬA ĐỔI: Join theo full_date thay vì date_sk tự tính.
+    Nạp chuỗi dump (full + incremental) theo thứ tự manifest, mỗi file:
+    kiểm tra checksum -> restore vào bảng staging tạm -> nạp Fact -> ghi log.
+    Dừng ngay ở file đầu tiên bị lỗi để không nạp lệch thứ tự.
+    """
+    skipped, pending = find_pending_dumps(engine)
+    if skipped:
+        record_restored(engine, skipped, skipped=True)
+        print(f"⏭️ Bỏ qua {len(skipped)} dump cũ hơn bản full mới nhất.")
+    if not pending:
+        print("ℹ️ Không có file dump mới trong manifest.")
+        return True
+
+    print(f"📂 Có {len(pending)} file dump cần nạp.")
+    for entry in pending:
+        path = os.path.join(OUTPUT_DIR, entry["file"])
+        if not os.path.exists(path):
+            print(f"❌ Thiếu file dump: {path}")
+            return False
+        if file_checksum(path) != entry["checksum"]:
+            print(f"❌ Checksum không khớp, file dump bị hỏng: {path}")
+            return False
+
+        print(f"📦 {entry['file']} ({entry['mode']}, {entry['row_count']} dòng)")
+        if not restore_dump_to_warehouse(path):
+            return False
+        if not transform_and_load_fact(engine, forecast_date=dump_forecast_date(entry)):
+            return False
+        record_restored(engine, [entry])
+    return True
+
+def dump_forecast_date(entry):
+    """
+    Biểu thức ngày dự báo của bảng restore từ 1 dump, theo phiên bản staging ghi trong manifest
+    lúc export (không dò information_schema). Dump cũ không ghi phiên bản -> FORECAST_DATE_FALLBACK.
+    """
+    if (entry or {}).get("staging_version", 0) >= FORECAST_DATE_STAGING_VERSION:
+        return "s.forecast_date"
+    return FORECAST_DATE_FALLBACK
+
+def fact_select_sql(source_table, forecast_date="s.forecast_date"):
+    """
+    Câu SELECT lấy dữ liệu Fact từ bảng staging (source_table).
+    date_sk được tra qua cột forecast_date (cột sinh sẵn DATE(date_time), có index)
+    bằng phép so sánh bằng thuần: dùng được index, không phải tính hàm trên từng dòng.
+    forecast_date: biểu thức thay thế khi bảng nguồn chưa có cột (xem dump_forecast_date).
     """
-    sql_etl = f"""
-    INSERT INTO {FACT_TABLE} (
-        date_sk, location_key, date_time,
-        min_temp_c, max_temp_c, day_icon, day_phrase, day_precip,day_precip_type, day_precip_intensity,
-        night_icon, night_phrase, night_precip, night_precip_type, night_precip_intensity, source, mobile_link, link
-    )
+    return f"""
     SELECT 
         d.date_sk,  -- Lấy ID thực tế từ bảng dim_date (ví dụ: 13) thay vì tự tính
         s.location_key,
@@ -153,62 +217,196 @@ def transform_and_load_fact(engine):
         s.source,
         s.mobile_link,
         s.link
-    FROM staging_weather_forecast s
+    FROM {source_table} s
     -- 1. JOIN location (Giữ nguyên)
     JOIN dim_location l ON s.location_key = l.location_key
     
-    -- 2. JOIN date (SỬA ĐỔI QUAN TRỌNG)
-    -- So sánh ngày trong staging (chuyển về DATE) với cột full_date của dim_date
-    JOIN dim_date d ON DATE(s.date_time) = d.full_date
-    
-    ON DUPLICATE KEY UPDATE
-        min_temp_c = VALUES(min_temp_c),
-        max_temp_c = VALUES(max_temp_c),
-        day_phrase = VALUES(day_phrase),
-        night_phrase = VALUES(night_phrase);
+    -- 2. JOIN date: forecast_date (staging) = full_date (dim_date, unique index)
+    JOIN dim_date d ON {forecast_date} = d.full_date
     """
-    
-    sql_drop_temp = "DROP TABLE IF EXISTS staging_weather_forecast;"
 
+def transform_and_load_fact(engine, source_table="staging_weather_forecast",
+                            cleanup_sql="DROP TABLE IF EXISTS staging_weather_forecast;",
+                            forecast_date="s.forecast_date"):
+    """
+    Chuyển dữ liệu từ bảng staging (source_table) -> bảng Fact.
+    SỬA ĐỔI: Join theo full_date thay vì date_sk tự tính.
+    Upsert theo khóa tự nhiên uq_fact_date_location (date_sk, location_key):
+    chạy lại cùng dữ liệu không sinh thêm dòng.
+    cleanup_sql: lệnh dọn bảng nguồn sau khi nạp (None = giữ nguyên).
+    forecast_date: mặc định cột forecast_date - staging và bảng đệm đã qua require_schema nên luôn có;
+    chỉ bảng restore từ dump cũ mới cần biểu thức khác (xem dump_forecast_date).
+    """
+    update_clause = ", ".join(f"{col} = VALUES({col})" for col in FACT_UPDATE_COLUMNS)
+    
     try:
         with engine.connect() as conn:
+            if forecast_date != "s.forecast_date":
+                print(f"⚠️ '{source_table}' chưa có cột forecast_date (dump cũ): join theo {forecast_date}.")
+            sql_etl = f"""
+            INSERT INTO {FACT_TABLE} (
+                date_sk, location_key, date_time,
+                min_temp_c, max_temp_c, day_icon, day_phrase, day_precip,day_precip_type, day_precip_intensity,
+                night_icon, night_phrase, night_precip, night_precip_type, night_precip_intensity, source, mobile_link, link
+            )
+            {fact_select_sql(source_table, forecast_date)}
+            ON DUPLICATE KEY UPDATE
+                {update_clause};
+            """
+            # Đếm trước khi upsert (cùng transaction) thay vì suy từ rowcount: SQLAlchemy bật
+            # CLIENT_FOUND_ROWS nên rowcount tính 1 cho dòng mới, 2 cho dòng đổi giá trị và 1 cho
+            # dòng đã có nhưng không đổi -> không phân biệt được dòng mới với dòng không đổi
+            total, existing = conn.execute(text(f"""
+                SELECT COUNT(*), COUNT(f.date_sk)
+                FROM ({fact_select_sql(source_table, forecast_date)}) src
+                LEFT JOIN {FACT_TABLE} f ON f.date_sk = src.date_sk AND f.location_key = src.location_key
+            """)).one()
             print("🔄 Đang chuyển đổi và nạp dữ liệu vào Fact Table...")
-            result = conn.execute(text(sql_etl))
+            conn.execute(text(sql_etl))
             conn.commit()
-            print(f"🎉 Đã nạp {result.rowcount} dòng vào '{FACT_TABLE}'.")
+            print(f"🎉 Đã upsert vào '{FACT_TABLE}': thêm mới {total - existing} | ghi đè {existing} dòng đã có.")
             
-            print("🧹 Đang dọn dẹp bảng tạm...")
-            conn.execute(text(sql_drop_temp))
-            conn.commit()
-            print("✅ Đã xóa bảng tạm staging_weather_forecast trong Warehouse.")
+            if cleanup_sql:
+                print("🧹 Đang dọn dẹp bảng tạm...")
+                conn.execute(text(cleanup_sql))
+                conn.commit()
+                print(f"✅ Đã dọn bảng tạm {source_table} trong Warehouse.")
+        return True
             
     except Exception as e:
         print(f"❌ Lỗi trong quá trình ETL: {e}")
+        return False
+
+
+# ==============================================================================
+# CHUYỂN TRỰC TIẾP STAGING -> WAREHOUSE (không qua file dump)
+# ==============================================================================
+def staging_on_same_server():
+    return (STAGING_HOST, str(STAGING_PORT)) == (DB_HOST, str(DB_PORT))
+
+def stream_staging_to_warehouse(wh_engine):
+    """
+    Staging ở server khác: đọc staging bằng server-side cursor theo từng chunk,
+    mỗi chunk nạp vào bảng đệm của Warehouse bằng 1 lệnh INSERT nhiều dòng.
+    Trả về số dòng đã chuyển.
+    """
+    staging_engine = create_engine(
+        f"mysql+pymysql://{STAGING_USER}:{STAGING_PASS}@{STAGING_HOST}:{STAGING_PORT}/{STAGING_DB}")
+    cols = ', '.join(TRANSFER_COLUMNS)
+    insert_sql = text(f"INSERT INTO {TRANSFER_TABLE} ({cols}) VALUES ({', '.join(f':{c}' for c in TRANSFER_COLUMNS)})")
+    total = 0
+    try:
+        with wh_engine.begin() as wh_conn:
+            wh_conn.execute(text(f"DELETE FROM {TRANSFER_TABLE}"))  # Bỏ dữ liệu dở của lần chạy lỗi trước
+        with staging_engine.connect() as src_conn, wh_engine.begin() as wh_conn:
+            result = src_conn.execution_options(stream_results=True).execute(
+                text(f"SELECT {cols} FROM staging_weather_forecast"))
+            for rows in result.mappings().partitions(TRANSFER_CHUNK_SIZE):
+                wh_conn.execute(insert_sql, [dict(row) for row in rows])
+                total += len(rows)
+                print(f"   ... đã chuyển {total} dòng")
+    finally:
+        staging_engine.dispose()
+    return total
+
+def transfer_direct(wh_engine):
+    """Nạp Fact trực tiếp từ Staging, không tạo file dump và không tạo lại bảng. Trả về True nếu nạp thành công."""
+    if staging_on_same_server():
+        # Cùng server: 1 lệnh INSERT ... SELECT đọc thẳng bảng staging ở schema khác
+        print(f"🔗 Staging '{STAGING_DB}' cùng server với Warehouse: INSERT ... SELECT trực tiếp.")
+        return transform_and_load_fact(wh_engine, source_table=f"{STAGING_DB}.staging_weather_forecast",
+                                       cleanup_sql=None)
+    else:
+        print(f"📡 Staging ở {STAGING_HOST}:{STAGING_PORT}: chuyển theo chunk {TRANSFER_CHUNK_SIZE} dòng...")
+        count = stream_staging_to_warehouse(wh_engine)
+        print(f"✅ Đã chuyển {count} dòng vào bảng đệm {TRANSFER_TABLE}.")
+        return transform_and_load_fact(wh_engine, source_table=TRANSFER_TABLE,
+                                       cleanup_sql=f"DELETE FROM {TRANSFER_TABLE}")
+
+
+# ==============================================================================
+# KIỂM TRA KẾ HOẠCH THỰC THI (EXPLAIN) CỦA LỆNH NẠP FACT
+# ==============================================================================
+def check_fact_join_plan(engine, source_table, forecast_date="s.forecast_date"):
+    """
+    EXPLAIN câu SELECT nạp Fact: chỉ bảng dẫn đầu được phép quét toàn bộ (type=ALL/index),
+    các bảng join sau nó phải tra bằng index (eq_ref/ref...). Trả về True nếu đạt.
+    """
+    try:
+        with engine.connect() as conn:
+            plan = conn.execute(text(f"EXPLAIN {fact_select_sql(source_table, forecast_date)}")).mappings().all()
+    except Exception as e:
+        print(f"❌ Không EXPLAIN được trên '{source_table}' (mode dump: bảng chỉ có khi đang restore): {e}")
+        return False
+
+    print(f"{'table':>8} {'type':>8} {'key':>28} {'rows':>10}  Extra")
+    for row in plan:
+        print(f"{row['table']:>8} {row['type'] or '-':>8} {row['key'] or '-':>28} "
+              f"{row['rows'] or 0:>10}  {row['Extra'] or ''}")
+
+    scanned_joins = [row['table'] for row in plan[1:] if row['type'] in ("ALL", "index")]
+    if scanned_joins:
+        print(f"❌ Bảng {scanned_joins} bị quét toàn bộ cho mỗi dòng join.")
+        return False
+    print("✅ Mọi phép join trong lệnh nạp Fact đều dùng index.")
+    return True
 
 
 # --- MAIN ---
 if __name__ == "__main__":
-    print("🚀 BẮT ĐẦU QUÁ TRÌNH IMPORT DUMP VÀO WAREHOUSE")
+    print(f"🚀 BẮT ĐẦU QUÁ TRÌNH NẠP STAGING VÀO WAREHOUSE (mode={TRANSFER_MODE})")
     
-    # 1. Tìm file dump
-    dump_file = get_latest_dump_file()
-    if not dump_file:
-        sys.exit(1)
-        
-    # 2. Restore file dump vào Warehouse (tạo bảng staging tạm)
-    if not restore_dump_to_warehouse(dump_file):
-        sys.exit(1)
-
-    # 3. Kết nối Python với Warehouse để xử lý logic
+    # 1. Kết nối Warehouse và kiểm tra cấu trúc (bảng Fact được tạo bởi migrations.py)
     engine = get_warehouse_engine()
     if not engine:
         sys.exit(1)
+    require_schema(engine, "warehouse")
+
+    if "--explain" in sys.argv:
+        # Kiểm tra kế hoạch join trên bảng nguồn của mode hiện tại
+        forecast_date = "s.forecast_date"
+        if TRANSFER_MODE != "direct":
+            # dump: bảng staging restore vào Warehouse, cột ngày theo dump mới nhất
+            source = "staging_weather_forecast"
+            entries = load_manifest(OUTPUT_DIR)
+            forecast_date = dump_forecast_date(entries[-1] if entries else None)
+        elif staging_on_same_server():
+            source = f"{STAGING_DB}.staging_weather_forecast"
+        else:
+            source = TRANSFER_TABLE
+        ok = check_fact_join_plan(engine, source, forecast_date)
+        engine.dispose()
+        sys.exit(0 if ok else 1)
 
-    # 4. Tạo bảng Fact (nếu chưa có)
-    create_fact_table_if_not_exists(engine)
+    if TRANSFER_MODE == "direct":
+        # 2-4. Chuyển thẳng Staging -> Fact
+        try:
+            ok = transfer_direct(engine)
+        except Exception as e:
+            print(f"❌ Lỗi khi chuyển dữ liệu Staging -> Warehouse: {e}")
+            ok = False
+        if not ok:
+            engine.dispose()
+            sys.exit(1)
+    elif load_manifest(OUTPUT_DIR):
+        # 2-4. Nạp chuỗi dump full/incremental theo manifest
+        if not restore_dump_chain(engine):
+            engine.dispose()
+            sys.exit(1)
+    else:
+        # 2. Tìm file dump (dump cũ, chưa có manifest)
+        dump_file = get_latest_dump_file()
+        if not dump_file:
+            sys.exit(1)
+            
+        # 3. Restore file dump vào Warehouse (tạo bảng staging tạm)
+        if not restore_dump_to_warehouse(dump_file):
+            sys.exit(1)
 
-    # 5. Transform & Load (Staging -> Fact)
-    transform_and_load_fact(engine)
+        # 4. Transform & Load (Staging -> Fact); dump cũ không ghi phiên bản staging
+        if not transform_and_load_fact(engine, forecast_date=FORECAST_DATE_FALLBACK):
+            engine.dispose()
+            sys.exit(1)
     
     engine.dispose()
-    print("\n✅ QUÁ TRÌNH HOÀN TẤT!")
\ No newline at end of file
+    print("\n✅ QUÁ TRÌNH HOÀN TẤT!")
@@ -1,14 +1,97 @@
 # location_mapping.py
+import csv
+import os
+import re
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+load_dotenv()
+
+# File danh mục địa điểm (location_key, location_name, mart_name, mart_table)
+LOCATION_CATALOG = os.getenv(
+    "LOCATION_CATALOG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "locations.csv")
+)
+
+# Tên bảng Detail Mart được ghép thẳng vào SQL: chỉ cho phép chữ, số và "_"
+TABLE_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_]{1,64}$")
+
+_catalog_cache = None
+_name_cache = None
+
+def load_locations(path=None):
+    """
+    Đọc danh mục địa điểm từ file CSV (nguồn duy nhất cho extract, dim_location, data mart).
+    Trả về list dict theo thứ tự trong file.
+    """
+    global _catalog_cache
+    if path is None and _catalog_cache is not None:
+        return _catalog_cache
+
+    with open(path or LOCATION_CATALOG, newline='', encoding='utf-8') as f:
+        locations = [
+            {k: (v or '').strip() for k, v in row.items()}
+            for row in csv.DictReader(f)
+            if row.get('location_key')
+        ]
+
+    if path is None:
+        _catalog_cache = locations
+    return locations
+
+def build_endpoints(locations=None):
+    """
+    Tạo danh sách URL API cho từng địa điểm trong danh mục.
+    API_ENDPOINT_TEMPLATE ví dụ: http://.../forecasts/v1/daily/5day/{location_key}?metric=true
+    Nếu chưa cấu hình template thì dùng 3 biến cũ API_ENDPOINT_HCM/HN/DN.
+    """
+    template = os.getenv("API_ENDPOINT_TEMPLATE")
+    if not template:
+        return [
+            url for url in [
+                os.getenv('API_ENDPOINT_HCM'),
+                os.getenv('API_ENDPOINT_HN'),
+                os.getenv('API_ENDPOINT_DN')
+            ] if url # Chỉ lấy giá trị không rỗng
+        ]
+    return [template.format(location_key=loc['location_key']) for loc in (locations or load_locations())]
 
 def get_location_name(key):
     """
     Hàm trả về tên địa điểm dựa trên location_key.
     """
-    mapping = {
-        "353981": "ho chi minh",
-        "353412": "ha noi",
-        "427264": "da nang"
-    }
+    global _name_cache
+    if _name_cache is None:
+        _name_cache = {loc['location_key']: loc['location_name'].lower() for loc in load_locations()}
     
     # Trả về tên nếu tìm thấy, nếu không trả về 'Unknown'
-    return mapping.get(str(key), "Unknown Location")
\ No newline at end of file
+    return _name_cache.get(str(key), "Unknown Location")
+
+
+def mart_table_name(location_key):
+    """
+    Tên bảng Detail Mart của 1 địa điểm: lấy mart_table trong locations.csv nếu có
+    (giữ tên cũ mà web đang đọc: dm_hcm, dm_hanoi...), ngược lại dm_loc_<location_key>.
+    """
+    configured = {loc['location_key']: loc.get('mart_table') for loc in load_locations()}
+    table_name = configured.get(str(location_key)) or f"dm_loc_{location_key}"
+    if not TABLE_NAME_PATTERN.match(table_name):
+        raise ValueError(f"Tên bảng Detail Mart không hợp lệ cho location_key {location_key!r}: {table_name!r}")
+    return table_name
+
+def load_mart_catalog(conn, warehouse_db):
+    """
+    Danh sách Detail Mart sinh từ nội dung dim_location của Warehouse:
+    {location_key: {"name": location_name, "table": tên bảng mart}}.
+    Địa điểm có location_key không tạo được tên bảng hợp lệ bị bỏ qua (kèm cảnh báo).
+    """
+    rows = conn.execute(text(
+        f"SELECT location_key, location_name FROM {warehouse_db}.dim_location ORDER BY location_key"
+    ))
+    catalog = {}
+    for row in rows:
+        try:
+            catalog[row.location_key] = {"name": row.location_name, "table": mart_table_name(row.location_key)}
+        except ValueError as e:
+            print(f"⚠️ Bỏ qua địa điểm: {e}")
+    return catalog
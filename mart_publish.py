@@ -0,0 +1,151 @@
+# mart_publish.py - Publish Data Mart qua bảng shadow + RENAME TABLE (web không thấy dữ liệu nạp dở)
+#
+# Mode shadow: mỗi mart được ghi vào bảng <mart>__shadow, xong hết thì đổi tên tất cả trong
+# 1 lệnh RENAME TABLE (nguyên tử): <mart> -> <mart>__old_<thời điểm>, <mart>__shadow -> <mart>.
+# Giữ DM_KEEP_VERSIONS bản cũ gần nhất để rollback:
+#   python mart_publish.py list <mart>
+#   python mart_publish.py rollback <mart>
+#
+# Lưu ý chi phí: với DM_REFRESH_MODE=incremental, shadow của mỗi mart có thay đổi phải được
+# chép đầy đủ từ bảng hiện tại (INSERT ... SELECT *), tức O(kích thước mart) chứ không còn
+# O(số dòng mới). Mart không có dòng Fact nào đổi thì không bị chép.
+import os
+import sys
+import threading
+from datetime import datetime
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+load_dotenv()
+
+SHADOW_SUFFIX = "__shadow"
+OLD_SUFFIX = "__old_"
+BAD_SUFFIX = "__bad_"
+DM_KEEP_VERSIONS = int(os.getenv("DM_KEEP_VERSIONS", "2"))
+# Bảng watermark của load_to_data_mart (mart_name -> mốc updated_at của Fact đã nạp)
+WATERMARK_TABLE = "dm_refresh_watermark"
+
+
+def shadow_name(table):
+    return f"{table}{SHADOW_SUFFIX}"
+
+def list_old_versions(conn, table):
+    """Các bản cũ của mart, mới nhất trước."""
+    rows = conn.execute(text("""
+        SELECT table_name FROM information_schema.tables
+        WHERE table_schema = DATABASE() AND table_name LIKE :pattern
+        ORDER BY table_name DESC
+    """), {"pattern": f"{table}{OLD_SUFFIX}".replace("_", r"\_") + "%"})
+    return [row[0] for row in rows]
+
+
+class InPlacePublisher:
+    """Ghi thẳng vào bảng mart (cách cũ)."""
+
+    def target(self, table):
+        return table
+
+    def publish(self):
+        pass
+
+    def discard(self):
+        pass
+
+
+class ShadowPublisher:
+    """
+    Dựng mart trong bảng shadow rồi publish tất cả bằng 1 lệnh RENAME TABLE.
+    seed=True: shadow được chép sẵn dữ liệu hiện tại (cho mode incremental, chỉ ghi phần thay đổi);
+    bản chép là toàn bộ mart, xem lưu ý chi phí ở đầu file.
+    """
+
+    def __init__(self, engine, seed=False, keep_versions=DM_KEEP_VERSIONS):
+        self.engine = engine
+        self.seed = seed
+        self.keep_versions = keep_versions
+        self.tables = []
+        self._table_locks = {}
+        self._lock = threading.Lock()
+
+    def target(self, table):
+        """
+        Tạo (1 lần) và trả về bảng shadow để ghi thay cho table.
+        Khóa chung chỉ giữ lúc nhận bảng; DDL và chép dữ liệu chạy dưới khóa riêng của bảng,
+        nên các luồng nạp mart khác nhau không phải chờ nhau.
+        """
+        with self._lock:
+            table_lock = self._table_locks.setdefault(table, threading.Lock())
+        with table_lock:
+            if table not in self.tables:
+                shadow = shadow_name(table)
+                with self.engine.begin() as conn:
+                    conn.execute(text(f"DROP TABLE IF EXISTS {shadow}"))
+                    conn.execute(text(f"CREATE TABLE {shadow} LIKE {table}"))
+                    if self.seed:
+                        conn.execute(text(f"INSERT INTO {shadow} SELECT * FROM {table}"))
+                with self._lock:
+                    self.tables.append(table)
+        return shadow_name(table)
+
+    def publish(self):
+        """Đổi shadow thành bảng chính cho mọi mart cùng lúc, rồi dọn bớt bản cũ."""
+        if not self.tables:
+            return
+        suffix = OLD_SUFFIX + datetime.now().strftime("%Y%m%d%H%M%S")
+        renames = []
+        for table in self.tables:
+            renames += [f"{table} TO {table}{suffix}", f"{shadow_name(table)} TO {table}"]
+        with self.engine.begin() as conn:
+            conn.execute(text(f"RENAME TABLE {', '.join(renames)}"))
+            for table in self.tables:
+                for old in list_old_versions(conn, table)[self.keep_versions:]:
+                    conn.execute(text(f"DROP TABLE IF EXISTS {old}"))
+        self.tables = []
+
+    def discard(self):
+        """Bỏ các bảng shadow khi nạp lỗi (bảng chính không bị ảnh hưởng)."""
+        with self.engine.begin() as conn:
+            for table in self.tables:
+                conn.execute(text(f"DROP TABLE IF EXISTS {shadow_name(table)}"))
+        self.tables = []
+
+
+def rollback(engine, table):
+    """
+    Đưa bản cũ gần nhất trở lại làm bảng chính; bản hiện tại đổi tên thành <mart>__bad_<thời điểm>.
+    Watermark của mart bị xóa để lần nạp sau (kể cả incremental) nạp lại mart từ toàn bộ Fact,
+    nếu không các dòng Fact của lần nạp lỗi sẽ không bao giờ vào lại bảng vừa khôi phục.
+    """
+    with engine.begin() as conn:
+        versions = list_old_versions(conn, table)
+        if not versions:
+            print(f"❌ Không có bản cũ nào của '{table}' để rollback.")
+            return False
+        bad = f"{table}{BAD_SUFFIX}{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        conn.execute(text(f"RENAME TABLE {table} TO {bad}, {versions[0]} TO {table}"))
+        conn.execute(text(f"DELETE FROM {WATERMARK_TABLE} WHERE mart_name = :m"), {"m": table})
+    print(f"✅ Đã rollback '{table}' về {versions[0]} (bản lỗi lưu tại {bad}).")
+    print(f"ℹ️ Đã xóa watermark của '{table}': lần chạy load_to_data_mart sau sẽ nạp lại toàn bộ.")
+    return True
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] not in ("list", "rollback"):
+        print("Cách dùng: python mart_publish.py <list|rollback> <mart_table>")
+        sys.exit(1)
+    command, table = sys.argv[1], sys.argv[2]
+    engine = create_engine(
+        f"mysql+pymysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@"
+        f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DM_DB_NAME')}"
+    )
+    try:
+        if command == "list":
+            with engine.connect() as conn:
+                versions = list_old_versions(conn, table)
+            print(f"{table}: {len(versions)} bản cũ")
+            for name in versions:
+                print(f"   - {name}")
+        elif not rollback(engine, table):
+            sys.exit(1)
+    finally:
+        engine.dispose()
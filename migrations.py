@@ -0,0 +1,416 @@
+# migrations.py - Tạo/nâng cấp cấu trúc DB theo phiên bản (chạy 1 lần khi triển khai)
+#
+# Mỗi DB có bảng schema_version ghi các phiên bản đã áp dụng theo từng component
+# (staging / warehouse / mart): các component có thể dùng chung 1 DB và trùng số phiên bản.
+# Các bước ETL chỉ gọi require_schema() lúc khởi động: 1 câu SELECT MAX(version) của component,
+# không còn CREATE DATABASE/TABLE IF NOT EXISTS hay dò information_schema mỗi lần chạy.
+#
+#   python migrations.py                 # áp dụng cho cả 3 DB
+#   python migrations.py staging mart    # chỉ các DB được chọn
+#
+# Thêm thay đổi cấu trúc: thêm 1 phần tử vào cuối danh sách của DB tương ứng
+# (không sửa các phiên bản đã áp dụng).
+import os
+import sys
+import pymysql
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from location_mapping import load_mart_catalog
+from fact_maintenance import compact_fact_table
+
+load_dotenv()
+
+VERSION_TABLE = "schema_version"
+
+# DB của từng target (tên biến môi trường)
+TARGET_DB_ENV = {
+    "staging": "DB_NAME",
+    "warehouse": "DB_WAREHOUSE_NAME",
+    "mart": "DM_DB_NAME",
+}
+
+MANIFEST_TABLE = os.getenv("RAW_MANIFEST_TABLE", "raw_file_manifest")
+FACT_TABLE = os.getenv("FACT_TABLE_NAME", "fact_weather_forecast")
+
+# ==============================================================================
+# DDL DÙNG CHUNG
+# ==============================================================================
+DIM_DATE_DDL = """
+CREATE TABLE IF NOT EXISTS dim_date (
+    date_sk INT NOT NULL PRIMARY KEY,
+    full_date DATE,
+    day_since_2005 INT,
+    month_sk INT,
+    day_name VARCHAR(20),
+    month_name VARCHAR(20),
+    year INT,
+    `year_month` VARCHAR(10),
+    day_of_month INT,
+    day_of_year INT,
+    week_of_year_sunday INT,
+    year_week_sunday VARCHAR(10),
+    week_sunday_start DATE,
+    week_of_year_monday INT,
+    year_week_monday VARCHAR(10),
+    week_monday_start DATE,
+    holiday_flag VARCHAR(20),
+    day_type VARCHAR(20)
+) ENGINE=InnoDB CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci
+"""
+
+def detail_mart_ddl(table_name):
+    """Bảng Detail Mart của 1 địa điểm (tên bảng: location_mapping.mart_table_name)."""
+    return f"""
+    CREATE TABLE IF NOT EXISTS {table_name} (
+        date_sk INT NOT NULL,
+        location_key VARCHAR(50) NOT NULL,
+        date_time DATETIME,
+        min_temp_c FLOAT,
+        max_temp_c FLOAT,
+        day_icon INT,
+        day_phrase VARCHAR(100),
+        day_precip TINYINT(1),
+        night_icon INT,
+        night_phrase VARCHAR(100),
+        night_precip TINYINT(1),
+        source VARCHAR(100),
+        created_at DATETIME,
+        last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        PRIMARY KEY (date_sk, location_key)
+    )
+    """
+
+def _has_index(conn, table, index_name):
+    return conn.execute(text("""
+        SELECT COUNT(1) FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = :t AND index_name = :i
+    """), {"t": table, "i": index_name}).scalar() > 0
+
+def _has_column(conn, table, column):
+    return conn.execute(text("""
+        SELECT COUNT(1) FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = :t AND column_name = :c
+    """), {"t": table, "c": column}).scalar() > 0
+
+# ==============================================================================
+# CÁC BƯỚC MIGRATION (callable nhận connection, câu SQL hoặc list câu SQL)
+# ==============================================================================
+def create_batch_sequence(conn):
+    """Bảng sequence cấp batch_id, khởi tạo từ MAX(batch_id) để id mới không trùng batch cũ."""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS batch_id_seq (
+            id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY
+        ) ENGINE=InnoDB
+    """))
+    if conn.execute(text("SELECT COUNT(*) FROM batch_id_seq")).scalar() == 0:
+        conn.execute(text("""
+            INSERT INTO batch_id_seq (id)
+            SELECT GREATEST(COALESCE(MAX(batch_id), 0), 1) FROM batch_log
+        """))
+
+def add_staging_unique_key(conn):
+    # Dữ liệu hiện tại phải sạch (không trùng) thì lệnh này mới chạy được
+    if not _has_index(conn, "staging_weather_forecast", "uq_forecast"):
+        conn.execute(text("""
+            ALTER TABLE staging_weather_forecast
+            ADD UNIQUE KEY uq_forecast (location_key, date_time)
+        """))
+
+def add_staging_row_hash(conn):
+    if not _has_column(conn, "staging_weather_forecast", "row_hash"):
+        conn.execute(text("ALTER TABLE staging_weather_forecast ADD COLUMN row_hash CHAR(32) NULL"))
+
+def add_manifest_file_stem(conn):
+    # Tên file bỏ đuôi: .csv và .parquet của cùng 1 lượt extract có chung file_stem
+    if not _has_column(conn, MANIFEST_TABLE, "file_stem"):
+        conn.execute(text(f"""
+            ALTER TABLE {MANIFEST_TABLE}
+            ADD COLUMN file_stem VARCHAR(255) NULL AFTER file_name,
+            ADD KEY idx_manifest_stem (file_stem)
+        """))
+    conn.execute(text(f"""
+        UPDATE {MANIFEST_TABLE}
+        SET file_stem = LEFT(file_name, LENGTH(file_name) - LENGTH(SUBSTRING_INDEX(file_name, '.', -1)) - 1)
+        WHERE file_stem IS NULL AND file_name LIKE '%.%'
+    """))
+
+def add_fact_natural_key(conn):
+    # Gộp dòng trùng trước, nếu không ADD UNIQUE KEY sẽ lỗi
+    compact_fact_table(conn, FACT_TABLE)
+    conn.execute(text(f"ALTER TABLE {FACT_TABLE} ADD UNIQUE KEY uq_fact_date_location (date_sk, location_key)"))
+
+def create_detail_marts(conn):
+    # 1 bảng / địa điểm có trong dim_location của Warehouse (cùng server)
+    for info in load_mart_catalog(conn, os.getenv("DB_WAREHOUSE_NAME")).values():
+        conn.execute(text(detail_mart_ddl(info["table"])))
+
+# (version, mô tả, bước)
+MIGRATIONS = {
+    "staging": [
+        (1, "raw file manifest", f"""
+            CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+                file_name VARCHAR(255) NOT NULL,
+                checksum CHAR(64) NOT NULL,
+                file_size BIGINT NOT NULL,
+                file_mtime DOUBLE NOT NULL,
+                batch_id BIGINT,
+                row_count INT,
+                loaded_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (file_name, checksum),
+                KEY idx_manifest_file (file_name, file_size, file_mtime)
+            ) ENGINE=InnoDB
+        """),
+        (2, "batch_id sequence", create_batch_sequence),
+        (3, "staging unique key uq_forecast", add_staging_unique_key),
+        (4, "staging row_hash column", add_staging_row_hash),
+        (5, "dim_date", DIM_DATE_DDL),
+        (6, "staging forecast_date + dim_date full_date index", [
+            """ALTER TABLE staging_weather_forecast
+               ADD COLUMN forecast_date DATE AS (DATE(date_time)) STORED,
+               ADD KEY idx_staging_forecast_date (forecast_date)""",
+            "ALTER TABLE dim_date ADD UNIQUE KEY uq_dim_date_full_date (full_date)",
+        ]),
+        (7, "raw file manifest file_stem", add_manifest_file_stem),
+    ],
+    "warehouse": [
+        # Bảng Fact tạo ở v3 chưa phân vùng; chuyển sang RANGE (date_sk) theo tháng:
+        #   python fact_maintenance.py partition
+        (1, "dim_date", DIM_DATE_DDL),
+        (2, "dim_location", """
+            CREATE TABLE IF NOT EXISTS dim_location (
+                location_key VARCHAR(50) NOT NULL,
+                location_name VARCHAR(100) NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                PRIMARY KEY (location_key)
+            ) ENGINE=InnoDB CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci
+        """),
+        (3, "fact table", f"""
+            CREATE TABLE IF NOT EXISTS {FACT_TABLE} (
+                id_fact BIGINT AUTO_INCREMENT PRIMARY KEY,
+
+                -- Khóa ngoại (Foreign Keys)
+                date_sk INT NOT NULL,
+                location_key VARCHAR(50) NOT NULL,
+
+                -- Các trường dữ liệu từ Staging
+                date_time DATETIME,
+                min_temp_c FLOAT DEFAULT 0,
+                max_temp_c FLOAT DEFAULT 0,
+                day_icon INT DEFAULT 0,
+                day_phrase VARCHAR(100),
+                day_precip BOOLEAN DEFAULT FALSE,
+                day_precip_type VARCHAR(20),
+                day_precip_intensity VARCHAR(20),
+                night_icon INT DEFAULT 0,
+                night_phrase VARCHAR(100),
+                night_precip BOOLEAN DEFAULT FALSE,
+                night_precip_type VARCHAR(20),
+                night_precip_intensity VARCHAR(20),
+                source VARCHAR(100),
+                mobile_link VARCHAR(500),
+                link VARCHAR(500),
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+
+                CONSTRAINT fk_fact_date FOREIGN KEY (date_sk) REFERENCES dim_date(date_sk),
+                CONSTRAINT fk_fact_location FOREIGN KEY (location_key) REFERENCES dim_location(location_key)
+            ) ENGINE=InnoDB
+        """),
+        (4, "transfer buffer table", """
+            CREATE TABLE IF NOT EXISTS transfer_weather_forecast (
+                location_key VARCHAR(50) NOT NULL,
+                date_time DATETIME,
+                min_temp_c FLOAT,
+                max_temp_c FLOAT,
+                day_icon INT,
+                day_phrase VARCHAR(100),
+                day_precip BOOLEAN,
+                day_precip_type VARCHAR(20),
+                day_precip_intensity VARCHAR(20),
+                night_icon INT,
+                night_phrase VARCHAR(100),
+                night_precip BOOLEAN,
+                night_precip_type VARCHAR(20),
+                night_precip_intensity VARCHAR(20),
+                source VARCHAR(100),
+                mobile_link VARCHAR(500),
+                link VARCHAR(500)
+            ) ENGINE=InnoDB
+        """),
+        (5, "dump restore log", """
+            CREATE TABLE IF NOT EXISTS dump_restore_log (
+                file_name VARCHAR(255) NOT NULL PRIMARY KEY,
+                checksum CHAR(64) NOT NULL,
+                mode VARCHAR(20) NOT NULL,
+                row_count INT,
+                skipped BOOLEAN DEFAULT FALSE,
+                restored_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB
+        """),
+        (6, "transfer forecast_date + dim_date full_date index", [
+            """ALTER TABLE transfer_weather_forecast
+               ADD COLUMN forecast_date DATE AS (DATE(date_time)) STORED,
+               ADD KEY idx_transfer_forecast_date (forecast_date)""",
+            "ALTER TABLE dim_date ADD UNIQUE KEY uq_dim_date_full_date (full_date)",
+        ]),
+        (7, "fact natural key (date_sk, location_key)", add_fact_natural_key),
+        (8, "fact updated_at (watermark cho data mart)", f"""
+            ALTER TABLE {FACT_TABLE}
+                ADD COLUMN updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                ADD KEY idx_fact_updated_at (updated_at)
+        """),
+    ],
+    "mart": [
+        (1, "dm_monthly_summary", """
+            CREATE TABLE IF NOT EXISTS dm_monthly_summary (
+                month_sk INT NOT NULL,
+                location_key VARCHAR(50) NOT NULL,
+                avg_max_temp_c FLOAT,
+                avg_min_temp_c FLOAT,
+                avg_temp_c FLOAT,
+                total_rainy_days INT,
+                total_forecast_days INT,
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                PRIMARY KEY (month_sk, location_key)
+            )
+        """),
+        (2, "refresh watermark", """
+            CREATE TABLE IF NOT EXISTS dm_refresh_watermark (
+                mart_name VARCHAR(64) NOT NULL PRIMARY KEY,
+                high_water DATETIME,
+                refreshed_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            )
+        """),
+        (3, "dm_rollup (cube nhiều grain)", """
+            CREATE TABLE IF NOT EXISTS dm_rollup (
+                grain VARCHAR(20) NOT NULL,
+                grain_key VARCHAR(20) NOT NULL,
+                location_key VARCHAR(50) NOT NULL,
+                avg_max_temp_c FLOAT,
+                avg_min_temp_c FLOAT,
+                avg_temp_c FLOAT,
+                total_rainy_days INT,
+                total_forecast_days INT,
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                PRIMARY KEY (grain, grain_key, location_key)
+            )
+        """),
+    ],
+}
+
+# Các bước chạy lại mỗi lần gọi migrations.py (phụ thuộc dữ liệu cấu hình, không đánh version)
+REPEATABLE = {
+    "mart": [("detail marts theo dim_location", create_detail_marts)],
+}
+
+def latest_version(target):
+    return max(version for version, _, _ in MIGRATIONS[target])
+
+# ==============================================================================
+# KIỂM TRA LÚC KHỞI ĐỘNG (dùng trong các bước ETL)
+# ==============================================================================
+def current_version(conn, target):
+    """Phiên bản cấu trúc đã áp dụng của component target (0 nếu chưa từng chạy migrations)."""
+    try:
+        return conn.execute(text(f"SELECT MAX(version) FROM {VERSION_TABLE} WHERE component = :c"),
+                            {"c": target}).scalar() or 0
+    except Exception:
+        return 0
+
+def require_schema(engine, target):
+    """
+    Dừng chương trình nếu DB chưa được migrate tới phiên bản mới nhất.
+    Chỉ tốn 1 câu SELECT, thay cho DDL/dò information_schema mỗi lần chạy.
+    """
+    with engine.connect() as conn:
+        version = current_version(conn, target)
+    expected = latest_version(target)
+    if version < expected:
+        print(f"❌ Cấu trúc DB '{target}' đang ở phiên bản {version}, cần {expected}. "
+              f"Hãy chạy: python migrations.py {target}", file=sys.stderr)
+        sys.exit(1)
+
+# ==============================================================================
+# ÁP DỤNG MIGRATION
+# ==============================================================================
+def add_version_component(conn, target):
+    """
+    Bảng schema_version cũ (trước khi có cột component) chỉ ghi phiên bản của DB đang migrate:
+    gán các dòng đó cho target rồi đổi khóa chính sang (component, version).
+    """
+    if _has_column(conn, VERSION_TABLE, "component"):
+        return
+    conn.execute(text(f"ALTER TABLE {VERSION_TABLE} ADD COLUMN component VARCHAR(20) NOT NULL DEFAULT '' FIRST"))
+    conn.execute(text(f"UPDATE {VERSION_TABLE} SET component = :c"), {"c": target})
+    conn.execute(text(f"ALTER TABLE {VERSION_TABLE} DROP PRIMARY KEY, ADD PRIMARY KEY (component, version)"))
+    print(f"🔄 [{target}] {VERSION_TABLE}: thêm cột component")
+
+def _run_step(conn, step):
+    if callable(step):
+        step(conn)
+    elif isinstance(step, list):
+        for statement in step:
+            conn.execute(text(statement))
+    else:
+        conn.execute(text(step))
+
+def migrate(target):
+    db_name = os.getenv(TARGET_DB_ENV[target])
+    host, port = os.getenv("DB_HOST"), int(os.getenv("DB_PORT"))
+    user, password = os.getenv("DB_USER"), os.getenv("DB_PASS")
+
+    # 1. Tạo CSDL nếu chưa có
+    conn = pymysql.connect(host=host, port=port, user=user, password=password, charset='utf8mb4')
+    try:
+        conn.cursor().execute(
+            f"CREATE DATABASE IF NOT EXISTS {db_name} CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
+    finally:
+        conn.close()
+
+    engine = create_engine(f"mysql+pymysql://{user}:{password}@{host}:{port}/{db_name}")
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (
+                    component VARCHAR(20) NOT NULL,
+                    version INT NOT NULL,
+                    description VARCHAR(255),
+                    applied_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (component, version)
+                ) ENGINE=InnoDB
+            """))
+            add_version_component(conn, target)
+            version = current_version(conn, target)
+
+        # 2. Áp dụng các phiên bản còn thiếu, mỗi phiên bản 1 transaction
+        # (DDL của MySQL tự commit, nên version chỉ được ghi khi bước đã chạy xong)
+        pending = [m for m in MIGRATIONS[target] if m[0] > version]
+        for number, description, step in pending:
+            with engine.begin() as conn:
+                _run_step(conn, step)
+                conn.execute(text(f"INSERT INTO {VERSION_TABLE} (component, version, description) VALUES (:c, :v, :d)"),
+                             {"c": target, "v": number, "d": description})
+            print(f"✅ [{target}] v{number}: {description}")
+
+        for description, step in REPEATABLE.get(target, []):
+            with engine.begin() as conn:
+                _run_step(conn, step)
+            print(f"🔄 [{target}] {description}")
+
+        if not pending:
+            print(f"ℹ️ [{target}] DB '{db_name}' đã ở phiên bản mới nhất (v{version}).")
+    finally:
+        engine.dispose()
+
+if __name__ == "__main__":
+    targets = sys.argv[1:] or list(MIGRATIONS)
+    for target in targets:
+        if target not in MIGRATIONS:
+            print(f"Không có target '{target}'. Chọn trong: {', '.join(MIGRATIONS)}")
+            sys.exit(1)
+    try:
+        for target in targets:
+            migrate(target)
+    except Exception as e:
+        print(f"❌ Lỗi khi migrate: {e}", file=sys.stderr)
+        sys.exit(1)
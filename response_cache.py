@@ -0,0 +1,132 @@
+# response_cache.py
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class ResponseCache:
+    """
+    Cache response API trên đĩa, mỗi location_key 1 file JSON.
+    - ttl: trong thời gian này dùng lại payload, không gọi API.
+    - Hết ttl: gửi request có điều kiện (If-None-Match / If-Modified-Since).
+    - max_entries: vượt quá thì xóa các entry cũ nhất.
+    - Payload mới chỉ được lưu khi commit() (sau khi đã ghi vào file extract).
+    """
+
+    def __init__(self, cache_dir, ttl=3600, max_entries=1000):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"hit": 0, "revalidated": 0, "unchanged": 0, "miss": 0}
+        self.pending = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, location_key):
+        return os.path.join(self.cache_dir, f"{location_key}.json")
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, location_key):
+        """Trả về entry đã lưu (dict) hoặc None."""
+        try:
+            with open(self._path(location_key), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, entry):
+        return entry is not None and time.time() - entry['fetched_at'] < self.ttl
+
+    def conditional_headers(self, entry):
+        """Header cho request có điều kiện, dựa trên ETag / Last-Modified đã lưu."""
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def record_hit(self):
+        self._count("hit")
+
+    def touch(self, location_key, entry):
+        """Server trả 304: payload không đổi, chỉ gia hạn ttl."""
+        entry['fetched_at'] = time.time()
+        self._write(location_key, entry)
+        self._count("revalidated")
+
+    def store(self, location_key, payload, response_headers):
+        """
+        Ghi nhận payload mới (chưa lưu xuống đĩa). Trả về True nếu nội dung khác với bản đã lưu.
+        Entry chỉ được lưu khi gọi commit() - sau khi payload đã nằm trong file extract,
+        nếu không lần gọi sau sẽ coi payload là "không đổi" và dữ liệu bị mất.
+        """
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+        old = self.get(location_key)
+        changed = old is None or old.get('digest') != digest
+
+        entry = {
+            'fetched_at': time.time(),
+            'etag': response_headers.get('ETag'),
+            'last_modified': response_headers.get('Last-Modified'),
+            'digest': digest,
+            'payload': payload,
+        }
+        if changed:
+            with self._lock:
+                self.pending[location_key] = entry
+        else:
+            self._write(location_key, entry)  # payload cũ đã nằm trong file extract trước đó
+        self._count("miss" if changed else "unchanged")
+        return changed
+
+    def drop(self, location_key):
+        """Bỏ entry chờ lưu của 1 địa điểm (payload không ghi được vào file extract)."""
+        with self._lock:
+            self.pending.pop(location_key, None)
+
+    def commit(self):
+        """Lưu mọi entry chờ xuống đĩa (gọi sau khi file extract đã chốt)."""
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        for location_key, entry in pending.items():
+            self._write(location_key, entry)
+        return len(pending)
+
+    def discard(self):
+        """Bỏ mọi entry chờ lưu (ghi file extract thất bại)."""
+        with self._lock:
+            self.pending = {}
+
+    def _write(self, location_key, entry):
+        # Ghi ra file tạm rồi đổi tên để không bao giờ để lại file hỏng
+        path = self._path(location_key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        """Xóa các entry cũ nhất khi số entry vượt quá max_entries. Trả về số file đã xóa."""
+        files = [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir) if name.endswith('.json')
+        ]
+        excess = len(files) - self.max_entries
+        if excess <= 0:
+            return 0
+        files.sort(key=os.path.getmtime)
+        for path in files[:excess]:
+            os.remove(path)
+        return excess
+
+    def summary(self):
+        s = self.stats
+        return (f"hit={s['hit']}, 304={s['revalidated']}, "
+                f"200 không đổi={s['unchanged']}, miss={s['miss']}")
@@ -7,7 +7,7 @@ import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 # Import hàm của các bước ETL
-from extract_to_file import process_all_endpoints
+from extract_to_file import process_all_endpoints, ENDPOINTS, get_response_cache, extract_location_key
 # from load_to_staging import load_to_staging   # Tương lai
 # from transform_data import transform_data     # Tương lai
 # from load_to_warehouse import load_wh         # Tương lai
@@ -29,11 +29,87 @@ def run_job(job_func, job_name):
     print("-" * 60)
 
 
+# === Cấu hình quota API ===
+# API_DAILY_QUOTA: số lượt gọi API tối đa mỗi ngày (để trống = chạy toàn bộ mỗi 2 phút như cũ)
+API_DAILY_QUOTA = int(os.getenv("API_DAILY_QUOTA", "0"))
+QUOTA_TICK_MINUTES = int(os.getenv("QUOTA_TICK_MINUTES", "5"))
+
+
+class TokenBucket:
+    """
+    Token bucket: nạp lại `rate` token mỗi giây, tối đa `capacity` token.
+    Mỗi lượt gọi API tiêu tốn 1 token.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def take(self, wanted):
+        """Lấy tối đa `wanted` token, trả về số token thực sự lấy được."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        granted = min(int(self.tokens), wanted)
+        self.tokens -= granted
+        return granted
+
+
+def endpoints_needing_request(urls):
+    """
+    Các endpoint sẽ thực sự gửi HTTP request: endpoint còn trong ttl của ResponseCache
+    được trả từ cache mà không gọi API nên không tiêu token.
+    """
+    cache = get_response_cache()
+    if not cache:
+        return list(urls)
+    return [url for url in urls if not cache.is_fresh(cache.get(extract_location_key(url)))]
+
+
+def make_quota_extract_job(endpoints, daily_quota):
+    """
+    Tạo job Extract dùng token bucket: mỗi lần chạy chỉ gọi các endpoint
+    lâu chưa được cập nhật nhất, trong giới hạn token còn lại.
+    Quota được rải đều trong ngày thay vì dồn hết vào vài lượt chạy đầu.
+    Token chỉ bị trừ cho endpoint cần gửi request (cache hết hạn hoặc chưa có).
+    """
+    bucket = TokenBucket(rate=daily_quota / 86400, capacity=min(daily_quota, len(endpoints)))
+    last_fetched = {url: 0.0 for url in endpoints}
+
+    def quota_extract():
+        candidates = endpoints_needing_request(endpoints)
+        if not candidates:
+            print("♻️ Mọi endpoint còn trong cache, không cần gọi API.")
+            return None
+        granted = bucket.take(len(candidates))
+        if granted == 0:
+            print("⏳ Hết token quota, chờ lượt sau.")
+            return None
+
+        # Ưu tiên endpoint có dữ liệu cũ nhất
+        stalest = sorted(candidates, key=last_fetched.get)[:granted]
+        now = time.time()
+        for url in stalest:
+            last_fetched[url] = now
+
+        print(f"📡 Gọi {granted}/{len(endpoints)} endpoint (token còn lại: {bucket.tokens:.2f})")
+        return process_all_endpoints(stalest)
+
+    return quota_extract
+
+
 def schedule_jobs():
     """Khai báo toàn bộ job ETL với lịch chạy cụ thể"""
 
-    # === Job Extract chạy mỗi 2 phút (demo) ===
-    schedule.every(2).minutes.do(run_job, process_all_endpoints, "Extract API")
+    if API_DAILY_QUOTA > 0:
+        # === Job Extract theo quota: rải đều số lượt gọi API trong ngày ===
+        quota_extract = make_quota_extract_job(ENDPOINTS, API_DAILY_QUOTA)
+        schedule.every(QUOTA_TICK_MINUTES).minutes.do(run_job, quota_extract, "Extract API (quota)")
+    else:
+        # === Job Extract chạy mỗi 2 phút (demo) ===
+        schedule.every(2).minutes.do(run_job, process_all_endpoints, "Extract API")
 
     # === Ví dụ tương lai: chạy lúc 01:00 mỗi ngày ===
     # schedule.every().day.at("01:00").do(run_job, load_to_staging, "Load Staging")
@@ -6,13 +6,48 @@ from dotenv import load_dotenv
 import os
 import sys
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from batch_log import mark_success, mark_failed
+from batch_partitions import prepare_batch, release_batch
+from transform_rules import convert_frame, build_select_sql, output_columns, COLUMN_SPECS
 
 load_dotenv()
 
 # ============ CẤU HÌNH ============
 RAW_TABLE = "raw_weather_forecast"
 TRANSFORM_TABLE = "transform_weather_forecast"
-BATCH_LOG_TABLE = "batch_log"
+
+# Số dòng raw đọc mỗi lần (bộ nhớ tối đa ~ 1 chunk)
+TRANSFORM_CHUNK_SIZE = int(os.getenv("TRANSFORM_CHUNK_SIZE", "50000"))
+
+# Engine chuyển đổi: pandas (đọc về Python) | sql (INSERT ... SELECT ngay trên MySQL)
+# Có thể chọn cho từng lần chạy: python transform.py --engine sql
+TRANSFORM_ENGINE = os.getenv("TRANSFORM_ENGINE", "pandas").lower()
+
+# Số process chạy song song (mỗi process xử lý 1 batch)
+TRANSFORM_WORKERS = int(os.getenv("TRANSFORM_WORKERS", str(os.cpu_count() or 1)))
+
+TRANSFORM_DTYPE = {
+    'batch_id': sqlalchemy.BIGINT(),
+    'date_time': sqlalchemy.DATETIME(),
+    'location_key': sqlalchemy.VARCHAR(50),
+    'location_name': sqlalchemy.VARCHAR(100),
+    'min_temp_c': sqlalchemy.FLOAT(),
+    'max_temp_c': sqlalchemy.FLOAT(),
+    'day_icon': sqlalchemy.INTEGER(),
+    'day_phrase': sqlalchemy.VARCHAR(100),
+    'day_precip': sqlalchemy.BOOLEAN(),
+    'day_precip_type': sqlalchemy.VARCHAR(20),
+    'day_precip_intensity': sqlalchemy.VARCHAR(20),
+    'night_icon': sqlalchemy.INTEGER(),
+    'night_phrase': sqlalchemy.VARCHAR(100),
+    'night_precip': sqlalchemy.BOOLEAN(),
+    'night_precip_type': sqlalchemy.VARCHAR(20),
+    'night_precip_intensity': sqlalchemy.VARCHAR(20),
+    'source': sqlalchemy.VARCHAR(100),
+    'mobile_link': sqlalchemy.VARCHAR(500),
+    'link': sqlalchemy.VARCHAR(500),
+}
 
 engine = sqlalchemy.create_engine(
     f"mysql+pymysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@"
@@ -25,34 +60,158 @@ def print_log(msg):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"[{timestamp}] {msg}")
 
-def get_current_batch_id():
+def get_pending_batch_ids():
+    """Tất cả batch đang có dữ liệu trong bảng raw (tăng dần)."""
     with engine.connect() as conn:
-        result = conn.execute(text(f"SELECT DISTINCT batch_id FROM {RAW_TABLE} LIMIT 1"))
-        row = result.fetchone()
-        return row[0] if row else None
+        result = conn.execute(text(f"SELECT DISTINCT batch_id FROM {RAW_TABLE} ORDER BY batch_id"))
+        return [row[0] for row in result]
+
+def update_batch_status(batch_id, status, error_msg=None, clean_count=None, raw_count=None):
+    if status == "SUCCESS":
+        mark_success(engine, batch_id, clean_count, total_records=raw_count)
+    elif status == "FAILED":
+        mark_failed(engine, batch_id, error_msg)
+
+# ============ TRANSFORM THEO CHUNK ============
+def transform_batch_chunked(batch_id, chunk_size=None):
+    """
+    Đọc batch từ raw bằng server-side cursor theo từng chunk, convert và append
+    vào bảng transform ngay, nên bộ nhớ không phụ thuộc kích thước batch.
+    Trả về (số dòng raw, số dòng sạch) cộng dồn qua các chunk.
+    """
+    chunk_size = chunk_size or TRANSFORM_CHUNK_SIZE
+    raw_count = 0
+    clean_count = 0
+
+    print_log(f"Đọc dữ liệu từ {RAW_TABLE} (batch_id = {batch_id}), mỗi chunk {chunk_size:,} dòng")
+    with engine.connect().execution_options(stream_results=True) as conn:
+        chunks = pd.read_sql(
+            text(f"SELECT * FROM {RAW_TABLE} WHERE batch_id = :bid"),
+            conn, params={"bid": batch_id}, chunksize=chunk_size
+        )
+        for df in chunks:
+            raw_count += len(df)
+
+            # ================== CONVERT TỪNG FIELD ==================
+            # Quy tắc khai báo trong transform_rules.COLUMN_SPECS, chạy vector hóa trên cả DataFrame
+            # Loại bỏ dòng lỗi nghiêm trọng (thiếu ngày/nhiệt độ)
+            df, dropped = convert_frame(df)
+            if dropped > 0:
+                print_log(f"Loại bỏ {dropped} dòng không hợp lệ (thiếu ngày/nhiệt độ)")
+
+            # Ghi dữ liệu sạch của chunk vào transform
+            df.to_sql(
+                name=TRANSFORM_TABLE,
+                con=engine,
+                if_exists='append',
+                index=False,
+                method='multi',
+                chunksize=1000,
+                dtype=TRANSFORM_DTYPE
+            )
+            clean_count += len(df)
+            print_log(f"Đã xử lý {raw_count:,} bản ghi thô → {clean_count:,} bản ghi sạch")
 
-def update_batch_status(batch_id, status, error_msg=None, clean_count=None):
+    return raw_count, clean_count
+
+# ============ TRANSFORM TRÊN DATABASE (PUSHDOWN) ============
+def transform_batch_pushdown(batch_id):
+    """
+    Chuyển đổi cả batch bằng 1 câu INSERT ... SELECT trong 1 transaction,
+    dữ liệu không rời khỏi MySQL. Quy tắc sinh từ transform_rules.COLUMN_SPECS.
+    Trả về (số dòng raw, số dòng sạch).
+    """
+    cols = ', '.join(output_columns())
+    insert_sql = text(f"INSERT INTO {TRANSFORM_TABLE} ({cols}) {build_select_sql(RAW_TABLE)}")
+
+    print_log(f"Chuyển đổi batch_id = {batch_id} bằng INSERT ... SELECT trên server")
     with engine.begin() as conn:
-        if status == "SUCCESS":
-            conn.execute(text(f"""
-                UPDATE {BATCH_LOG_TABLE} SET 
-                    status = 'SUCCESS',
-                    success_count = :cnt,
-                    total_records = (SELECT COUNT(*) FROM {RAW_TABLE} WHERE batch_id = :bid),
-                    end_time = NOW()
-                WHERE batch_id = :bid
-            """), {"bid": batch_id, "cnt": clean_count})
-        elif status == "FAILED":
-            msg = str(error_msg)[:2000] if error_msg else "Lỗi không xác định"
-            conn.execute(text(f"""
-                UPDATE {BATCH_LOG_TABLE} SET 
-                    status = 'FAILED',
-                    error_message = :msg,
-                    end_time = NOW()
-                WHERE batch_id = :bid
-            """), {"bid": batch_id, "msg": msg})
+        raw_count = conn.execute(
+            text(f"SELECT COUNT(*) FROM {RAW_TABLE} WHERE batch_id = :bid"), {"bid": batch_id}
+        ).scalar()
+        clean_count = conn.execute(insert_sql, {"bid": batch_id}).rowcount
+
+    dropped = raw_count - clean_count
+    if dropped > 0:
+        print_log(f"Loại bỏ {dropped} dòng không hợp lệ (thiếu ngày/nhiệt độ)")
+    return raw_count, clean_count
+
+TRANSFORM_ENGINES = {
+    "pandas": transform_batch_chunked,
+    "sql": transform_batch_pushdown,
+}
+
+def check_engine_parity(batch_id):
+    """
+    So sánh kết quả của 2 engine trên cùng 1 batch raw (chỉ đọc, không ghi gì).
+    Trả về True nếu giống nhau.
+    """
+    cols = output_columns()
+    raw_df = pd.read_sql(text(f"SELECT * FROM {RAW_TABLE} WHERE batch_id = :bid"), engine, params={"bid": batch_id})
+    pandas_df, _ = convert_frame(raw_df)
+    sql_df = pd.read_sql(text(build_select_sql(RAW_TABLE)), engine, params={"bid": batch_id})
+
+    # MySQL trả về cờ dạng 0/1
+    for spec in COLUMN_SPECS:
+        if spec["type"] == "flag":
+            sql_df[spec["column"]] = sql_df[spec["column"]].astype(bool)
+
+    sort_keys = ["location_key", "date_time"]
+    pandas_df = pandas_df[cols].sort_values(sort_keys).reset_index(drop=True)
+    sql_df = sql_df[cols].sort_values(sort_keys).reset_index(drop=True)
+    try:
+        pd.testing.assert_frame_equal(pandas_df, sql_df, check_dtype=False, check_exact=False, rtol=1e-6)
+    except AssertionError as e:
+        print_log(f"KHÁC BIỆT giữa engine pandas và sql (batch_id = {batch_id}): {e}")
+        return False
+    print_log(f"Engine pandas và sql cho kết quả giống nhau ({len(sql_df):,} dòng, batch_id = {batch_id})")
+    return True
+
+def parse_engine_arg(argv):
+    """Đọc tham số --engine <pandas|sql> (mặc định lấy từ TRANSFORM_ENGINE)."""
+    name = TRANSFORM_ENGINE
+    for i, arg in enumerate(argv):
+        if arg.startswith("--engine="):
+            name = arg.split("=", 1)[1]
+        elif arg == "--engine" and i + 1 < len(argv):
+            name = argv[i + 1]
+    if name not in TRANSFORM_ENGINES:
+        print_log(f"Engine không hợp lệ: {name} (chọn: {', '.join(TRANSFORM_ENGINES)})")
+        sys.exit(1)
+    return name
 
 # ============ MAIN WORKFLOW ============
+def process_batch(batch_id, engine_name):
+    """
+    Chuyển đổi 1 batch (chạy trong process worker): ghi trạng thái batch_log riêng,
+    thành công thì xóa raw của đúng batch đó, lỗi thì xóa phần transform đã ghi dở.
+    Trả về (batch_id, số dòng raw, số dòng sạch).
+    """
+    try:
+        # Partition dựng sẵn cho batch trong bảng transform (xóa dữ liệu cũ nếu batch được chạy lại)
+        prepare_batch(engine, TRANSFORM_TABLE, batch_id)
+        raw_count, clean_count = TRANSFORM_ENGINES[engine_name](batch_id)
+
+        # Ghi log thành công vào batch_log
+        update_batch_status(batch_id, "SUCCESS", clean_count=clean_count, raw_count=raw_count)
+        print_log(f"Ghi log thành công vào batch_log (batch_id = {batch_id})")
+
+        # Cuối cùng mới dọn raw của batch này (chỉ chạm partition của batch, không khóa batch khác)
+        release_batch(engine, RAW_TABLE, batch_id)
+        return batch_id, raw_count, clean_count
+
+    except Exception as e:
+        error_detail = f"Transform lỗi: {str(e)}"
+        print_log(f"THẤT BẠI (batch_id = {batch_id}): {error_detail}")
+        release_batch(engine, TRANSFORM_TABLE, batch_id)
+        update_batch_status(batch_id, "FAILED", error_msg=error_detail)
+        print_log(f"Đã ghi lỗi vào batch_log (batch_id = {batch_id})")
+        raise
+
+def _init_worker():
+    # Không dùng lại kết nối kế thừa từ process cha (fork)
+    engine.dispose(close=False)
+
 def main():
     print_log("=== BẮT ĐẦU TRANSFORM THEO WORKFLOW MỚI ===")
 
@@ -60,118 +219,44 @@ def main():
     print_log("Kết nối đến weather_staging_db")
 
     # 2. Kiểm tra raw_weather_forecast có dữ liệu không?
-    batch_id = get_current_batch_id()
+    batch_ids = get_pending_batch_ids()
     
-    if not batch_id:
+    if not batch_ids:
         error_msg = "Không có dữ liệu trong bảng raw_weather_forecast"
         print_log(f"THẤT BẠI: {error_msg}")
         print_log("=== KẾT THÚC VỚI LỖI ===")
         sys.exit(1)  # Thoát ngay, không làm gì thêm
 
-    print_log(f"Phát hiện batch_id = {batch_id} → Có dữ liệu raw → Tiếp tục")
+    print_log(f"Phát hiện {len(batch_ids)} batch chờ xử lý: {batch_ids} → Tiếp tục")
 
-    try:
-        # 3. TRUNCATE bảng transform
-        print_log(f"TRUNCATE bảng {TRANSFORM_TABLE}")
-        with engine.begin() as conn:
-            conn.execute(text(f"TRUNCATE TABLE {TRANSFORM_TABLE}"))
-
-        # 4. Đọc và convert dữ liệu từ raw
-        print_log(f"Đọc dữ liệu từ {RAW_TABLE} (batch_id = {batch_id})")
-        df = pd.read_sql(f"SELECT * FROM {RAW_TABLE} WHERE batch_id = {batch_id}", engine)
-        raw_count = len(df)
-        print_log(f"Đọc được {raw_count:,} bản ghi thô")
-
-        # ================== CONVERT TỪNG FIELD ==================
-        def safe_datetime(x):
-            try:
-                s = str(x).split('+')[0].split('Z')[0].split('.')[0]
-                return pd.to_datetime(s)
-            except:
-                return pd.NaT
-
-        df['date_time'] = df['date_time'].apply(safe_datetime)
-        df['min_temp_c'] = pd.to_numeric(df['min_temp_c'], errors='coerce')
-        df['max_temp_c'] = pd.to_numeric(df['max_temp_c'], errors='coerce')
-
-        df['day_icon'] = pd.to_numeric(df['day_icon'], errors='coerce').fillna(0).astype(int)
-        df['night_icon'] = pd.to_numeric(df['night_icon'], errors='coerce').fillna(0).astype(int)
-
-        df['day_phrase'] = df['day_phrase'].fillna('Unknown').str.slice(0, 100)
-        df['night_phrase'] = df['night_phrase'].fillna('Unknown').str.slice(0, 100)
-
-        df['day_precip'] = df['day_precip'].notnull() & (df['day_precip'].astype(str).str.strip() != '0')
-        df['night_precip'] = df['night_precip'].notnull() & (df['night_precip'].astype(str).str.strip() != '0')
-
-        df['day_precip_type'] = df['day_precip_type'].fillna('None').str.slice(0, 20)
-        df['day_precip_intensity'] = df['day_precip_intensity'].fillna('None').str.slice(0, 20)
-        df['night_precip_type'] = df['night_precip_type'].fillna('None').str.slice(0, 20)
-        df['night_precip_intensity'] = df['night_precip_intensity'].fillna('None').str.slice(0, 20)
-
-        df['location_name'] = df['location_name'].fillna('Ho Chi Minh City')
-        df['location_key'] = df['location_key'].fillna('353981')
-        df['source'] = df['source'].fillna('AccuWeather')
-
-        # Loại bỏ dòng lỗi nghiêm trọng
-        before = len(df)
-        df = df.dropna(subset=['date_time', 'min_temp_c', 'max_temp_c'])
-        dropped = before - len(df)
-        if dropped > 0:
-            print_log(f"Loại bỏ {dropped} dòng không hợp lệ (thiếu ngày/nhiệt độ)")
-
-        clean_count = len(df)
-
-        # 5. Ghi dữ liệu sạch vào transform
-        print_log(f"Ghi {clean_count:,} bản ghi sạch vào {TRANSFORM_TABLE}")
-        df.to_sql(
-            name=TRANSFORM_TABLE,
-            con=engine,
-            if_exists='append',
-            index=False,
-            method='multi',
-            chunksize=1000,
-            dtype={
-                'batch_id': sqlalchemy.BIGINT(),
-                'date_time': sqlalchemy.DATETIME(),
-                'location_key': sqlalchemy.VARCHAR(50),
-                'location_name': sqlalchemy.VARCHAR(100),
-                'min_temp_c': sqlalchemy.FLOAT(),
-                'max_temp_c': sqlalchemy.FLOAT(),
-                'day_icon': sqlalchemy.INTEGER(),
-                'day_phrase': sqlalchemy.VARCHAR(100),
-                'day_precip': sqlalchemy.BOOLEAN(),
-                'day_precip_type': sqlalchemy.VARCHAR(20),
-                'day_precip_intensity': sqlalchemy.VARCHAR(20),
-                'night_icon': sqlalchemy.INTEGER(),
-                'night_phrase': sqlalchemy.VARCHAR(100),
-                'night_precip': sqlalchemy.BOOLEAN(),
-                'night_precip_type': sqlalchemy.VARCHAR(20),
-                'night_precip_intensity': sqlalchemy.VARCHAR(20),
-                'source': sqlalchemy.VARCHAR(100),
-                'mobile_link': sqlalchemy.VARCHAR(500),
-                'link': sqlalchemy.VARCHAR(500),
-            }
-        )
+    if "--parity-check" in sys.argv:
+        results = [check_engine_parity(batch_id) for batch_id in batch_ids]
+        sys.exit(0 if all(results) else 1)
 
-        # 6. Ghi log thành công vào batch_log
-        update_batch_status(batch_id, "SUCCESS", clean_count=clean_count)
-        print_log(f"Ghi log thành công vào batch_log (batch_id = {batch_id})")
+    engine_name = parse_engine_arg(sys.argv[1:])
+    print_log(f"Engine chuyển đổi: {engine_name}")
 
-        # 7. Cuối cùng mới TRUNCATE raw
-        print_log(f"TRUNCATE bảng {RAW_TABLE} (dọn dữ liệu thô)")
-        with engine.begin() as conn:
-            conn.execute(text(f"TRUNCATE TABLE {RAW_TABLE}"))
+    # 3. Mỗi batch 1 process worker, ghi vào partition riêng của bảng transform
+    #    (không TRUNCATE: các batch trước vẫn chờ load_to_staging lấy đi)
+    workers = max(1, min(TRANSFORM_WORKERS, len(batch_ids)))
+    print_log(f"Xử lý {len(batch_ids)} batch với {workers} process")
 
-        print_log("=== HOÀN TẤT TOÀN BỘ QUY TRÌNH TRANSFORM THÀNH CÔNG! ===")
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = {executor.submit(process_batch, batch_id, engine_name): batch_id for batch_id in batch_ids}
+        for future in as_completed(futures):
+            try:
+                batch_id, raw_count, clean_count = future.result()
+                print_log(f"Batch {batch_id}: {raw_count:,} bản ghi thô → {clean_count:,} bản ghi sạch")
+            except Exception:
+                failed.append(futures[future])
 
-    except Exception as e:
-        error_detail = f"Transform lỗi: {str(e)}"
-        print_log(f"THẤT BẠI: {error_detail}")
-        if batch_id:
-            update_batch_status(batch_id, "FAILED", error_msg=error_detail)
-            print_log(f"Đã ghi lỗi vào batch_log (batch_id = {batch_id})")
+    if failed:
+        print_log(f"Có {len(failed)}/{len(batch_ids)} batch thất bại: {sorted(failed)}")
         print_log("=== KẾT THÚC VỚI LỖI ===")
-        raise
+        sys.exit(1)
+
+    print_log("=== HOÀN TẤT TOÀN BỘ QUY TRÌNH TRANSFORM THÀNH CÔNG! ===")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
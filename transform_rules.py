@@ -0,0 +1,252 @@
+# transform_rules.py - Quy tắc chuyển kiểu raw -> transform (khai báo theo cột, chạy vector hóa)
+#
+# Tự kiểm tra quy tắc trên các giá trị biên (không cần database):
+#   python transform_rules.py
+import sys
+import pandas as pd
+
+# Mỗi cột: kiểu đích + giá trị mặc định (khi NULL/lỗi) + độ dài tối đa (với text)
+#   datetime: giữ giờ địa phương 'YYYY-MM-DD[ HH:MM[:SS]]', bỏ phần lẻ giây và timezone
+#             (Z, +hh:mm, -hh:mm), sai định dạng -> NaT
+#   float:    số thực dạng thập phân (NUMBER_PATTERN), lỗi/inf/nan -> NaN
+# Khác cách parse cũ (pd.to_datetime/pd.to_numeric từng giá trị): ngày không theo ISO 8601
+# (vd. '12/11/2025') và inf/nan dạng chữ giờ bị loại, vì engine sql (MySQL) không parse
+# được chúng giống pandas; API chỉ trả ngày ISO 8601 và nhiệt độ hữu hạn.
+#   int:      phần nguyên của số thực trên, lỗi/NULL -> default
+#   flag:     True nếu có giá trị và khác '0'
+#   text:     NULL -> default, cắt theo max_len
+COLUMN_SPECS = [
+    {"column": "date_time", "type": "datetime"},
+    {"column": "min_temp_c", "type": "float"},
+    {"column": "max_temp_c", "type": "float"},
+
+    {"column": "day_icon", "type": "int", "default": 0},
+    {"column": "night_icon", "type": "int", "default": 0},
+
+    {"column": "day_phrase", "type": "text", "default": "Unknown", "max_len": 100},
+    {"column": "night_phrase", "type": "text", "default": "Unknown", "max_len": 100},
+
+    {"column": "day_precip", "type": "flag"},
+    {"column": "night_precip", "type": "flag"},
+
+    {"column": "day_precip_type", "type": "text", "default": "None", "max_len": 20},
+    {"column": "day_precip_intensity", "type": "text", "default": "None", "max_len": 20},
+    {"column": "night_precip_type", "type": "text", "default": "None", "max_len": 20},
+    {"column": "night_precip_intensity", "type": "text", "default": "None", "max_len": 20},
+
+    {"column": "location_name", "type": "text", "default": "Ho Chi Minh City"},
+    {"column": "location_key", "type": "text", "default": "353981"},
+    {"column": "source", "type": "text", "default": "AccuWeather"},
+]
+
+# Dòng thiếu 1 trong các cột này sẽ bị loại bỏ
+REQUIRED_COLUMNS = ["date_time", "min_temp_c", "max_temp_c"]
+
+
+# Dùng chung cho cả 2 engine (Python re và MySQL REGEXP đều hiểu cú pháp này)
+NUMBER_PATTERN = "[-+]?(?:[0-9]+[.]?[0-9]*|[.][0-9]+)(?:[eE][-+]?[0-9]+)?"
+# Phần giờ địa phương của chuỗi ngày giờ, phần đuôi được phép bỏ đi (lẻ giây, timezone)
+DATETIME_LOCAL_PATTERN = (
+    "[0-9]{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12][0-9]|3[01])"
+    "(?:[T ](?:[01][0-9]|2[0-3]):[0-5][0-9](?::[0-5][0-9])?)?"
+)
+DATETIME_PATTERN = DATETIME_LOCAL_PATTERN + "(?:[.][0-9]+)?(?:Z|[-+][0-9]{2}(?::?[0-9]{2})?)?"
+
+
+def _to_datetime(s, spec):
+    # Cắt về giờ địa phương trước khi parse: lẫn offset âm/dương trong 1 batch
+    # sẽ làm pd.to_datetime báo lỗi "Mixed timezones" cho cả batch
+    s = s.astype(str)
+    local = s.str.extract(f"^({DATETIME_LOCAL_PATTERN})", expand=False)
+    local = local.where(s.str.fullmatch(DATETIME_PATTERN)).str.replace("T", " ", regex=False)
+    return pd.to_datetime(local, errors="coerce", format="ISO8601")
+
+def _to_number(s):
+    # Chỉ nhận số thập phân theo NUMBER_PATTERN (inf/nan/Infinity -> NaN như engine sql,
+    # MySQL không lưu được inf); TRIM của MySQL chỉ bỏ dấu cách
+    s = s.astype(str).str.strip(" ")
+    return pd.to_numeric(s.where(s.str.fullmatch(NUMBER_PATTERN)), errors="coerce")
+
+def _to_float(s, spec):
+    return _to_number(s)
+
+def _to_int(s, spec):
+    return _to_number(s).fillna(spec.get("default", 0)).astype(int)
+
+def _to_flag(s, spec):
+    return s.notnull() & (s.astype(str).str.strip(" ") != "0")
+
+def _to_text(s, spec):
+    s = s.fillna(spec["default"]) if "default" in spec else s
+    return s.str.slice(0, spec["max_len"]) if "max_len" in spec else s
+
+CONVERTERS = {
+    "datetime": _to_datetime,
+    "float": _to_float,
+    "int": _to_int,
+    "flag": _to_flag,
+    "text": _to_text,
+}
+
+
+def convert_frame(df, specs=COLUMN_SPECS, required=REQUIRED_COLUMNS):
+    """
+    Áp dụng toàn bộ quy tắc chuyển kiểu cho DataFrame raw (mọi thao tác đều vector hóa),
+    rồi loại bỏ các dòng thiếu cột bắt buộc.
+    Trả về (DataFrame đã chuyển kiểu, số dòng bị loại).
+    """
+    converted = {
+        spec["column"]: CONVERTERS[spec["type"]](df[spec["column"]], spec)
+        for spec in specs
+    }
+    df = df.assign(**converted)
+
+    before = len(df)
+    df = df.dropna(subset=required)
+    return df, before - len(df)
+
+
+# ==============================================================================
+# PUSHDOWN: sinh câu SELECT (MySQL) có cùng ngữ nghĩa với convert_frame
+# ==============================================================================
+# Các cột raw được chép nguyên sang transform
+PASSTHROUGH_COLUMNS = ["batch_id", "mobile_link", "link"]
+
+
+
+def _sql_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _sql_number(col):
+    # Kiểm tra bằng regex trước khi ép kiểu để chuỗi lỗi thành NULL (không bị lỗi strict mode)
+    return f"(CASE WHEN TRIM({col}) REGEXP '^{NUMBER_PATTERN}$' THEN TRIM({col}) + 0 END)"
+
+def _sql_datetime(col, spec):
+    # Cùng quy tắc với _to_datetime: khớp DATETIME_PATTERN rồi giữ phần giờ địa phương
+    # (ngày vượt quá số ngày của tháng -> NULL thay vì để CAST báo lỗi strict mode)
+    local = f"REGEXP_SUBSTR({col}, '^{DATETIME_LOCAL_PATTERN}')"
+    # CASE lồng nhau: chỉ tính LAST_DAY khi chuỗi đã khớp định dạng
+    in_month = f"SUBSTRING({local}, 9, 2) + 0 <= DAY(LAST_DAY(CONCAT(LEFT({col}, 7), '-01')))"
+    return (f"(CASE WHEN {col} REGEXP '^{DATETIME_PATTERN}$' THEN "
+            f"CASE WHEN {in_month} THEN CAST(REPLACE({local}, 'T', ' ') AS DATETIME) END END)")
+
+def _sql_float(col, spec):
+    return _sql_number(col)
+
+def _sql_int(col, spec):
+    return f"COALESCE(TRUNCATE({_sql_number(col)}, 0), {int(spec.get('default', 0))})"
+
+def _sql_flag(col, spec):
+    return f"({col} IS NOT NULL AND TRIM({col}) <> '0')"
+
+def _sql_text(col, spec):
+    expr = f"COALESCE({col}, {_sql_literal(spec['default'])})" if "default" in spec else col
+    return f"LEFT({expr}, {int(spec['max_len'])})" if "max_len" in spec else expr
+
+SQL_CONVERTERS = {
+    "datetime": _sql_datetime,
+    "float": _sql_float,
+    "int": _sql_int,
+    "flag": _sql_flag,
+    "text": _sql_text,
+}
+
+
+def output_columns(specs=COLUMN_SPECS):
+    """Danh sách cột ghi vào bảng transform khi chạy pushdown."""
+    return PASSTHROUGH_COLUMNS + [spec["column"] for spec in specs]
+
+def build_select_sql(raw_table, specs=COLUMN_SPECS, required=REQUIRED_COLUMNS):
+    """
+    Sinh câu SELECT chuyển kiểu 1 batch (tham số :bid) ngay trên MySQL,
+    cùng quy tắc và cùng điều kiện loại dòng với convert_frame.
+    """
+    select_list = PASSTHROUGH_COLUMNS + [
+        f"{SQL_CONVERTERS[spec['type']](spec['column'], spec)} AS {spec['column']}"
+        for spec in specs
+    ]
+    where = " AND ".join(f"c.{col} IS NOT NULL" for col in required)
+    return (
+        f"SELECT {', '.join(output_columns(specs))} FROM ("
+        f"SELECT {', '.join(select_list)} FROM {raw_table} WHERE batch_id = :bid"
+        f") c WHERE {where}"
+    )
+
+
+# ==============================================================================
+# TỰ KIỂM TRA: giá trị biên -> kết quả mong đợi
+# ==============================================================================
+EDGE_CASES = {
+    "datetime": [
+        ("2025-11-12T07:00:00+07:00", "2025-11-12 07:00:00"),
+        ("2025-11-12T07:00:00-05:00", "2025-11-12 07:00:00"),
+        ("2025-11-12T07:00:00Z", "2025-11-12 07:00:00"),
+        ("2025-11-12T07:00:00.123-03:30", "2025-11-12 07:00:00"),
+        ("2025-11-12T07:00", "2025-11-12 07:00:00"),
+        ("2025-11-12 07:00:00", "2025-11-12 07:00:00"),
+        ("2025-11-12", "2025-11-12 00:00:00"),
+        ("2025-02-30T07:00:00", None),
+        ("12/11/2025", None),  # Cách cũ parse thành 2025-12-11, quy tắc mới chỉ nhận ISO 8601
+        ("Nov 12 2025", None),
+        ("abc", None),
+        (None, None),
+    ],
+    "float": [
+        ("25.5", "25.5"),
+        (" -3 ", "-3.0"),
+        ("+.5", "0.5"),
+        ("1e2", "100.0"),
+        ("7.", "7.0"),
+        ("inf", None),
+        ("-Infinity", None),
+        ("nan", None),
+        ("1,5", None),
+        ("", None),
+        (None, None),
+    ],
+    "int": [
+        ("12", "12"),
+        ("12.9", "12"),
+        ("-3.7", "-3"),
+        ("nan", "0"),
+        ("abc", "0"),
+        (None, "0"),
+    ],
+}
+
+
+def check_edge_cases():
+    """
+    Chạy convert_frame trên EDGE_CASES (cả batch trộn lẫn timezone âm/dương/không có,
+    như khi danh mục có địa điểm ở nhiều múi giờ). Engine sql dùng chung NUMBER_PATTERN /
+    DATETIME_PATTERN nên cũng được kiểm tra là nhúng nguyên văn các pattern đó vào câu SQL.
+    Trả về danh sách lỗi (rỗng = đạt).
+    """
+    errors = []
+    # MySQL xử lý dấu backslash trong chuỗi SQL trước khi tới REGEXP: pattern không được chứa backslash
+    select_sql = build_select_sql("raw")
+    for name, pattern in [("NUMBER_PATTERN", NUMBER_PATTERN), ("DATETIME_PATTERN", DATETIME_PATTERN)]:
+        if "\\" in pattern or f"'^{pattern}$'" not in select_sql:
+            errors.append(f"sql: {name} không được nhúng nguyên văn vào build_select_sql")
+    for spec_type, cases in EDGE_CASES.items():
+        spec = {"column": "value", "type": spec_type}
+        values = [raw for raw, _ in cases]
+        try:
+            result = CONVERTERS[spec_type](pd.Series(values, dtype=object), spec)
+        except Exception as e:
+            errors.append(f"{spec_type}: cả batch lỗi ({e})")
+            continue
+        for (raw, expected), actual in zip(cases, result):
+            actual = None if pd.isna(actual) else str(actual)
+            if actual != expected:
+                errors.append(f"{spec_type}: {raw!r} -> {actual!r}, mong đợi {expected!r}")
+    return errors
+
+
+if __name__ == "__main__":
+    failures = check_edge_cases()
+    for failure in failures:
+        print(f"❌ {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"✅ {sum(len(cases) for cases in EDGE_CASES.values())} giá trị biên đều đúng quy tắc.")